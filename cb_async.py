@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import sys
+import serial
+from serial import Serial
+from time import monotonic
+from time import time
+
+from cb_events import EventLog, CMD, REPLY
+from cb_metrics import Metrics
+from simulate_cb import (CbProtocol, FrameCodec, LineSplitter, UnexpectedDisconnect, match_response, command_name,
+                         split_replies, setting_value, OUTCOMES, SSPPIN_PAT, POLL_INTERVAL, ISCA_LOST, ISCA_RECOVERED,
+                         ATTEMPTS_FAILED, CB_CONNECTED, CB_DISCONNECT, RECOVERED)
+
+
+class AsyncUartDriver :
+    def __init__(self, baud=115200, port="/dev/ttyUSB0", verbose=0, metrics=None, events=None) :
+        self.baud = int(baud)
+        self.port = port
+        self.verbose = int(verbose)
+        self.metrics = metrics
+        self.events = events if events != None else EventLog()
+        self.serial = None
+        self.codec = FrameCodec()
+        self.splitter = LineSplitter()
+        self.lines = asyncio.Queue()
+        self.full_response = ""
+        self.wire = asyncio.Lock()
+        self.frame = None
+        self.poller = None
+        self.closing = False
+
+    async def bind(self) :
+        print("[UART_BIND][ ]: The uart driver will be bind to port %s with baudrate %d" % (self.port, self.baud))
+        # timeout=0 keeps every read non-blocking, the event loop tells us when bytes arrived
+        self.serial = Serial(port=self.port, baudrate=self.baud, bytesize=8, timeout=0, stopbits=serial.STOPBITS_ONE)
+        self.closing = False
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.serial.fileno(), self.on_readable)
+        self.poller = asyncio.create_task(self.poll_loop())
+        print("[UART_BIND][X]")
+
+    async def close(self) :
+        # wait_for may swallow a cancel that races a completed frame, so the loop also checks a flag
+        self.closing = True
+        if self.poller :
+            self.poller.cancel()
+            try :
+                await self.poller
+            except asyncio.CancelledError :
+                pass
+            self.poller = None
+        if self.serial :
+            asyncio.get_running_loop().remove_reader(self.serial.fileno())
+            self.serial.close()
+            self.serial = None
+
+    def on_readable(self) :
+        data = self.serial.read(self.serial.in_waiting or 1)
+        for payload in self.codec.feed(data) :
+            if self.frame and not self.frame.done() :
+                self.frame.set_result(payload)
+
+    async def poll(self) :
+        async with self.wire :
+            self.codec.reset()
+            self.frame = asyncio.get_running_loop().create_future()
+            self.serial.write(self.codec.encode('r'))
+            try :
+                payload = await asyncio.wait_for(self.frame, 1)
+            except asyncio.TimeoutError :
+                return None
+            finally :
+                self.frame = None
+            if payload :
+                self.serial.write(self.codec.encode('a'))
+            return payload
+
+    async def poll_loop(self) :
+        while not self.closing :
+            payload = await self.poll()
+            if payload :
+                text = payload.decode('ascii', 'replace')
+                self.events.emit(REPLY, data=text, port=self.port)
+                if self.verbose :
+                    print("[%s] Resposta do comando: \"%s\"" % (self.port, text))
+                lines = self.splitter.feed(text)
+            else :
+                lines = self.splitter.flush()
+                await asyncio.sleep(POLL_INTERVAL)
+            if lines :
+                self.lines.put_nowait("\r\n".join(lines))
+
+    async def write(self, data) :
+        self.events.emit(CMD, data=data, port=self.port)
+        if self.verbose :
+            print("[%s] Enviando \"%s\"" % (self.port, data.decode('ascii')), end='')
+        async with self.wire :
+            self.serial.write(data)
+
+    async def read_until_x(self, timeout=1, pattern=None) :
+        deadline = monotonic() + timeout
+        self.full_response = ""
+
+        if pattern == None :
+            while not self.lines.empty() :
+                self.lines.get_nowait()
+            return 0
+
+        while True :
+            remaining = deadline - monotonic()
+            if remaining <= 0 :
+                return 1
+            try :
+                line = await asyncio.wait_for(self.lines.get(), remaining)
+            except asyncio.TimeoutError :
+                return 1
+            self.full_response += line + "\r\n"
+            err = match_response(pattern, line)
+            if err != None :
+                return err
+            ssppin = SSPPIN_PAT.search(line)
+            if ssppin :
+                msg = "AT+BSSPPIN " + ssppin.group(1) + ",123456"
+                await self.transport_msg(attempts=2, timeout=10, data=msg, expected="OK")
+                print("Aguardando a isca processar o bound...")
+
+    async def transport_msg(self, attempts, timeout, data, expected="OK") :
+        if not self.metrics :
+            return await self.send_msg(attempts, timeout, data, expected)
+
+        cmd = command_name(data)
+        start = monotonic()
+        outcome = "UnexpectedDisconnect"
+        try :
+            err = await self.send_msg(attempts, timeout, data, expected)
+            outcome = OUTCOMES.get(err, str(err))
+            return err
+        finally :
+            self.metrics.observe("cb_transport_seconds", monotonic() - start, cmd=cmd, outcome=outcome, port=self.port)
+            self.metrics.inc("cb_transport_total", cmd=cmd, outcome=outcome, port=self.port)
+
+    async def send_msg(self, attempts, timeout, data, expected) :
+        data = self.codec.encode('w', data)
+        while attempts > 0 :
+            await self.write(data)
+            err = await self.read_until_x(timeout, expected)
+            if not err :
+                return 0
+            elif err == ISCA_LOST :
+                return ISCA_LOST
+            elif err == ISCA_RECOVERED :
+                return ISCA_RECOVERED
+            attempts = attempts - 1
+
+        return ATTEMPTS_FAILED
+
+
+class AsyncSimulation(CbProtocol) :
+    # Simulation's trip on the event loop: the commands and what is kept from their replies
+    # come from CbProtocol, only the waiting is done here
+    def __init__(self, uart, telemetry=None) :
+        self.uart = uart
+        self.telemetry = telemetry
+        self.mode = "async"
+        self.init_protocol(uart.events)
+
+    async def send(self, msg) :
+        return await self.uart.transport_msg(**msg)
+
+    async def cb_setup(self) :
+        print("[CB_SETUP][ ] : %s" % self.uart.port)
+        settings = self.setup_settings()
+        current = {}
+        for cmd, name, value in settings :
+            err = await self.uart.transport_msg(attempts=1, timeout=5, data="AT+%s?" % name, expected="OK")
+            replies = [lines for ok, lines in split_replies(self.uart.full_response)]
+            current[name] = setting_value(name, replies[-1]) if not err and replies else None
+        changed = self.changed_settings(settings, current)
+        if not changed :
+            print("[CB_SETUP][X] : %s já configurado" % self.uart.port)
+            return 0
+
+        for cmd in changed :
+            err = await self.uart.transport_msg(attempts=1, timeout=10, data=cmd, expected="OK")
+            if err :
+                print("[CB_SETUP][ ] : %s: falha ao configurar o extensor" % self.uart.port)
+                return err
+        for cmd, msg in (('AT&W', self.save_msg()), ('AT+RESET', self.reset_msg())) :
+            if cmd in self.setup_arr :
+                err = await self.send(msg)
+                if err :
+                    print("[CB_SETUP][ ] : %s: %s falhou" % (self.uart.port, cmd))
+                    return err
+        print("[CB_SETUP][X] : %s: %d de %d configurações alteradas" % (self.uart.port, len(changed), len(settings)))
+        return 0
+
+    async def connect(self, addr) :
+        err = await self.send(self.connect_msg(addr))
+        if not err :
+            self.addr = addr
+        return err
+
+    async def disconnect(self, channel) :
+        return await self.send(self.disconnect_msg(channel))
+
+    async def send_tid(self, expected=None) :
+        return await self.send(self.tid_msg(expected))
+
+    async def change_mode(self, mode) :
+        err = await self.send(self.mode_msg(mode))
+        self.mode_written()
+        return err
+
+    async def set_times(self, static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time) :
+        values = self.time_values(static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time)
+        names, cmds = self.attribute_writes(values)
+        results = []
+        for cmd in cmds :
+            results.append(await self.uart.transport_msg(attempts=1, timeout=10, data=cmd, expected="OK"))
+            if results[-1] :
+                break
+        results += [ATTEMPTS_FAILED] * (len(cmds) - len(results))
+        return self.attributes_written(names, values, results)
+
+    async def wait_until(self, when) :
+        waiting_bait = when - time()
+        if waiting_bait > 0 :
+            await asyncio.sleep(waiting_bait)
+            if self.uart.metrics :
+                self.uart.metrics.observe("cb_bait_wait_seconds", waiting_bait, mode=self.mode, port=self.uart.port)
+
+    async def reconnect(self, addr, predictor, learn=True, deadline=None) :
+        # Simulation.reconnect on the event loop: dial with jittered backoff until the bait
+        # answers or the deadline (monotonic) passes
+        lost = 0
+        while True :
+            attempt = time()
+            err = await self.connect(addr)
+            if not err :
+                self.bait_connected(addr, predictor, self.now_tid if learn else None, attempt)
+                if lost :
+                    self.events.emit(RECOVERED, addr=addr, attempts=lost)
+                self.actual_state = CB_CONNECTED
+                return 0
+            if err == ISCA_LOST :
+                print("[%s] Isca perdida, tentando reconectar..." % self.uart.port)
+                self.nisca_lost += 1
+                lost += 1
+                self.bait_lost(addr, self.nisca_lost)
+            if deadline != None and monotonic() >= deadline :
+                return err if err == ISCA_LOST else ATTEMPTS_FAILED
+            await asyncio.sleep(self.backoff_delay(predictor, deadline))
+
+    async def end_trip(self, timeout) :
+        # Cancelled (Ctrl-C): leave the bait in mode 00 and the link closed, as Simulation.run does
+        await self.uart.read_until_x()
+        if self.actual_state != CB_CONNECTED :
+            print("[%s] Isca desconectada, tentando conectar com a isca para finalizar viagem..." % self.uart.port)
+            if await self.reconnect(self.addr, self.predictor(self.addr, 0), learn=False, deadline=monotonic() + timeout) :
+                print("[%s] Isca não respondeu, viagem não encerrada" % self.uart.port)
+                return
+        print("[%s] Encerrando viagem..." % self.uart.port)
+        await self.change_mode("00")
+        await self.disconnect("0x10")
+        self.actual_state = CB_DISCONNECT
+        print("[%s] Viagem encerrada com sucesso!" % self.uart.port)
+
+    async def bait_in_field(self, addr, static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time, cycles=0) :
+        # Same trip as the field scenario, with the target and times given up front
+        await self.uart.read_until_x()
+        await self.disconnect("0x10")
+        self.addr = addr
+        predictor = self.predictor(addr, static_sleep_time)
+        try :
+            await self.reconnect(addr, predictor, learn=False)
+
+            err = await self.set_times(static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time)
+            if err :
+                return err
+            err = await self.change_mode("01")
+            if err :
+                return err
+
+            done = 0
+            while not cycles or done < cycles :
+                try :
+                    while await self.send_tid() :
+                        pass
+                    await self.wait_until(predictor.next_attempt(self.now_tid))
+                    await self.reconnect(addr, predictor, learn=True)
+                    done += 1
+                except UnexpectedDisconnect :
+                    print("[%s] Isca perdida!!!" % self.uart.port)
+                    self.actual_state = CB_DISCONNECT
+                    await self.reconnect(addr, predictor, learn=False)
+        except asyncio.CancelledError :
+            # One sleep and wait of the bait is the longest it can take to answer
+            await self.end_trip(static_sleep_time + static_wait_time)
+            raise
+
+        await self.change_mode("00")
+        await self.disconnect("0x10")
+        self.actual_state = CB_DISCONNECT
+        return 0
+
+
+async def run_trip(port, baud, addr, times, setup, cycles, verbose, metrics=None) :
+    uart = AsyncUartDriver(baud=baud, port=port, verbose=verbose, metrics=metrics)
+    await uart.bind()
+    try :
+        sim = AsyncSimulation(uart)
+        if setup :
+            err = await sim.cb_setup()
+            if err :
+                print("[CB_SETUP][ ] : viagem abortada em %s (%s)" % (port, OUTCOMES.get(err, err)))
+                return err
+        return await sim.bait_in_field(addr, *times, cycles=cycles)
+    finally :
+        await uart.close()
+
+
+async def run_all(args, metrics=None) :
+    times = (args.static_sleep, args.static_wait, args.dyn_sleep, args.dyn_wait)
+    trips = [run_trip(port, args.baudrate, addr, times, args.setup, args.cycles, args.verbose, metrics)
+             for port, addr in zip(args.port, args.bait)]
+    return await asyncio.gather(*trips, return_exceptions=True)
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Several trackers working as CB on one event loop')
+    parser.add_argument('-p', '--port', type=str, action='append', required=True,
+                        help='Port of UART device, once per extender')
+    parser.add_argument('-a', '--bait', type=str, action='append', required=True,
+                        help='Bait address (e.g. 001EC0A1B2C3,t2), once per port')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200,
+                        help='UART baudrate')
+    parser.add_argument('--static-sleep', type=int, default=60)
+    parser.add_argument('--static-wait', type=int, default=10)
+    parser.add_argument('--dyn-sleep', type=int, default=30)
+    parser.add_argument('--dyn-wait', type=int, default=10)
+    parser.add_argument('-n', '--cycles', type=int, default=0,
+                        help='Wake cycles per bait, 0 runs until interrupted')
+    parser.add_argument('-s', '--setup', type=int, default=0,
+                        help='Enable the setup to extensor work as CB')
+    parser.add_argument('-v', '--verbose', type=int, default=0,
+                        help='Simulation verbose')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Export timing metrics of every port here on exit (.json or Prometheus text)')
+    args = parser.parse_args(sys.argv[1:])
+    if len(args.port) != len(args.bait) :
+        parser.error("one --bait is required for each --port")
+
+    metrics = Metrics() if args.metrics else None
+    try :
+        for port, result in zip(args.port, asyncio.run(run_all(args, metrics))) :
+            print("%s: %s" % (port, result))
+    except KeyboardInterrupt :
+        print("Viagens interrompidas")
+    finally :
+        if metrics :
+            metrics.dump(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+from time import monotonic
+from time import time
+
+import simulate_cb
+from simulate_cb import UartDriver, Simulation, TID_ADDR
+
+WORKLOADS = ('tid', 'connect', 'scan', 'set_times')
+
+
+def percentile(samples, q) :
+    if not samples :
+        return None
+    ordered = sorted(samples)
+    pos = (len(ordered) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def summarize(name, samples, failures, elapsed) :
+    return {'workload': name,
+            'n': len(samples),
+            'failures': failures,
+            'elapsed_s': elapsed,
+            'throughput_ops_s': len(samples) / elapsed if elapsed else None,
+            'mean_s': sum(samples) / len(samples) if samples else None,
+            'p50_s': percentile(samples, 0.50),
+            'p90_s': percentile(samples, 0.90),
+            'p99_s': percentile(samples, 0.99),
+            'max_s': max(samples) if samples else None}
+
+
+class Bench :
+    def __init__(self, sim, addr, iterations) :
+        self.sim = sim
+        self.uart = sim.uart
+        self.addr = addr
+        self.iterations = iterations
+
+    def measure(self, name, step) :
+        samples = []
+        failures = 0
+        start = monotonic()
+        for _ in range(self.iterations) :
+            t0 = monotonic()
+            err = step()
+            samples.append(monotonic() - t0)
+            if err :
+                failures += 1
+        return summarize(name, samples, failures, monotonic() - start)
+
+    def quiet(self) :
+        # show_baits prints the whole table on every call
+        return contextlib.redirect_stdout(io.StringIO())
+
+    def tid(self) :
+        self.sim.connect(self.addr)
+        # A bait in normal mode answers the TID with OK and keeps the link
+        msg = 'AT+LEWRITE=0x10,' + TID_ADDR + ",000F"
+        result = self.measure('tid', lambda : self.uart.transport_msg(attempts=1, timeout=10, data=msg, expected="OK"))
+        self.sim.disconnect("0x10")
+        return result
+
+    def connect(self) :
+        def cycle() :
+            err = self.sim.connect(self.addr)
+            return self.sim.disconnect("0x10") if not err else err
+        return self.measure('connect', cycle)
+
+    def scan(self) :
+        parse = []
+
+        def step() :
+            err = self.sim.scan()
+            t0 = monotonic()
+            with self.quiet() :
+                self.sim.show_baits()
+            parse.append(monotonic() - t0)
+            return err
+
+        result = self.measure('scan', step)
+        result['parse'] = summarize('scan_parse', parse, 0, sum(parse))
+        result['response_bytes'] = len(self.uart.full_response)
+        return result
+
+    def set_times(self) :
+        # Unchanged values are skipped, so every iteration starts from a forgotten mirror
+        # to time the four writes and not the diff
+        def step() :
+            self.sim.mirror().invalidate()
+            return self.sim.set_times(60, 10, 30, 10)
+
+        self.sim.addr = self.addr
+        self.sim.connect(self.addr)
+        result = self.measure('set_times', step)
+        self.sim.disconnect("0x10")
+        self.sim.addr = None
+        return result
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Benchmarks of the CB command path')
+    parser.add_argument('-p', '--port', type=str, default=None,
+                        help='Port of UART device, the bundled emulator is used when omitted')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200)
+    parser.add_argument('-a', '--bait', type=str, default="001EC0A1B2C3,t2",
+                        help='Bait address used by connect/TID/set_times workloads')
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('-w', '--workload', type=str, action='append', choices=WORKLOADS,
+                        help='Workload to run, may be repeated (default: all)')
+    parser.add_argument('-r', '--reader', type=int, default=1,
+                        help='Drain the UART from a dedicated reader thread')
+    parser.add_argument('--window', type=int, default=simulate_cb.PIPELINE_WINDOW)
+    parser.add_argument('--noise', type=int, default=200,
+                        help='Extra devices per emulated scan')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Emulated reply latency in seconds')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Write the JSON report here instead of stdout')
+    args = parser.parse_args(sys.argv[1:])
+
+    emulator = None
+    port = args.port
+    if not port :
+        from cb_emulator import CbEmulator
+        emulator = CbEmulator(latency=args.latency, scan_time=0.2, noise=args.noise, seed=0)
+        emulator.add_bait(args.bait, bonded=True)
+        port = emulator.start()
+
+    with contextlib.redirect_stdout(io.StringIO()) :
+        uart = UartDriver(baud=args.baudrate, port=port, reader=args.reader, window=args.window)
+    sim = Simulation(uart=uart, mode='field', setup=0)
+    sim.progress = False
+    bench = Bench(sim, args.bait, args.iterations)
+
+    report = {'timestamp': time(),
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'target': 'emulator' if emulator else port,
+              'reader': args.reader,
+              'window': args.window,
+              'iterations': args.iterations,
+              'results': []}
+    for name in args.workload or WORKLOADS :
+        report['results'].append(getattr(bench, name)())
+
+    uart.stop_reader()
+    if emulator :
+        emulator.stop()
+
+    text = json.dumps(report, indent=2)
+    if args.output :
+        with open(args.output, 'w') as f :
+            f.write(text + "\n")
+    else :
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
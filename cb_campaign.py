@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import fnmatch
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import sys
+import traceback
+from multiprocessing.connection import wait
+from serial.tools import list_ports
+from time import monotonic
+from time import time
+
+from cb_metrics import Metrics
+from cb_scenario import parse_params
+
+DISCOVER_PATTERNS = ("/dev/ttyUSB*", "/dev/ttyACM*")
+GRACE_TIME = 30
+
+
+def discover_ports(patterns=DISCOVER_PATTERNS) :
+    return sorted(p.device for p in list_ports.comports() if any(fnmatch.fnmatch(p.device, pat) for pat in patterns))
+
+
+def interrupt(signum, frame) :
+    # SIGTERM from the campaign runs the scenario's stop states like a Ctrl-C would
+    raise KeyboardInterrupt()
+
+
+def run_device(job, conn) :
+    # Worker process: one extender, its own log file, result sent back through conn
+    from simulate_cb import UartDriver, Simulation, OUTCOMES, SCAN_ATTEMPTS
+    from cb_telemetry import TelemetryStore
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    result = {'port': job['port'], 'bait': job.get('bait'), 'mode': job['mode'], 'params': job.get('params', {}),
+              'started': time()}
+    metrics = Metrics()
+    start = monotonic()
+    log = open(job['log'], 'w') if job.get('log') else open(os.devnull, 'w')
+    telemetry = TelemetryStore(job['telemetry']) if job.get('telemetry') else None
+    try :
+        with contextlib.redirect_stdout(log) :
+            uart = UartDriver(baud=job.get('baudrate', 115200), port=job['port'], reader=job.get('reader', 1),
+                              window=job.get('window', 4), metrics=metrics, record=job.get('record'))
+            try :
+                if not uart.serial :
+                    raise IOError("could not open %s" % job['port'])
+                sim = Simulation(uart=uart, mode=job['mode'], setup=job.get('setup', 0), target=job.get('bait'),
+                                 params=job.get('params', {}), telemetry=telemetry)
+                sim.progress = False
+                sim.scan_attempts = job.get('scan_attempts', SCAN_ATTEMPTS)
+                code = sim.run() or 0
+            finally :
+                uart.close()
+        result['code'] = code
+        result['outcome'] = OUTCOMES.get(code, str(code))
+        result['lost'] = sim.nisca_lost
+    except KeyboardInterrupt :
+        result['code'] = None
+        result['outcome'] = 'INTERRUPTED'
+    except Exception :
+        result['code'] = None
+        result['outcome'] = 'EXCEPTION'
+        result['error'] = traceback.format_exc()
+    finally :
+        log.close()
+        if telemetry != None :
+            telemetry.close()
+    result['elapsed_s'] = monotonic() - start
+    result['metrics'] = metrics.snapshot()
+    conn.send(result)
+    conn.close()
+
+
+class Campaign :
+    # One worker process per port, at most `jobs` at a time; a port over its timeout is
+    # asked to stop (SIGTERM), then killed after the grace time without touching the others
+    def __init__(self, devices, jobs=0, timeout=None, grace=GRACE_TIME) :
+        self.devices = devices
+        self.jobs = jobs or len(devices)
+        self.timeout = timeout
+        self.grace = grace
+        self.results = []
+
+    def failed(self, job, outcome, elapsed, error=None) :
+        result = {'port': job['port'], 'bait': job.get('bait'), 'mode': job['mode'], 'params': job.get('params', {}),
+                  'code': None, 'outcome': outcome, 'elapsed_s': elapsed}
+        if error :
+            result['error'] = error
+        return result
+
+    def run(self) :
+        ctx = multiprocessing.get_context("fork")
+        queue = list(self.devices)
+        running = {}
+        while queue or running :
+            while queue and len(running) < self.jobs :
+                job = queue.pop(0)
+                reader, writer = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=run_device, args=(job, writer), name="cb-%s" % os.path.basename(job['port']))
+                proc.start()
+                writer.close()
+                running[reader] = {'job': job, 'proc': proc, 'start': monotonic(), 'stopping': None}
+                print("[CAMPAIGN][ ] : %s -> %s (%s)" % (job['port'], job.get('bait'), job['mode']))
+
+            for reader in wait(list(running), timeout=1) :
+                entry = running.pop(reader)
+                try :
+                    result = reader.recv()
+                except EOFError :
+                    entry['proc'].join(1)
+                    result = self.failed(entry['job'], 'CRASHED', monotonic() - entry['start'],
+                                         "exit code %s" % entry['proc'].exitcode)
+                reader.close()
+                entry['proc'].join()
+                # A trip stopped at its timeout that still ended cleanly is a success
+                result['stopped'] = entry['stopping'] != None
+                self.results.append(result)
+                print("[CAMPAIGN][X] : %s %s em %.1fs" % (result['port'], result['outcome'], result['elapsed_s']))
+
+            now = monotonic()
+            for reader, entry in list(running.items()) :
+                if entry['stopping'] != None and now - entry['stopping'] > self.grace :
+                    entry['proc'].kill()
+                    entry['proc'].join()
+                    running.pop(reader)
+                    reader.close()
+                    self.results.append(self.failed(entry['job'], 'TIMEOUT', now - entry['start']))
+                    print("[CAMPAIGN][ ] : %s travado, processo encerrado" % entry['job']['port'])
+                elif entry['stopping'] == None and self.timeout and now - entry['start'] > self.timeout :
+                    entry['stopping'] = now
+                    entry['proc'].terminate()
+        order = dict((job['port'], idx) for idx, job in enumerate(self.devices))
+        self.results.sort(key=lambda r : order.get(r['port'], 0))
+        return self.results
+
+    def report(self) :
+        merged = Metrics()
+        for result in self.results :
+            if result.get('metrics') :
+                merged.merge(result['metrics'])
+        ok = [r for r in self.results if r['code'] == 0]
+        elapsed = [r['elapsed_s'] for r in self.results]
+        return {'timestamp': time(),
+                'host': platform.node(),
+                'devices': len(self.results),
+                'succeeded': len(ok),
+                'failed': len(self.results) - len(ok),
+                'wall_s': max(elapsed) if elapsed else 0,
+                'device_s': sum(elapsed),
+                'outcomes': dict((o, sum(1 for r in self.results if r['outcome'] == o))
+                                 for o in sorted(set(r['outcome'] for r in self.results))),
+                'results': self.results,
+                'metrics': merged.snapshot()}, merged
+
+
+def load_devices(args) :
+    defaults = {'mode': args.mode, 'params': parse_params(args.param), 'baudrate': args.baudrate,
+                'reader': args.reader, 'window': args.window, 'setup': args.setup, 'scan_attempts': args.scan_attempts}
+    devices = []
+    if args.campaign :
+        with open(args.campaign) as f :
+            spec = json.load(f)
+        defaults.update(spec.get('defaults', {}))
+        for device in spec.get('devices', []) :
+            job = dict(defaults)
+            job['params'] = dict(defaults['params'], **device.get('params', {}))
+            job.update((k, v) for k, v in device.items() if k != 'params')
+            devices.append(job)
+    else :
+        ports = args.port or discover_ports()
+        baits = args.bait or []
+        if len(baits) == 1 :
+            baits = baits * len(ports)
+        if len(baits) != len(ports) :
+            raise ValueError("%d ports but %d baits: give one --bait per port (or a single one for all)" % (len(ports), len(baits)))
+        for port, bait in zip(ports, baits) :
+            job = dict(defaults, port=port, bait=bait)
+            devices.append(job)
+    for job in devices :
+        name = os.path.basename(job['port'])
+        if args.log_dir and 'log' not in job :
+            job['log'] = os.path.join(args.log_dir, name + ".log")
+        if args.record_dir and 'record' not in job :
+            job['record'] = os.path.join(args.record_dir, name + ".cbsess")
+        if args.telemetry_dir and 'telemetry' not in job :
+            job['telemetry'] = os.path.join(args.telemetry_dir, name + ".cbtel")
+    return devices
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Run a scenario on several CB extenders at once')
+    parser.add_argument('-p', '--port', type=str, action='append',
+                        help='Extender port, may be repeated (default: discover ttyUSB/ttyACM ports)')
+    parser.add_argument('-a', '--bait', type=str, action='append',
+                        help='Bait for each port, in the same order')
+    parser.add_argument('-m', '--mode', type=str, default="field",
+                        help='Scenario run by every device')
+    parser.add_argument('-P', '--param', type=str, action='append', default=[],
+                        help='Scenario parameter as name=value, may be repeated')
+    parser.add_argument('--campaign', type=str, default=None,
+                        help='JSON file with "defaults" and a "devices" list (port, bait, mode, params, ...)')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200)
+    parser.add_argument('-r', '--reader', type=int, default=1)
+    parser.add_argument('-w', '--window', type=int, default=4)
+    parser.add_argument('-s', '--setup', type=int, default=0)
+    parser.add_argument('--scan-attempts', type=int, default=10,
+                        help='Scans for the bait before a device gives up, 0 scans forever')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Devices run at the same time, 0 runs all of them')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='Seconds before a device is stopped')
+    parser.add_argument('--grace', type=float, default=GRACE_TIME,
+                        help='Seconds a stopped device gets to end its trip before being killed')
+    parser.add_argument('--log-dir', type=str, default=None,
+                        help='Per-device output goes to <log-dir>/<port>.log')
+    parser.add_argument('--record-dir', type=str, default=None,
+                        help='Record every device session to <record-dir>/<port>.cbsess')
+    parser.add_argument('--telemetry-dir', type=str, default=None,
+                        help='Append every device trip telemetry to <telemetry-dir>/<port>.cbtel')
+    parser.add_argument('--emulate', type=int, default=0,
+                        help='Run against this many emulated extenders instead of real ports')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Write the JSON report here instead of stdout')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Also export the merged metrics here (.json or Prometheus text)')
+    args = parser.parse_args(sys.argv[1:])
+
+    emulators = []
+    if args.emulate :
+        from cb_emulator import CbEmulator
+        args.port = []
+        args.bait = []
+        for idx in range(args.emulate) :
+            emulator = CbEmulator(scan_time=0.2, seed=idx)
+            bait = emulator.add_bait("001EC0A1%04X,t2" % idx)
+            args.port.append(emulator.start())
+            args.bait.append(bait.bd_addr)
+            emulators.append(emulator)
+
+    for directory in (args.log_dir, args.record_dir, args.telemetry_dir) :
+        if directory :
+            os.makedirs(directory, exist_ok=True)
+    try :
+        devices = load_devices(args)
+    except (OSError, ValueError) as e :
+        parser.error(str(e))
+    if not devices :
+        parser.error("no extender found, use --port")
+
+    campaign = Campaign(devices, jobs=args.jobs, timeout=args.timeout, grace=args.grace)
+    try :
+        campaign.run()
+    finally :
+        for emulator in emulators :
+            emulator.stop()
+
+    report, merged = campaign.report()
+    text = json.dumps(report, indent=2)
+    if args.output :
+        with open(args.output, 'w') as f :
+            f.write(text + "\n")
+    else :
+        print(text)
+    if args.metrics :
+        merged.dump(args.metrics)
+    print("[CAMPAIGN][%s] : %d/%d devices ok" % ("X" if not report['failed'] else " ", report['succeeded'], report['devices']),
+          file=sys.stderr)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
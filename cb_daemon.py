@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from time import monotonic
+from time import time
+
+from simulate_cb import UartDriver, Simulation, OUTCOMES, PIPELINE_WINDOW, SCAN_ATTEMPTS, compile_pattern
+from cb_events import EventLog
+from cb_metrics import Metrics
+from cb_scenario import ScenarioError, parse_params
+from cb_state import BondCache, BaitRegistry, BOND_CACHE_PATH, BAIT_REGISTRY_PATH
+from cb_telemetry import TelemetryStore
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), "cb_daemon.sock")
+# Modes that ask the operator for input, nobody is there to answer
+INTERACTIVE_MODES = ('multi',)
+STOP_GRACE = 30
+
+
+class DaemonError(Exception) :
+    pass
+
+
+class CbDaemon :
+    # Owns the extender: the port is opened (and the CB set up) once, then jobs from thin
+    # clients run one at a time on the same Simulation, keeping bonds, wake predictors and
+    # attribute mirrors between them. One JSON request and one JSON reply per line.
+    def __init__(self, sim, path=SOCKET_PATH) :
+        self.sim = sim
+        self.uart = sim.uart
+        self.path = path
+        self.job_lock = threading.Lock()
+        self.job = None
+        self.jobs = 0
+        self.started = time()
+        self.server = None
+        self.stopping = threading.Event()
+        self.ops = {'run': self.run_job,
+                    'at': self.at,
+                    'stop': self.stop_job,
+                    'status': self.status,
+                    'shutdown': self.shutdown}
+
+    def listen(self) :
+        if os.path.exists(self.path) :
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try :
+                probe.connect(self.path)
+                raise DaemonError("a daemon already listens on %s" % self.path)
+            except (ConnectionRefusedError, FileNotFoundError) :
+                # Left behind by a daemon that died
+                os.unlink(self.path)
+            finally :
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created 0600 already, a chmod after bind leaves a window for other users to connect
+        old = os.umask(0o177)
+        try :
+            self.server.bind(self.path)
+        finally :
+            os.umask(old)
+        self.server.listen(8)
+        self.server.settimeout(0.5)
+
+    def serve(self) :
+        print("[DAEMON][X] : escutando em %s" % self.path)
+        try :
+            while not self.stopping.is_set() :
+                try :
+                    conn, _ = self.server.accept()
+                except socket.timeout :
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), name="cb-client", daemon=True).start()
+        finally :
+            self.unlisten()
+
+    def unlisten(self) :
+        self.server.close()
+        if os.path.exists(self.path) :
+            os.unlink(self.path)
+
+    def handle(self, conn) :
+        with conn :
+            for line in conn.makefile('rb') :
+                try :
+                    request = json.loads(line.decode('utf-8'))
+                    op = self.ops.get(request.get('op')) if isinstance(request, dict) else None
+                    if op == None :
+                        raise DaemonError("unknown request %s" % line.decode('utf-8', 'replace').strip())
+                    reply = op(request)
+                except (ValueError, DaemonError, ScenarioError) as e :
+                    reply = {'ok': False, 'error': str(e)}
+                except Exception :
+                    reply = {'ok': False, 'error': traceback.format_exc()}
+                try :
+                    conn.sendall((json.dumps(reply) + "\n").encode('utf-8'))
+                except OSError :
+                    return
+
+    def acquire(self, request) :
+        # Jobs and raw commands queue for the extender unless the client set a wait limit
+        wait = request.get('wait')
+        if not self.job_lock.acquire(timeout=-1 if wait == None else wait) :
+            raise DaemonError("busy with %s" % (self.job or {}).get('mode'))
+
+    def run_job(self, request) :
+        mode = request.get('mode')
+        if not mode :
+            raise DaemonError("run needs a mode")
+        if mode in INTERACTIVE_MODES or not request.get('bait') :
+            raise DaemonError("daemon jobs need a bait (-a) and a non-interactive mode")
+        params = request.get('params', {})
+        if isinstance(params, list) :
+            params = parse_params(params)
+        self.acquire(request)
+        try :
+            sim = self.sim
+            sim.mode = mode
+            sim.params = params
+            sim.target = request['bait']
+            sim.addr = None
+            sim.machine = None
+            sim.dialed = None
+            sim.cancel.clear()
+            lost = sim.nisca_lost
+            self.job = {'mode': mode, 'bait': sim.target, 'started': time()}
+            self.jobs += 1
+            start = monotonic()
+            code = sim.run() or 0
+            return {'ok': code == 0, 'code': code, 'outcome': OUTCOMES.get(code, str(code)),
+                    'elapsed_s': monotonic() - start, 'lost': sim.nisca_lost - lost,
+                    'stopped': self.job.get('stopped', False)}
+        finally :
+            self.job = None
+            self.job_lock.release()
+
+    def at(self, request) :
+        cmd = request.get('cmd')
+        if not cmd :
+            raise DaemonError("at needs a cmd")
+        expected = request.get('expected', "OK")
+        compile_pattern(expected)
+        self.acquire(request)
+        try :
+            start = monotonic()
+            err = self.uart.transport_msg(attempts=1, timeout=request.get('timeout', 10), data=cmd, expected=expected)
+            return {'ok': not err, 'code': err, 'outcome': OUTCOMES.get(err, str(err)),
+                    'response': self.uart.full_response, 'elapsed_s': monotonic() - start}
+        finally :
+            self.job_lock.release()
+
+    def stop_job(self, request=None) :
+        # A scenario goes through its stop states (end the trip, disconnect) like on Ctrl-C,
+        # an ota job gives up between writes
+        if self.job :
+            self.job['stopped'] = True
+            self.sim.stop()
+        return {'ok': True, 'running': self.job != None}
+
+    def status(self, request=None) :
+        metrics = self.uart.metrics
+        return {'ok': True,
+                'pid': os.getpid(),
+                'port': self.uart.port,
+                'uptime_s': time() - self.started,
+                'jobs': self.jobs,
+                'job': self.job,
+                'bait': self.sim.addr,
+                'state': self.sim.actual_state,
+                'lost': self.sim.nisca_lost,
+                'metrics': metrics.snapshot() if metrics else None}
+
+    def shutdown(self, request=None) :
+        self.stop_job()
+        self.stopping.set()
+        return {'ok': True}
+
+    def close(self) :
+        self.stop_job()
+        idle = self.job_lock.acquire(timeout=STOP_GRACE)
+        if not idle :
+            # Stop states still running past the grace period: cut them short too
+            print("[DAEMON][ ] : job não terminou em %ds, cancelando..." % STOP_GRACE)
+            self.sim.cancel.set()
+            idle = self.job_lock.acquire(timeout=STOP_GRACE)
+        if idle :
+            self.job_lock.release()
+            self.uart.close()
+        else :
+            # The job thread still owns the port, it goes away with the process
+            print("[DAEMON][ ] : job ainda ativo, porta %s não fechada" % self.uart.port)
+        if self.sim.bonds :
+            self.sim.bonds.flush()
+
+
+def send(request, path=SOCKET_PATH, timeout=None) :
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try :
+        client.connect(path)
+        client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        line = client.makefile('rb').readline()
+    finally :
+        client.close()
+    if not line :
+        raise DaemonError("daemon closed the connection")
+    return json.loads(line.decode('utf-8'))
+
+
+def serve(args) :
+    metrics = Metrics()
+    events = EventLog(path=args.events, console=bool(args.verbose))
+    events.install_crash_dump()
+    uart = UartDriver(baud=args.baudrate, port=args.port, verbose=args.verbose, reader=args.reader,
+                      window=args.window, metrics=metrics, events=events)
+    if not uart.serial :
+        print("[DAEMON][ ] : não foi possível abrir %s" % args.port)
+        return 1
+    telemetry = TelemetryStore(args.telemetry) if args.telemetry else None
+    sim = Simulation(uart=uart, mode="daemon", setup=0,
+                     bonds=BondCache(args.bond_cache) if args.bond_cache else None,
+                     registry=BaitRegistry(args.registry) if args.registry else None, telemetry=telemetry)
+    sim.progress = False
+    sim.scan_attempts = args.scan_attempts
+    daemon = CbDaemon(sim, args.socket)
+    try :
+        daemon.listen()
+    except DaemonError as e :
+        print("[DAEMON][ ] : %s" % e)
+        uart.close()
+        return 1
+
+    # Setup and the extender reset are paid once, not by every job
+    if args.setup :
+        err = sim.cb_setup()
+        if err :
+            print("[DAEMON][ ] : extensor não configurado (%s)" % OUTCOMES.get(err, err))
+            daemon.unlisten()
+            uart.close()
+            return 1
+    if args.uart_baud :
+        uart.negotiate_baud(args.uart_baud)
+    signal.signal(signal.SIGTERM, lambda signum, frame : daemon.shutdown())
+    try :
+        daemon.serve()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        print("[DAEMON][ ] : encerrando...")
+        daemon.close()
+        if telemetry != None :
+            telemetry.close()
+        if args.metrics :
+            metrics.dump(args.metrics)
+    return 0
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Keep the CB extender open and run jobs sent over a Unix socket')
+    parser.add_argument('--socket', type=str, default=SOCKET_PATH)
+    sub = parser.add_subparsers(dest='command')
+    daemon = sub.add_parser('serve', help='Open the extender and serve requests')
+    daemon.add_argument('-p', '--port', type=str, default="/dev/ttyUSB0")
+    daemon.add_argument('-b', '--baudrate', type=int, default=115200)
+    daemon.add_argument('-s', '--setup', type=int, default=0,
+                        help='Set the extender up as CB once, at startup')
+    daemon.add_argument('--uart-baud', type=int, default=0,
+                        help='Negotiate up to this UART baudrate once the port is open')
+    daemon.add_argument('-r', '--reader', type=int, default=1)
+    daemon.add_argument('-w', '--window', type=int, default=PIPELINE_WINDOW)
+    daemon.add_argument('--scan-attempts', type=int, default=SCAN_ATTEMPTS,
+                        help='Scans for the bait of a job before it fails, 0 scans forever')
+    daemon.add_argument('-v', '--verbose', type=int, default=0)
+    daemon.add_argument('--bond-cache', type=str, default=BOND_CACHE_PATH)
+    daemon.add_argument('--registry', type=str, default=BAIT_REGISTRY_PATH)
+    daemon.add_argument('--events', type=str, default=None)
+    daemon.add_argument('--telemetry', type=str, default=None)
+    daemon.add_argument('--metrics', type=str, default=None,
+                        help='Export the metrics here on shutdown')
+    run = sub.add_parser('run', help='Run a scenario on the daemon and wait for its outcome')
+    run.add_argument('-m', '--mode', type=str, default="field")
+    run.add_argument('-a', '--bait', type=str, required=True)
+    run.add_argument('-P', '--param', type=str, action='append', default=[])
+    run.add_argument('--wait', type=float, default=None,
+                     help='Give up if the extender is still busy after this many seconds')
+    at = sub.add_parser('at', help='Send one AT command through the daemon')
+    at.add_argument('cmd', type=str)
+    at.add_argument('-e', '--expected', type=str, default="OK")
+    at.add_argument('-t', '--timeout', type=float, default=10)
+    at.add_argument('--wait', type=float, default=None)
+    sub.add_parser('status', help='Show what the daemon is doing')
+    sub.add_parser('stop', help='Stop the running job through its stop states')
+    sub.add_parser('shutdown', help='Stop the running job and the daemon')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.command == 'serve' :
+        return serve(args)
+    if args.command == None :
+        parser.print_help()
+        return 1
+    if args.command == 'run' :
+        request = {'op': 'run', 'mode': args.mode, 'bait': args.bait, 'params': parse_params(args.param), 'wait': args.wait}
+    elif args.command == 'at' :
+        request = {'op': 'at', 'cmd': args.cmd, 'expected': args.expected, 'timeout': args.timeout, 'wait': args.wait}
+    else :
+        request = {'op': args.command}
+    try :
+        reply = send(request, args.socket)
+    except (OSError, DaemonError) as e :
+        print("[DAEMON][ ] : %s: %s" % (args.socket, e), file=sys.stderr)
+        return 2
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get('ok') else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
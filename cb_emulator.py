@@ -0,0 +1,453 @@
+import argparse
+import binascii
+import heapq
+import itertools
+import os
+import random
+import re
+import select
+import sys
+import threading
+import tty
+from time import monotonic
+from time import sleep
+
+BATTERY_ADDR = 0x0023
+TID_ADDR = 0x0026
+OP_MODE_CTRL_ADDR = 0x0029
+OP_MODE_VAL_ADDR = 0x002C
+STAT_SLEEP_TIME_ADDR = 0x0030
+STAT_WAIT_TIME_ADDR = 0x0033
+DYN_SLEEP_TIME_ADDR = 0x0036
+DYN_WAIT_TIME_ADDR = 0x0039
+OTA_CTRL_ADDR = 0x0040
+OTA_DATA_ADDR = 0x0043
+OTA_STATUS_ADDR = 0x0046
+
+READY_BANNER = "BlueMod+SR READY"
+
+WRITE_FRAME = re.compile(r'b w "(.*)" ([0-9A-Fa-f]{4})$')
+LEWRITE_CMD = re.compile(r'AT\+LEWRITE=0x10,0x([0-9A-Fa-f]{4}),([0-9A-Fa-f]+)$')
+LEREAD_CMD = re.compile(r'AT\+LEREAD=0x10,0x([0-9A-Fa-f]{4})$')
+SETTING_CMD = re.compile(r'AT\+(\w+)=(.*)$')
+QUERY_CMD = re.compile(r'AT\+(\w+)\?$')
+UARTBAUD_CMD = re.compile(r'AT\+UARTBAUD=(\d+)$')
+UART_BAUDS = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600)
+
+
+class EmulatedBait :
+    def __init__(self, addr, name=None, rssi=-60, bonded=False, battery=3600) :
+        self.addr = addr if "," in addr else addr + ",t2"
+        self.name = name or "ISCA TC-P2 %s" % self.addr[8:12]
+        self.rssi = rssi
+        self.bonded = bonded
+        self.attrs = {BATTERY_ADDR: battery, TID_ADDR: 0, OP_MODE_CTRL_ADDR: 0, OP_MODE_VAL_ADDR: 0,
+                      STAT_SLEEP_TIME_ADDR: 60, STAT_WAIT_TIME_ADDR: 10,
+                      DYN_SLEEP_TIME_ADDR: 30, DYN_WAIT_TIME_ADDR: 10}
+        # Start of the current sleep/wait cycle, None while the bait never sleeps
+        self.anchor = None
+        self.ota = None
+        self.firmware = None
+
+    @property
+    def bd_addr(self) :
+        return self.addr.split(",")[0]
+
+    def period(self) :
+        if self.attrs[OP_MODE_CTRL_ADDR] == 2 :
+            return self.attrs[DYN_SLEEP_TIME_ADDR], self.attrs[DYN_WAIT_TIME_ADDR]
+        return self.attrs[STAT_SLEEP_TIME_ADDR], self.attrs[STAT_WAIT_TIME_ADDR]
+
+    def next_wake(self, now) :
+        # Returns (wake, window_end) for the awake window that contains or follows now
+        if self.anchor == None :
+            return now, None
+        sleep_time, wait_time = self.period()
+        cycle = sleep_time + wait_time
+        start = self.anchor + ((now - self.anchor) // cycle) * cycle
+        wake = start + sleep_time
+        return max(now, wake), wake + wait_time
+
+    def sleep(self, now) :
+        if self.attrs[OP_MODE_CTRL_ADDR] :
+            self.anchor = now
+
+
+class CbEmulator :
+    def __init__(self, latency=0.01, jitter=0.0, drop=0.0, corrupt=0.0, scan_time=0.5,
+                 connect_timeout=5.0, bond_time=1.0, reset_time=0.5, noise=0, pin="123456", seed=None,
+                 max_baud=921600, wire_baud=None, baud_revert=2.0) :
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.corrupt = corrupt
+        self.scan_time = scan_time
+        self.connect_timeout = connect_timeout
+        self.bond_time = bond_time
+        self.reset_time = reset_time
+        self.noise = noise
+        self.pin = pin
+        self.random = random.Random(seed)
+        # The pty has no baud rate: max_baud is what the firmware accepts, above wire_baud
+        # the link "garbles" (frames are lost) until the bridge reverts after baud_revert
+        self.max_baud = max_baud
+        self.wire_baud = wire_baud
+        self.baud_revert = baud_revert
+        self.baud = 115200
+        self.pending_baud = None
+        self.garbled_until = None
+        self.own_addr = "0080254800A1"
+        self.baits = {}
+        self.connected = None
+        self.link = 0
+        self.pairing = None
+        self.scanning = None
+        self.settings = {'LETIO': '0', 'BIOCAP': '0', 'BMITM': '0', 'LECONINTMIN': '24',
+                         'LECONINTMAX': '40', 'LEROLE': '0'}
+        self.stored = dict(self.settings)
+        self.outbox = ""
+        self.read_len = 0
+        self.events = []
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.master = None
+        self.slave = None
+        self.port = None
+
+    def add_bait(self, addr, **kwargs) :
+        bait = EmulatedBait(addr, **kwargs)
+        self.baits[bait.addr] = bait
+        return bait
+
+    def open(self) :
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        return self.port
+
+    def start(self) :
+        if not self.port :
+            self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="cb-emulator", daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self) :
+        self.running = False
+        if self.thread :
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave) :
+            if fd != None :
+                os.close(fd)
+        self.master = self.slave = self.port = None
+
+    def serve(self) :
+        buf = b''
+        while self.running :
+            with self.lock :
+                due = self.events[0][0] if self.events else None
+            timeout = 0.1 if due == None else min(0.1, max(0, due - monotonic()))
+            ready, _, _ = select.select([self.master], [], [], timeout)
+            if ready :
+                try :
+                    buf += os.read(self.master, 4096)
+                except OSError :
+                    break
+                while b'\n' in buf :
+                    line, buf = buf.split(b'\n', 1)
+                    self.handle_frame(line.decode('ascii', 'replace').strip())
+            self.run_events()
+
+    # Bridge framing
+
+    def handle_frame(self, line) :
+        with self.lock :
+            if self.garbled_until != None :
+                if monotonic() < self.garbled_until :
+                    return
+                # No valid frame at the new rate: the bridge falls back to the previous one
+                self.baud, self.garbled_until = self.previous_baud, None
+            if line == "b r" :
+                payload = self.outbox
+                self.read_len = len(payload)
+                crc = binascii.crc_hqx(payload.encode('ascii'), 0xFFFF)
+                if payload and self.random.random() < self.corrupt :
+                    crc ^= 0x5A5A
+                os.write(self.master, ('\r\nbro "%s" %04X\r\n' % (payload, crc)).encode('ascii'))
+            elif line == "b a" :
+                self.outbox = self.outbox[self.read_len:]
+                if self.pending_baud and self.read_len :
+                    # The OK of AT+UARTBAUD was delivered and acked: switch now
+                    self.switch_baud(self.pending_baud)
+                self.read_len = 0
+            else :
+                match = WRITE_FRAME.match(line)
+                if match and binascii.crc_hqx(match.group(1).encode('ascii'), 0xFFFF) == int(match.group(2), 16) :
+                    self.handle_command(match.group(1))
+
+    def emit(self, text) :
+        self.outbox += "\r\n" + text + "\r\n"
+
+    def later(self, delay, action, *args) :
+        heapq.heappush(self.events, (monotonic() + delay, next(self.seq), action, args))
+
+    def reply(self, *lines, delay=0) :
+        delay += self.latency + self.random.uniform(0, self.jitter)
+        for line in lines :
+            self.later(delay, self.emit, line)
+
+    def run_events(self) :
+        with self.lock :
+            now = monotonic()
+            while self.events and self.events[0][0] <= now :
+                _, _, action, args = heapq.heappop(self.events)
+                action(*args)
+
+    # AT command set
+
+    def switch_baud(self, baud) :
+        self.previous_baud, self.baud, self.pending_baud = self.baud, baud, None
+        if self.wire_baud and baud > self.wire_baud :
+            self.garbled_until = monotonic() + self.baud_revert
+
+    def handle_command(self, cmd) :
+        if cmd == "AT" :
+            self.reply("OK")
+        elif UARTBAUD_CMD.match(cmd) :
+            baud = int(UARTBAUD_CMD.match(cmd).group(1))
+            if baud in UART_BAUDS and baud <= self.max_baud :
+                self.pending_baud = baud
+                self.reply("OK")
+            else :
+                self.reply("ERROR")
+        elif cmd == "AT+LESCAN=GATT" :
+            self.scan()
+        elif cmd == "AT+LESCAN=STOP" :
+            self.stop_scan()
+        elif cmd.startswith("ATD") and cmd.endswith(",GATT") :
+            self.dial(cmd[3:-5])
+        elif cmd.startswith("ATH") :
+            if self.connected :
+                self.hangup()
+                self.reply("OK", "NO CARRIER")
+            else :
+                self.reply("OK")
+        elif cmd == "AT+BNDLIST" :
+            bonded = [b.bd_addr for b in self.baits.values() if b.bonded]
+            self.reply(*(bonded + ["OK"]))
+        elif cmd.startswith("AT+BSSPPIN ") :
+            self.reply("OK")
+            if self.pairing :
+                bond = self.bonded if cmd.endswith("," + self.pin) else self.bond_failed
+                self.later(self.bond_time, bond, self.pairing)
+        elif cmd == "AT+BOAD" :
+            self.reply(self.own_addr, "OK")
+        elif cmd == "AT&W" :
+            self.stored = dict(self.settings)
+            self.reply("OK")
+        elif cmd == "AT+RESET" :
+            self.reply("OK")
+            self.later(self.reset_time, self.reset)
+        elif LEWRITE_CMD.match(cmd) :
+            match = LEWRITE_CMD.match(cmd)
+            self.gatt_write(int(match.group(1), 16), match.group(2))
+        elif LEREAD_CMD.match(cmd) :
+            self.gatt_read(int(LEREAD_CMD.match(cmd).group(1), 16))
+        elif QUERY_CMD.match(cmd) and QUERY_CMD.match(cmd).group(1) in self.settings :
+            self.reply(self.settings[QUERY_CMD.match(cmd).group(1)], "OK")
+        elif SETTING_CMD.match(cmd) :
+            name, value = SETTING_CMD.match(cmd).groups()
+            self.settings[name] = value
+            self.reply("OK")
+        else :
+            self.reply("ERROR")
+
+    def scan(self) :
+        now = monotonic()
+        found = [b for b in self.baits.values() if b.next_wake(now)[0] <= now + self.scan_time]
+        lines = []
+        for i in range(self.noise) :
+            lines.append("%012X,t1 %d \"Device %d\"" % (self.random.getrandbits(48), self.random.randint(-95, -50), i))
+        for bait in found :
+            lines.append("%s %d \"%s\"" % (bait.addr, bait.rssi, bait.name))
+        self.random.shuffle(lines)
+        scan = self.scanning = next(self.seq)
+        for i, line in enumerate(lines) :
+            self.later(self.scan_time * (i + 1) / (len(lines) + 1), self.scan_output, scan, line)
+        self.later(self.scan_time, self.scan_output, scan, "OK")
+
+    def scan_output(self, scan, line) :
+        # Output of a stopped scan never shows up
+        if scan == self.scanning :
+            self.emit(line)
+            if line == "OK" :
+                self.scanning = None
+
+    def stop_scan(self) :
+        if self.scanning == None :
+            self.reply("ERROR")
+            return
+        self.scanning = None
+        self.emit("OK")
+        self.reply("OK")
+
+    def dial(self, addr) :
+        bait = self.baits.get(addr)
+        now = monotonic()
+        if self.connected or not bait :
+            self.reply("NO CARRIER", delay=0 if self.connected else self.connect_timeout)
+            return
+        wake, _ = bait.next_wake(now)
+        if wake - now > self.connect_timeout or self.random.random() < self.drop :
+            self.reply("NO CARRIER", delay=self.connect_timeout)
+            return
+        self.connected = "pending"
+        self.later(wake - now + self.latency + self.random.uniform(0, self.jitter), self.link_up, bait)
+
+    def link_up(self, bait) :
+        if self.connected != "pending" :
+            return
+        self.connected = bait
+        self.link += 1
+        self.emit("CONNECT 0x10")
+        _, window_end = bait.next_wake(monotonic())
+        if window_end != None :
+            # The bait goes back to sleep at the end of its wait window unless a TID arrives
+            self.later(window_end - monotonic(), self.window_closed, self.link)
+
+    def window_closed(self, link) :
+        if self.connected and link == self.link :
+            self.hangup()
+            self.emit("NO CARRIER")
+
+    def hangup(self) :
+        self.connected = None
+        self.link += 1
+
+    def gatt_write(self, handle, value) :
+        bait = self.connected
+        if not isinstance(bait, EmulatedBait) :
+            self.reply("ERROR")
+            return
+        if handle in (OTA_CTRL_ADDR, OTA_DATA_ADDR) :
+            self.reply("OK" if self.ota_write(bait, handle, value) else "ERROR")
+            return
+        bait.attrs[handle] = int(value, 16)
+        self.reply("OK")
+        if handle == TID_ADDR and bait.attrs[OP_MODE_CTRL_ADDR] :
+            bait.sleep(monotonic())
+            self.hangup()
+            self.reply("NO CARRIER", delay=self.latency)
+
+    def gatt_read(self, handle) :
+        bait = self.connected
+        if not isinstance(bait, EmulatedBait) :
+            self.reply("ERROR")
+            return
+        if handle >= STAT_SLEEP_TIME_ADDR and not bait.bonded :
+            # Protected attribute: the extender asks for the passkey before reading
+            self.pairing = bait
+            self.reply("SSPPIN %s ?" % bait.addr)
+            return
+        if handle == OTA_STATUS_ADDR :
+            self.reply("LEREAD:0x10,0x%04X,%08X" % (handle, len(bait.ota['image']) if bait.ota else 0), "OK")
+            return
+        self.reply("LEREAD:0x10,0x%04X,%04X" % (handle, bait.attrs.get(handle, 0)), "OK")
+
+    def ota_write(self, bait, handle, value) :
+        # Bootloader side of the OTA service: blocks only land in the image once their CRC matches
+        ota = bait.ota
+        if handle == OTA_DATA_ADDR :
+            if not ota or int(value[:8], 16) != len(ota['image']) + len(ota['pending']) :
+                return False
+            ota['pending'] += bytes.fromhex(value[8:])
+            return True
+        op = value[:2]
+        if op == "01" :
+            size, crc = int(value[2:10], 16), int(value[10:18], 16)
+            if not ota or (ota['size'], ota['crc']) != (size, crc) :
+                bait.ota = {'size': size, 'crc': crc, 'image': bytearray(), 'pending': bytearray()}
+            else :
+                ota['pending'] = bytearray()
+            return True
+        if not ota :
+            return False
+        if op == "02" :
+            offset, length, crc = int(value[2:10], 16), int(value[10:14], 16), int(value[14:18], 16)
+            pending = ota['pending']
+            ota['pending'] = bytearray()
+            if offset != len(ota['image']) or length != len(pending) or binascii.crc_hqx(pending, 0xFFFF) != crc :
+                return False
+            ota['image'] += pending
+            return True
+        if op == "03" :
+            if len(ota['image']) != ota['size'] or binascii.crc32(ota['image']) != ota['crc'] :
+                return False
+            bait.firmware = bytes(ota['image'])
+            bait.ota = None
+            return True
+        return False
+
+    def bonded(self, bait) :
+        bait.bonded = True
+        self.pairing = None
+        self.emit("BNDSUCCESS %s" % bait.addr)
+        self.emit("LEREAD:0x10,0x%04X,%04X" % (STAT_WAIT_TIME_ADDR, bait.attrs[STAT_WAIT_TIME_ADDR]))
+        self.emit("OK")
+
+    def bond_failed(self, bait) :
+        self.pairing = None
+        self.emit("BNDFAIL %s" % bait.addr)
+        self.emit("ERROR")
+
+    def reset(self) :
+        self.hangup()
+        self.settings = dict(self.stored)
+        self.emit(READY_BANNER)
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Emulated CB extender and baits on a pseudo-terminal')
+    parser.add_argument('-a', '--bait', type=str, action='append', default=[],
+                        help='Bait address (e.g. 001EC0A1B2C3,t2), may be repeated')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Base delay of every AT reply in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Uniform extra delay added to each reply in seconds')
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help='Probability that a connect to an awake bait fails')
+    parser.add_argument('--corrupt', type=float, default=0.0,
+                        help='Probability that a bridge frame goes out with a bad CRC')
+    parser.add_argument('--scan-time', type=float, default=0.5)
+    parser.add_argument('--noise', type=int, default=0,
+                        help='Non-bait devices reported by each scan')
+    parser.add_argument('--bonded', type=int, default=0,
+                        help='Start with every bait already bonded')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-baud', type=int, default=921600,
+                        help='Fastest UART rate AT+UARTBAUD accepts')
+    parser.add_argument('--wire-baud', type=int, default=None,
+                        help='Fastest rate that works on the wire, above it frames are lost until the bridge reverts')
+    args = parser.parse_args(sys.argv[1:])
+
+    emulator = CbEmulator(latency=args.latency, jitter=args.jitter, drop=args.drop, corrupt=args.corrupt,
+                          scan_time=args.scan_time, noise=args.noise, seed=args.seed, max_baud=args.max_baud,
+                          wire_baud=args.wire_baud)
+    for addr in args.bait or ["001EC0A1B2C3,t2"] :
+        emulator.add_bait(addr, bonded=bool(args.bonded))
+    port = emulator.start()
+    print("[EMULATOR][X]: %s" % port)
+    try :
+        while True :
+            sleep(1)
+    except KeyboardInterrupt :
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
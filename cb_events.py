@@ -0,0 +1,159 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+from collections import deque
+from time import time
+
+from cb_state import STATE_DIR
+
+CMD = 'cmd'
+REPLY = 'reply'
+STATE = 'state'
+LOST = 'lost'
+RECOVERED = 'recovered'
+RING_SIZE = 8192
+FLUSH_INTERVAL = 0.5
+CRASH_DUMP_PATH = os.path.join(STATE_DIR, "crash_events.jsonl")
+
+
+def text(value) :
+    if isinstance(value, (bytes, bytearray)) :
+        return bytes(value).decode('ascii', 'replace')
+    return value
+
+
+def to_record(event) :
+    seq, t, kind, fields = event
+    record = {'seq': seq, 't': t, 'event': kind}
+    for key, value in fields.items() :
+        record[key] = text(value)
+    return record
+
+
+def console_line(event) :
+    seq, t, kind, fields = event
+    if kind == CMD :
+        return "Enviando \"%s\"" % text(fields.get('data', '')).rstrip("\r\n")
+    if kind == REPLY :
+        return "Resposta do comando: \"%s\"" % text(fields.get('data', ''))
+    return "[%s] %s" % (kind.upper(), " ".join("%s=%s" % (k, text(v)) for k, v in fields.items()))
+
+
+class EventLog :
+    # Bounded ring of (seq, timestamp, kind, fields). emit() only appends to the ring, so the
+    # caller never waits on a file or the console; a writer thread formats and writes batches.
+    # A writer that falls behind loses the oldest events, counted in `dropped`.
+    def __init__(self, path=None, console=False, size=RING_SIZE, interval=FLUSH_INTERVAL) :
+        self.ring = deque(maxlen=size)
+        self.seq = itertools.count()
+        self.written = -1
+        self.dropped = 0
+        self.path = path
+        self.console = console
+        self.interval = interval
+        self.file = open(path, 'a') if path else None
+        # Serializes drains between the writer, flush() and close()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        if self.file or self.console :
+            self.thread = threading.Thread(target=self.writer_loop, name="event-writer", daemon=True)
+            self.thread.start()
+
+    def emit(self, kind, **fields) :
+        self.ring.append((next(self.seq), time(), kind, fields))
+
+    def pending(self) :
+        # Events are appended with consecutive seq numbers, the unwritten ones are the tail
+        events = list(self.ring)
+        if not events or events[-1][0] <= self.written :
+            return []
+        start = max(0, len(events) - (events[-1][0] - self.written))
+        if events[start][0] > self.written + 1 :
+            self.dropped += events[start][0] - self.written - 1
+        self.written = events[-1][0]
+        return events[start:]
+
+    def flush(self) :
+        with self.lock :
+            batch = self.pending()
+            if not batch :
+                return 0
+            if self.file :
+                self.file.write("".join(json.dumps(to_record(e)) + "\n" for e in batch))
+                self.file.flush()
+            if self.console :
+                sys.stdout.write("".join(console_line(e) + "\n" for e in batch))
+                sys.stdout.flush()
+            return len(batch)
+
+    def writer_loop(self) :
+        while not self.stop_event.wait(self.interval) :
+            self.flush()
+
+    def dump(self, path) :
+        # Whole ring, written or not: the last moments before a crash
+        directory = os.path.dirname(path)
+        if directory :
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f :
+            for event in list(self.ring) :
+                f.write(json.dumps(to_record(event)) + "\n")
+        return path
+
+    def install_crash_dump(self, path=CRASH_DUMP_PATH) :
+        # Uncaught exceptions, in the main thread or any other, dump the ring before the traceback
+        previous = sys.excepthook
+        previous_thread = threading.excepthook
+
+        def on_crash(exc_type, exc, tb) :
+            if not issubclass(exc_type, KeyboardInterrupt) :
+                self.emit('crash', error="%s: %s" % (exc_type.__name__, exc))
+                print("[EVENTS][ ] : eventos salvos em %s" % self.dump(path), file=sys.stderr)
+            previous(exc_type, exc, tb)
+
+        def on_thread_crash(args) :
+            self.emit('crash', error="%s: %s" % (args.exc_type.__name__, args.exc_value),
+                      thread=args.thread.name if args.thread else None)
+            print("[EVENTS][ ] : eventos salvos em %s" % self.dump(path), file=sys.stderr)
+            previous_thread(args)
+
+        sys.excepthook = on_crash
+        threading.excepthook = on_thread_crash
+
+    def close(self) :
+        if self.thread :
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.file :
+            self.file.close()
+            self.file = None
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Print an event log written with simulate_cb.py --events')
+    parser.add_argument('log', type=str)
+    parser.add_argument('-k', '--kind', type=str, default=None,
+                        help='Comma separated event kinds to show (cmd, reply, state, lost, recovered, crash)')
+    args = parser.parse_args(sys.argv[1:])
+
+    kinds = set(args.kind.split(",")) if args.kind else None
+    first = None
+    with open(args.log) as f :
+        for line in f :
+            record = json.loads(line)
+            if kinds and record['event'] not in kinds :
+                continue
+            if first == None :
+                first = record['t']
+            fields = dict((k, v) for k, v in record.items() if k not in ('seq', 't', 'event'))
+            print("%10.4f %-9s %s" % (record['t'] - first, record['event'], json.dumps(fields)))
+
+
+if __name__ == "__main__":
+    main()
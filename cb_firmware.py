@@ -0,0 +1,265 @@
+import argparse
+import binascii
+import hashlib
+import struct
+import sys
+
+try :
+    import numpy
+except ImportError :
+    numpy = None
+
+DATA = 0x00
+EOF = 0x01
+EXT_SEGMENT = 0x02
+START_SEGMENT = 0x03
+EXT_LINEAR = 0x04
+START_LINEAR = 0x05
+
+VECTOR_COUNT = 16
+DIFF_BLOCK = 256
+FILL = 0xFF
+
+
+class HexError(ValueError) :
+    pass
+
+
+def record_checksums(data, starts, ends, vectorized=True) :
+    # Sum of every record including its checksum byte, mod 256; all of them must be zero.
+    # reduceat accumulates uint8 in a wider type, so the sums are wrapped by hand.
+    if vectorized and numpy != None and len(starts) :
+        sums = numpy.add.reduceat(numpy.frombuffer(data, dtype=numpy.uint8), starts)
+        return [int(i) for i in numpy.flatnonzero(sums & 0xFF)]
+    return [i for i, (start, end) in enumerate(zip(starts, ends)) if sum(data[start:end]) & 0xFF]
+
+
+def split_records(text, path=None) :
+    # All records decoded into one buffer, with each record's [start, end) in it
+    lines = text.split()
+    for n, line in enumerate(lines) :
+        if line[:1] != ":" or len(line) % 2 == 0 or len(line) < 11 :
+            raise HexError("%s:%d: malformed record" % (path, n + 1))
+    try :
+        data = bytes.fromhex("".join(line[1:] for line in lines))
+    except ValueError :
+        raise HexError("%s: invalid hex digits" % path)
+
+    starts = []
+    ends = []
+    pos = 0
+    for n, line in enumerate(lines) :
+        size = (len(line) - 1) // 2
+        if data[pos] + 5 != size :
+            raise HexError("%s:%d: length byte does not match the record" % (path, n + 1))
+        starts.append(pos)
+        pos += size
+        ends.append(pos)
+    return data, starts, ends
+
+
+class FirmwareImage :
+    # Sparse image: sorted, non-adjacent [start, bytearray] segments
+    def __init__(self, segments=None, start_linear=None, start_segment=None, path=None) :
+        self.segments = segments or []
+        self.start_linear = start_linear
+        self.start_segment = start_segment
+        self.path = path
+
+    @classmethod
+    def load(cls, path) :
+        with open(path) as f :
+            return cls.parse(f.read(), path)
+
+    @classmethod
+    def parse(cls, text, path=None) :
+        data, starts, ends = split_records(text, path)
+        bad = record_checksums(data, starts, ends)
+        if bad :
+            raise HexError("%s:%d: checksum mismatch (%d bad records)" % (path, bad[0] + 1, len(bad)))
+
+        image = cls(path=path)
+        view = memoryview(data)
+        base = 0
+        chunks = []
+        seen_eof = False
+        for n, start in enumerate(starts) :
+            length, offset, rtype = data[start], (data[start + 1] << 8) | data[start + 2], data[start + 3]
+            payload = view[start + 4:start + 4 + length]
+            if seen_eof :
+                raise HexError("%s:%d: record after end of file" % (path, n + 1))
+            if rtype == DATA :
+                chunks.append((base + offset, payload))
+            elif rtype == EOF :
+                seen_eof = True
+            elif rtype == EXT_LINEAR and length == 2 :
+                base = ((payload[0] << 8) | payload[1]) << 16
+            elif rtype == EXT_SEGMENT and length == 2 :
+                base = ((payload[0] << 8) | payload[1]) << 4
+            elif rtype == START_LINEAR and length == 4 :
+                image.start_linear = struct.unpack(">I", payload)[0]
+            elif rtype == START_SEGMENT and length == 4 :
+                image.start_segment = struct.unpack(">HH", payload)
+            else :
+                raise HexError("%s:%d: unsupported record type %02X" % (path, n + 1, rtype))
+        if not seen_eof :
+            raise HexError("%s: missing end of file record" % path)
+
+        image.build(chunks)
+        return image
+
+    def build(self, chunks) :
+        # Records are almost always in order, so this is one append per record
+        if any(b[0] < a[0] for a, b in zip(chunks, chunks[1:])) :
+            chunks = sorted(chunks, key=lambda chunk : chunk[0])
+        segments = []
+        for addr, payload in chunks :
+            if segments :
+                start, seg = segments[-1]
+                end = start + len(seg)
+                if addr == end :
+                    seg += payload
+                    continue
+                if addr < end :
+                    if addr + len(payload) > end :
+                        seg[addr - start:] = payload
+                    else :
+                        seg[addr - start:addr - start + len(payload)] = payload
+                    continue
+            segments.append([addr, bytearray(payload)])
+        self.segments = segments
+
+    def ranges(self) :
+        return [(start, start + len(seg)) for start, seg in self.segments]
+
+    @property
+    def size(self) :
+        return sum(len(seg) for _, seg in self.segments)
+
+    @property
+    def base(self) :
+        return self.segments[0][0] if self.segments else 0
+
+    def read(self, addr, length) :
+        # Bytes outside every segment read as erased flash
+        out = bytearray([FILL]) * length
+        end = addr + length
+        for start, seg in self.segments :
+            seg_end = start + len(seg)
+            if seg_end <= addr or start >= end :
+                continue
+            lo = max(addr, start)
+            hi = min(end, seg_end)
+            out[lo - addr:hi - addr] = memoryview(seg)[lo - start:hi - start]
+        return bytes(out)
+
+    def vector_table(self, count=VECTOR_COUNT) :
+        # Cortex-M layout at the image base: initial stack pointer, then the exception handlers
+        return list(struct.unpack("<%dI" % count, self.read(self.base, 4 * count)))
+
+    @property
+    def reset_handler(self) :
+        return self.vector_table(2)[1] & ~1
+
+    def crc32(self) :
+        crc = 0
+        for _, seg in self.segments :
+            crc = binascii.crc32(seg, crc)
+        return crc
+
+    def fingerprint(self) :
+        digest = hashlib.sha256()
+        for start, seg in self.segments :
+            digest.update(struct.pack("<II", start, len(seg)))
+            digest.update(seg)
+        return digest.hexdigest()
+
+    def diff(self, other, block=DIFF_BLOCK) :
+        # Changed block-aligned ranges [(start, end)], adjacent blocks merged into one delta
+        spans = sorted(self.ranges() + other.ranges())
+        blocks = []
+        for start, end in spans :
+            addr = start - start % block
+            if blocks and addr < blocks[-1] + block :
+                addr = blocks[-1] + block
+            while addr < end :
+                blocks.append(addr)
+                addr += block
+
+        changed = []
+        for addr in blocks :
+            if self.read(addr, block) != other.read(addr, block) :
+                if changed and changed[-1][1] == addr :
+                    changed[-1][1] = addr + block
+                else :
+                    changed.append([addr, addr + block])
+        return [tuple(span) for span in changed]
+
+    def info(self) :
+        vectors = self.vector_table()
+        return {'path': self.path,
+                'size': self.size,
+                'segments': [[start, end] for start, end in self.ranges()],
+                'initial_sp': vectors[0],
+                'reset_handler': vectors[1] & ~1,
+                'vectors': vectors,
+                'start_linear': self.start_linear,
+                'crc32': self.crc32(),
+                'sha256': self.fingerprint()}
+
+
+def show_info(image) :
+    info = image.info()
+    print("[FIRMWARE][X] : %s" % info['path'])
+    print("  size          %d bytes" % info['size'])
+    for start, end in info['segments'] :
+        print("  segment       0x%08X-0x%08X (%d bytes)" % (start, end, end - start))
+    print("  initial SP    0x%08X" % info['initial_sp'])
+    print("  reset handler 0x%08X" % info['reset_handler'])
+    if info['start_linear'] != None :
+        print("  entry point   0x%08X" % info['start_linear'])
+    for n, vector in enumerate(info['vectors'][2:], 2) :
+        print("  vector %-6d 0x%08X" % (n, vector))
+    print("  crc32         %08X" % info['crc32'])
+    print("  sha256        %s" % info['sha256'])
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Intel HEX firmware images of the tracker and the baits')
+    sub = parser.add_subparsers(dest='command')
+    info = sub.add_parser('info', help='Validate images and show their vector table')
+    info.add_argument('images', nargs='+')
+    info.add_argument('--expect', type=str, default=None,
+                      help='Fail unless the image sha256 starts with this prefix')
+    diff = sub.add_parser('diff', help='Block-level delta between two images')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('--block', type=int, default=DIFF_BLOCK)
+    args = parser.parse_args(sys.argv[1:])
+
+    try :
+        if args.command == 'info' :
+            for path in args.images :
+                image = FirmwareImage.load(path)
+                show_info(image)
+                if args.expect and not image.fingerprint().startswith(args.expect.lower()) :
+                    print("[FIRMWARE][ ] : %s is not the expected build" % path)
+                    return 1
+        elif args.command == 'diff' :
+            old = FirmwareImage.load(args.old)
+            new = FirmwareImage.load(args.new)
+            changed = old.diff(new, args.block)
+            total = sum(end - start for start, end in changed)
+            for start, end in changed :
+                print("0x%08X-0x%08X %d bytes" % (start, end, end - start))
+            print("%d ranges, %d bytes to send (new image %d bytes)" % (len(changed), total, new.size))
+        else :
+            parser.print_help()
+    except (OSError, HexError) as e :
+        print("[FIRMWARE][ ] : %s" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
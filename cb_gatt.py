@@ -0,0 +1,102 @@
+import re
+
+LEREAD_PAT = re.compile(r"LEREAD:0x10,0x([0-9A-Fa-f]{4}),([0-9A-Fa-f]+)")
+
+
+class Attribute :
+    # One characteristic of the bait's GATT service.
+    # control: writing triggers an action on the bait, never skipped and never mirrored
+    # protected: reading asks for the passkey, only read once the bait is bonded
+    # mode: the bait derives its value from the operating mode, stale after a mode change
+    __slots__ = ('name', 'handle', 'digits', 'writable', 'protected', 'control', 'mode')
+
+    def __init__(self, name, handle, digits=4, writable=True, protected=False, control=False, mode=False) :
+        self.name = name
+        self.handle = handle
+        self.digits = digits
+        self.writable = writable
+        self.protected = protected
+        self.control = control
+        self.mode = mode
+
+    @property
+    def number(self) :
+        return int(self.handle, 16)
+
+    def encode(self, value) :
+        return "%0*x" % (self.digits, value)
+
+    def read_cmd(self) :
+        return 'AT+LEREAD=0x10,' + self.handle
+
+    def write_cmd(self, value) :
+        return 'AT+LEWRITE=0x10,' + self.handle + "," + self.encode(value)
+
+
+ATTRIBUTES = (Attribute('battery', '0x0023', writable=False),
+              Attribute('tid', '0x0026', control=True),
+              Attribute('op_mode_ctrl', '0x0029', digits=2, control=True),
+              Attribute('op_mode_val', '0x002C', writable=False, mode=True),
+              Attribute('static_sleep_time', '0x0030', protected=True),
+              Attribute('static_wait_time', '0x0033', protected=True),
+              Attribute('dyn_sleep_time', '0x0036', protected=True),
+              Attribute('dyn_wait_time', '0x0039', protected=True))
+
+
+class AttributeMap :
+    def __init__(self, attributes=ATTRIBUTES) :
+        self.attributes = list(attributes)
+        self.by_name = dict((a.name, a) for a in self.attributes)
+        self.by_number = dict((a.number, a) for a in self.attributes)
+
+    def __getitem__(self, name) :
+        return self.by_name[name]
+
+    def __iter__(self) :
+        return iter(self.attributes)
+
+    def lookup(self, number) :
+        return self.by_number.get(number)
+
+    def readable(self, bonded=False) :
+        return [a for a in self.attributes if not a.control and (bonded or not a.protected)]
+
+
+class AttributeMirror :
+    # Host side copy of the values one bait holds, learned from its LEREAD replies and our
+    # acknowledged writes. Unknown means "ask or write it", never "assume the default".
+    def __init__(self, attributes) :
+        self.attributes = attributes
+        self.values = {}
+
+    def get(self, name) :
+        return self.values.get(name)
+
+    def update(self, name, value) :
+        if not self.attributes[name].control :
+            self.values[name] = value
+
+    def invalidate(self, names=None) :
+        if names == None :
+            self.values.clear()
+            return
+        for name in names :
+            self.values.pop(name, None)
+
+    def mode_changed(self) :
+        self.invalidate([a.name for a in self.attributes if a.mode])
+
+    def changed(self, values) :
+        # Attributes of values that must be written: control points, unknown or different ones
+        return [name for name, value in values.items()
+                if self.attributes[name].control or self.values.get(name) != value]
+
+    def feed(self, line) :
+        match = LEREAD_PAT.search(line)
+        if not match :
+            return None
+        attribute = self.attributes.lookup(int(match.group(1), 16))
+        if attribute == None or attribute.control :
+            return None
+        self.values[attribute.name] = int(match.group(2), 16)
+        return attribute.name
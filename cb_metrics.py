@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from time import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Histogram :
+    def __init__(self, buckets=DEFAULT_BUCKETS) :
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) :
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) :
+        total = 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts) :
+            total += count
+            yield le, total
+
+
+class Metrics :
+    # Counters and histograms keyed by metric name and a sorted label tuple
+    def __init__(self, buckets=DEFAULT_BUCKETS) :
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        # Dumps from several threads (SIGUSR1 bursts) would share the temporary file
+        self.dump_lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels) :
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock :
+            hist = self.histograms.get(key)
+            if hist == None :
+                hist = self.histograms[key] = Histogram(self.buckets)
+            hist.observe(value)
+
+    def snapshot(self) :
+        with self.lock :
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': hist.count, 'sum': hist.sum,
+                           'buckets': [[le if le != float('inf') else "+Inf", n] for le, n in hist.cumulative()]}
+                          for (name, labels), hist in sorted(self.histograms.items())]
+        return {'timestamp': time(), 'counters': counters, 'histograms': histograms}
+
+    def merge(self, snapshot) :
+        # Adds a snapshot() taken elsewhere, e.g. in a campaign worker process
+        with self.lock :
+            for counter in snapshot['counters'] :
+                key = (counter['name'], tuple(sorted(counter['labels'].items())))
+                self.counters[key] = self.counters.get(key, 0) + counter['value']
+            for entry in snapshot['histograms'] :
+                key = (entry['name'], tuple(sorted(entry['labels'].items())))
+                hist = self.histograms.get(key)
+                if hist == None :
+                    hist = self.histograms[key] = Histogram(self.buckets)
+                previous = 0
+                for idx, (le, total) in enumerate(entry['buckets'][:len(hist.counts)]) :
+                    hist.counts[idx] += total - previous
+                    previous = total
+                hist.sum += entry['sum']
+                hist.count += entry['count']
+
+    def to_prometheus(self) :
+        lines = []
+        typed = set()
+        with self.lock :
+            for (name, labels), value in sorted(self.counters.items()) :
+                if name not in typed :
+                    lines.append("# TYPE %s counter" % name)
+                    typed.add(name)
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+            for (name, labels), hist in sorted(self.histograms.items()) :
+                if name not in typed :
+                    lines.append("# TYPE %s histogram" % name)
+                    typed.add(name)
+                for le, count in hist.cumulative() :
+                    le = "+Inf" if le == float('inf') else repr(le)
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels + (('le', le),)), count))
+                lines.append("%s_sum%s %r" % (name, format_labels(labels), hist.sum))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), hist.count))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path) :
+        # JSON for *.json, Prometheus text format otherwise; replaced atomically for textfile collectors
+        if path.endswith(".json") :
+            text = json.dumps(self.snapshot(), indent=2) + "\n"
+        else :
+            text = self.to_prometheus()
+        tmp = path + ".tmp"
+        with self.dump_lock :
+            with open(tmp, 'w') as f :
+                f.write(text)
+            os.replace(tmp, path)
+
+
+def format_labels(labels) :
+    if not labels :
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + "}"
@@ -0,0 +1,96 @@
+import argparse
+import binascii
+import sys
+import threading
+import time as clock
+
+import cb_scenario
+import simulate_cb
+from simulate_cb import UartDriver, Simulation, FrameCodec
+from cb_session import SessionLog, ReplaySerial
+from cb_state import BondCache, BaitRegistry
+from cb_scenario import parse_params
+
+
+class ReplayClock :
+    # Scaled clock installed in simulate_cb and cb_scenario, so waits for bait wakes, scenario
+    # sleeps, retry delays and state deadlines shrink with the replay speed
+    def __init__(self, speed) :
+        self.speed = speed
+        self.mono0 = clock.monotonic()
+        self.epoch0 = clock.time()
+
+    def monotonic(self) :
+        return self.mono0 + (clock.monotonic() - self.mono0) * self.speed
+
+    def time(self) :
+        return self.epoch0 + (clock.monotonic() - self.mono0) * self.speed
+
+    def sleep(self, seconds) :
+        if seconds > 0 :
+            clock.sleep(seconds / self.speed)
+
+    def install(self, module) :
+        module.monotonic = self.monotonic
+        module.time = self.time
+        module.sleep = self.sleep
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Replay a recorded UART session into the simulation')
+    parser.add_argument('log', type=str,
+                        help='Session log written with simulate_cb.py --record')
+    parser.add_argument('-m', '--mode', type=str, default="field",
+                        help='Simulation mode the session was recorded with')
+    parser.add_argument('-P', '--param', type=str, action='append', default=[],
+                        help='Scenario parameters the session was recorded with, as name=value')
+    parser.add_argument('-x', '--speed', type=float, default=1.0,
+                        help='Replay speed, e.g. 60 replays a minute of trip per second')
+    parser.add_argument('-s', '--setup', type=int, default=0)
+    parser.add_argument('-r', '--reader', type=int, default=0,
+                        help='Must match the reader mode of the recording')
+    parser.add_argument('-v', '--verbose', type=int, default=0)
+    parser.add_argument('-a', '--bait', type=str, default=None)
+    parser.add_argument('--bond-cache', type=str, default="",
+                        help='Bond cache file, empty to always ask the (recorded) extender')
+    parser.add_argument('--registry', type=str, default="")
+    args = parser.parse_args(sys.argv[1:])
+    if args.speed <= 0 :
+        parser.error("--speed must be positive")
+
+    log = SessionLog(args.log)
+    print("[REPLAY][ ] : %s, %d records, %.1fs at %gx" % (args.log, len(log), log.duration, args.speed))
+    codec = FrameCodec()
+    empty = b'\r\nbro "" %04X\r\n' % binascii.crc_hqx(b'', 0xFFFF)
+    link = ReplaySerial(log, speed=args.speed, idle=(codec.encode('r'), codec.encode('a')), quiet=(empty,))
+    if args.speed != 1 :
+        replay_clock = ReplayClock(args.speed)
+        replay_clock.install(simulate_cb)
+        replay_clock.install(cb_scenario)
+
+    uart = UartDriver(port=args.log, verbose=args.verbose, reader=args.reader, link=link)
+    sim = Simulation(uart=uart, mode=args.mode, setup=args.setup, target=args.bait, params=parse_params(args.param),
+                     bonds=BondCache(args.bond_cache) if args.bond_cache else None,
+                     registry=BaitRegistry(args.registry) if args.registry else None)
+
+    start = clock.monotonic()
+    runner = threading.Thread(target=sim.run, name="replay", daemon=True)
+    runner.start()
+    # The simulation never ends on its own in most modes: the replay is over with the log
+    while runner.is_alive() and not link.finished.wait(0.1) :
+        pass
+    runner.join(1)
+    elapsed = clock.monotonic() - start
+    if link.diverged != None :
+        print("[REPLAY][ ] : host diverged from the recording at %.3fs" % link.diverged)
+    print("[REPLAY][X] : %.1fs of session in %.1fs, %d writes" % (log.duration, elapsed, link.writes))
+    uart.stop_reader()
+    uart.events.close()
+    if sim.bonds :
+        sim.bonds.flush()
+    log.close()
+    return 1 if link.mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+import json
+import os
+from time import monotonic
+from time import sleep
+
+try :
+    import yaml
+except ImportError :
+    yaml = None
+
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenarios")
+END = 'end'
+FAIL = 'fail'
+RETRY_DELAY = 1
+# Longest a sleep goes without looking at a stop request
+STOP_POLL = 0.5
+
+
+class ScenarioError(ValueError) :
+    pass
+
+
+def parse_bool(value) :
+    if isinstance(value, str) :
+        return value.strip().lower() in ('1', 'true', 'yes', 'sim', 'on')
+    return bool(value)
+
+
+TYPES = {'int': int, 'float': float, 'str': str, 'bool': parse_bool}
+
+
+def scenario_path(name) :
+    # A file path, or the name of one of the bundled scenarios
+    if os.path.exists(name) :
+        return name
+    for ext in ('.json', '.yaml', '.yml') :
+        path = os.path.join(SCENARIO_DIR, name + ext)
+        if os.path.exists(path) :
+            return path
+    return None
+
+
+def available_scenarios() :
+    if not os.path.isdir(SCENARIO_DIR) :
+        return []
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(SCENARIO_DIR) if f.endswith(('.json', '.yaml', '.yml')))
+
+
+def load_scenario(name) :
+    path = scenario_path(name)
+    if path == None :
+        raise ScenarioError("scenario %s not found" % name)
+    with open(path) as f :
+        if path.endswith(('.yaml', '.yml')) :
+            if yaml == None :
+                raise ScenarioError("%s: PyYAML is required for YAML scenarios" % path)
+            spec = yaml.safe_load(f)
+        else :
+            spec = json.load(f)
+    if not isinstance(spec, dict) :
+        raise ScenarioError("%s: a scenario is a mapping" % path)
+    spec.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    return spec
+
+
+def parse_params(items) :
+    # ["name=value", ...] from the command line
+    values = {}
+    for item in items or [] :
+        name, sep, value = item.partition("=")
+        if not sep :
+            raise ScenarioError("parameter %s has no value (name=value)" % item)
+        values[name.strip()] = value
+    return values
+
+
+class Param :
+    __slots__ = ('name', 'type', 'default', 'help')
+
+    def __init__(self, name, spec) :
+        if not isinstance(spec, dict) :
+            spec = {'type': type(spec).__name__, 'default': spec}
+        self.name = name
+        self.type = spec.get('type', 'str')
+        if self.type not in TYPES :
+            raise ScenarioError("parameter %s has unknown type %s" % (name, self.type))
+        self.default = spec.get('default')
+        self.help = spec.get('help', "")
+
+    def convert(self, value) :
+        try :
+            return TYPES[self.type](value)
+        except (TypeError, ValueError) :
+            raise ScenarioError("parameter %s expects %s, got %r" % (self.name, self.type, value))
+
+
+class State :
+    __slots__ = ('name', 'action', 'args', 'timeout', 'attempts', 'delay', 'backoff', 'on')
+
+    def __init__(self, name, spec) :
+        self.name = name
+        self.action = spec.get('action')
+        self.args = spec.get('args', {})
+        self.timeout = spec.get('timeout')
+        retry = spec.get('retry', {})
+        self.attempts = retry.get('attempts', 1)
+        self.delay = retry.get('delay', RETRY_DELAY)
+        self.backoff = retry.get('backoff', 1)
+        self.on = dict(spec.get('on', {}))
+        if 'next' in spec :
+            self.on.setdefault('ok', spec['next'])
+
+
+class StateMachine :
+    # Compiled scenario: every state runs one action and moves on the event it produced.
+    # Events are ok, done, error (or the outcome label, e.g. ISCA_LOST), disconnect and timeout.
+    def __init__(self, spec, actions, outcomes=None, disconnect=(), metrics=None) :
+        self.name = spec.get('name', "scenario")
+        self.actions = {'count': self.count, 'sleep': self.pause, 'log': self.log}
+        self.actions.update(actions)
+        self.outcomes = outcomes or {}
+        self.disconnect = tuple(disconnect)
+        self.metrics = metrics
+        self.params = dict((name, Param(name, p)) for name, p in spec.get('params', {}).items())
+        self.states = dict((name, State(name, s)) for name, s in spec.get('states', {}).items())
+        self.initial = spec.get('initial')
+        self.stop_state = spec.get('stop')
+        # Scenario wide transitions, used when a state does not handle the event itself
+        self.on = spec.get('on', {})
+        self.stopping = False
+        self.current = None
+        # Monotonic deadline of the running state's timeout, blocking actions give up there
+        self.deadline = None
+        self.counters = {}
+        self.values = {}
+        self.compile()
+
+    def compile(self) :
+        if self.initial not in self.states :
+            raise ScenarioError("%s: initial state %s is not defined" % (self.name, self.initial))
+        targets = [self.stop_state] if self.stop_state else []
+        targets += list(self.on.values())
+        for state in self.states.values() :
+            if state.action not in self.actions :
+                raise ScenarioError("%s: state %s uses unknown action %s" % (self.name, state.name, state.action))
+            if 'ok' not in state.on and 'done' not in state.on :
+                raise ScenarioError("%s: state %s has no ok/next transition" % (self.name, state.name))
+            for value in state.args.values() :
+                if isinstance(value, str) and value.startswith("$") and value[1:] not in self.params :
+                    raise ScenarioError("%s: state %s uses undeclared parameter %s" % (self.name, state.name, value))
+            targets += list(state.on.values())
+        for target in targets :
+            if target not in self.states and target not in (END, FAIL) :
+                raise ScenarioError("%s: transition to undefined state %s" % (self.name, target))
+
+    def bind(self, values) :
+        unknown = set(values) - set(self.params)
+        if unknown :
+            raise ScenarioError("%s: unknown parameters %s" % (self.name, ", ".join(sorted(unknown))))
+        bound = {}
+        for name, param in self.params.items() :
+            if name in values :
+                bound[name] = param.convert(values[name])
+            elif param.default != None :
+                bound[name] = param.convert(param.default)
+            else :
+                raise ScenarioError("%s: parameter %s is required" % (self.name, name))
+        return bound
+
+    def resolve(self, args) :
+        return dict((key, self.values[value[1:]] if isinstance(value, str) and value.startswith("$") else value)
+                    for key, value in args.items())
+
+    def count(self, name, limit=0) :
+        # Loop counter: done once limit iterations went by, 0 counts forever
+        self.counters[name] = self.counters.get(name, 0) + 1
+        return 'done' if limit and self.counters[name] >= limit else 0
+
+    def pause(self, seconds) :
+        if self.deadline != None and seconds > self.deadline - monotonic() :
+            if not self.nap(max(0, self.deadline - monotonic())) :
+                return 'stopped'
+            return 'timeout'
+        if not self.nap(seconds) :
+            return 'stopped'
+        return 0
+
+    def nap(self, seconds) :
+        # Sleeps in STOP_POLL slices, False if a stop request cut it short
+        end = monotonic() + seconds
+        while not self.stop_requested() :
+            left = end - monotonic()
+            if left <= 0 :
+                return True
+            sleep(min(left, STOP_POLL))
+        return False
+
+    def log(self, message) :
+        print("[%s] %s" % (self.name, message.format(**self.values)))
+        return 0
+
+    def attempt(self, state) :
+        try :
+            result = self.actions[state.action](**self.resolve(state.args))
+        except self.disconnect :
+            return 'disconnect'
+        if isinstance(result, str) :
+            return result
+        return result or 0
+
+    def step(self, state) :
+        # timeout bounds the whole state, retries and a blocking action alike: the action
+        # sees self.deadline and a failure at or past it is a timeout.
+        # attempts 0 retries until the action succeeds or the state times out
+        deadline = self.deadline = monotonic() + state.timeout if state.timeout else None
+        delay = state.delay
+        n = 0
+        while True :
+            result = self.attempt(state)
+            if result == 0 or isinstance(result, str) :
+                return result
+            if deadline != None and monotonic() >= deadline :
+                return 'timeout'
+            n += 1
+            if state.attempts and n >= state.attempts :
+                return result
+            if not self.nap(delay if deadline == None else max(0, min(delay, deadline - monotonic()))) :
+                return result
+            delay *= state.backoff
+
+    def transition(self, state, result) :
+        if result == 0 :
+            keys = ['ok']
+        elif result == 'done' :
+            keys = ['done', 'ok']
+        elif isinstance(result, str) :
+            keys = [result, 'error']
+        else :
+            keys = [self.outcomes.get(result, str(result)), 'error']
+        for key in keys :
+            if key in state.on :
+                return state.on[key]
+        for key in keys :
+            if key in self.on :
+                return self.on[key]
+        return FAIL
+
+    def stop(self) :
+        self.stopping = True
+
+    def stop_requested(self) :
+        # Only the states outside the stop chain give up early, the stop states run to completion
+        return self.stopping and self.stop_state != None and self.current not in self.stop_chain()
+
+    def run(self, values=None) :
+        self.values = self.bind(values or {})
+        self.counters = {}
+        self.stopping = False
+        current = self.initial
+        result = 0
+        while current not in (END, FAIL) :
+            state = self.states[current]
+            self.current = current
+            start = monotonic()
+            try :
+                result = self.step(state)
+                self.deadline = None
+            except KeyboardInterrupt :
+                self.deadline = None
+                # First interrupt runs the scenario's stop states, a second one aborts them
+                if self.stopping or not self.stop_state :
+                    raise
+                print("[%s][ ] : interrompido em %s" % (self.name, current))
+                self.stopping = True
+                current = self.stop_state
+                continue
+            if self.metrics :
+                self.metrics.observe("cb_scenario_state_seconds", monotonic() - start, scenario=self.name, state=current)
+            nxt = self.transition(state, result)
+            if nxt == FAIL :
+                print("[%s][ ] : %s -> %s (%s)" % (self.name, current, nxt, self.outcomes.get(result, result)))
+            if self.stopping and self.stop_state and current not in self.stop_chain() :
+                nxt = self.stop_state
+            current = nxt
+        print("[%s][%s]" % (self.name, "X" if current == END else " "))
+        if current == END :
+            return 0
+        return result if result and not isinstance(result, str) else -1
+
+    def stop_chain(self) :
+        # States reachable from the stop state, which run to completion once stopping
+        seen = set()
+        todo = [self.stop_state] if self.stop_state else []
+        while todo :
+            name = todo.pop()
+            if name in seen or name not in self.states :
+                continue
+            seen.add(name)
+            todo.extend(self.states[name].on.values())
+        return seen
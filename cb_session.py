@@ -0,0 +1,288 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from time import monotonic
+from time import time
+
+MAGIC = b"CBSESS\x01\n"
+HEADER = struct.Struct("<8sdd")
+RECORD = struct.Struct("<dBI")
+OUT = 0
+IN = 1
+FLUSH_INTERVAL = 1.0
+LOOKAHEAD = 4096
+
+
+class SessionRecorder :
+    # Append-only log: header, then (offset seconds, direction, length) + raw bytes per transfer
+    def __init__(self, path) :
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.flushed = self.start
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, time(), self.start))
+
+    def record(self, direction, data) :
+        if not data :
+            return
+        with self.lock :
+            if self.file == None :
+                return
+            now = monotonic()
+            self.file.write(RECORD.pack(now - self.start, direction, len(data)))
+            self.file.write(data)
+            if now - self.flushed > FLUSH_INTERVAL :
+                self.file.flush()
+                self.flushed = now
+
+    def close(self) :
+        with self.lock :
+            if self.file != None :
+                self.file.close()
+                self.file = None
+
+
+class RecordingSerial :
+    # Wraps an open Serial and records every byte that crosses it
+    def __init__(self, serial, recorder) :
+        self.serial = serial
+        self.recorder = recorder
+
+    def __getattr__(self, name) :
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value) :
+        if name in ('serial', 'recorder') :
+            object.__setattr__(self, name, value)
+        else :
+            setattr(self.serial, name, value)
+
+    def write(self, data) :
+        self.recorder.record(OUT, bytes(data))
+        return self.serial.write(data)
+
+    def read(self, size=1) :
+        data = self.serial.read(size)
+        self.recorder.record(IN, data)
+        return data
+
+    def read_until(self, expected=b'\n', size=None) :
+        data = self.serial.read_until(expected, size)
+        self.recorder.record(IN, data)
+        return data
+
+    def close(self) :
+        self.recorder.close()
+        self.serial.close()
+
+
+class SessionLog :
+    # Memory-mapped view of a recorded session with a time index for seeking
+    def __init__(self, path) :
+        self.path = path
+        with open(path, 'rb') as f :
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.epoch, self.start = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC :
+            raise ValueError("%s is not a session log" % path)
+        self.offsets = array('Q')
+        self.times = array('d')
+        pos = HEADER.size
+        end = len(self.map)
+        # A crash can leave a partial record at the tail, it is ignored
+        while pos + RECORD.size <= end :
+            t, direction, length = RECORD.unpack_from(self.map, pos)
+            if pos + RECORD.size + length > end :
+                break
+            self.offsets.append(pos)
+            self.times.append(t)
+            pos += RECORD.size + length
+
+    def __len__(self) :
+        return len(self.offsets)
+
+    def __getitem__(self, idx) :
+        pos = self.offsets[idx]
+        t, direction, length = RECORD.unpack_from(self.map, pos)
+        start = pos + RECORD.size
+        return t, direction, self.map[start:start + length]
+
+    def __iter__(self) :
+        for idx in range(len(self)) :
+            yield self[idx]
+
+    def find(self, t) :
+        return bisect_left(self.times, t)
+
+    @property
+    def duration(self) :
+        return self.times[-1] if self.times else 0.0
+
+    def close(self) :
+        self.map.close()
+
+
+class ReplaySerial :
+    # Serial stand-in fed from a SessionLog. Recorded reads are released in order once the
+    # writes that preceded them were made by the host, keeping the recorded gaps / speed.
+    # Writes listed in idle (status polls) may be skipped when the host polled less often,
+    # and their quiet replies (whole reply to one poll saying nothing) are dropped.
+    def __init__(self, log, speed=1.0, idle=(), quiet=()) :
+        self.log = log
+        self.speed = speed
+        self.idle = set(bytes(data) for data in idle)
+        self.quiet = set(bytes(data) for data in quiet)
+        self.timeout = 2
+        self.pos = 0
+        self.pending = bytearray()
+        self.cond = threading.Condition()
+        self.anchor_real = monotonic()
+        self.anchor_t = 0.0
+        self.writes = 0
+        self.mismatches = 0
+        self.diverged = None
+        self.finished = threading.Event()
+
+    def due(self, t) :
+        if self.speed <= 0 :
+            return 0.0
+        return self.anchor_real + (t - self.anchor_t) / self.speed - monotonic()
+
+    def release(self, wait) :
+        # Moves due read records into the pending buffer; returns seconds until the next one
+        while self.pos < len(self.log) :
+            t, direction, data = self.log[self.pos]
+            if direction == OUT :
+                return None
+            delay = self.due(t)
+            if wait and delay > 0 :
+                return delay
+            self.pending += data
+            self.pos += 1
+        self.finished.set()
+        return None
+
+    def match(self, data) :
+        found = None
+        for idx in range(self.pos, min(self.pos + LOOKAHEAD, len(self.log))) :
+            t, direction, recorded = self.log[idx]
+            if direction == IN :
+                continue
+            recorded = bytes(recorded)
+            if recorded == data :
+                # A faster replay polls less often: one poll stands for every recorded one already due
+                if found != None and self.due(t) > 0 :
+                    break
+                found = idx
+                if data not in self.idle :
+                    break
+            elif recorded not in self.idle :
+                break
+        return found
+
+    def write(self, data) :
+        data = bytes(data)
+        with self.cond :
+            # Whatever the device sent before this write in the recording has arrived by now
+            self.release(False)
+            self.writes += 1
+            idx = self.match(data)
+            if idx == None :
+                if data not in self.idle :
+                    # The host took another path than the recording, nothing after this is meaningful
+                    self.mismatches += 1
+                    if self.diverged == None :
+                        self.diverged = self.log.times[self.pos] if self.pos < len(self.log) else self.log.duration
+                    self.finished.set()
+            else :
+                reply = bytearray()
+                for skipped in range(self.pos, idx + 1) :
+                    t, direction, recorded = self.log[skipped]
+                    if direction == IN :
+                        reply += recorded
+                        continue
+                    if bytes(reply) not in self.quiet :
+                        self.pending += reply
+                    reply = bytearray()
+                self.pos = idx + 1
+                self.anchor_real = monotonic()
+                self.anchor_t = self.log.times[idx]
+            self.release(True)
+            self.cond.notify_all()
+        return len(data)
+
+    def take(self, size=None, expected=None) :
+        end = len(self.pending)
+        if expected != None :
+            idx = self.pending.find(expected)
+            end = idx + len(expected) if idx >= 0 else -1
+        if size != None and (end < 0 or end > size) and len(self.pending) >= size :
+            end = size
+        if end <= 0 :
+            return None
+        data = bytes(self.pending[:end])
+        del self.pending[:end]
+        return data
+
+    def read_until(self, expected=b'\n', size=None) :
+        deadline = monotonic() + (self.timeout if self.timeout != None else 1e9)
+        with self.cond :
+            while True :
+                delay = self.release(True)
+                data = self.take(size, expected)
+                if data != None :
+                    return data
+                remaining = deadline - monotonic()
+                if remaining <= 0 :
+                    return self.take() or b''
+                self.cond.wait(min(remaining, delay) if delay != None else remaining)
+
+    def read(self, size=1) :
+        return self.read_until(None, size)
+
+    @property
+    def in_waiting(self) :
+        with self.cond :
+            self.release(True)
+            return len(self.pending)
+
+    def close(self) :
+        self.finished.set()
+
+
+def printable(data) :
+    return bytes(data).decode('ascii', 'replace').replace("\r", "\\r").replace("\n", "\\n")
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Inspect recorded UART sessions')
+    parser.add_argument('log', type=str)
+    parser.add_argument('--start', type=float, default=0.0,
+                        help='Seconds from the start of the session')
+    parser.add_argument('--end', type=float, default=None)
+    parser.add_argument('--summary', type=int, default=0,
+                        help='Only print totals')
+    args = parser.parse_args(sys.argv[1:])
+
+    log = SessionLog(args.log)
+    totals = [0, 0]
+    first = log.find(args.start)
+    last = log.find(args.end) if args.end != None else len(log)
+    for idx in range(first, last) :
+        t, direction, data = log[idx]
+        totals[direction] += len(data)
+        if not args.summary :
+            print("%10.4f %s %s" % (t, "->" if direction == OUT else "<-", printable(data)))
+    print("[SESSION][X] : %s, %d records, %.1fs, %d bytes out, %d bytes in" %
+          (os.path.basename(args.log), last - first, log.duration, totals[OUT], totals[IN]))
+    log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+from time import time
+
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simulate_cb")
+BOND_CACHE_PATH = os.path.join(STATE_DIR, "bonds.json")
+BAIT_REGISTRY_PATH = os.path.join(STATE_DIR, "baits.json")
+
+
+class JsonStore :
+    # Small JSON document on disk, rewritten atomically on every change
+    def __init__(self, path) :
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = self.load()
+        # Changes made with save_later(), written by the saver thread or flush()
+        self.dirty = False
+        self.wake = threading.Event()
+        self.saver = None
+
+    def load(self) :
+        try :
+            with open(self.path) as f :
+                return json.load(f)
+        except (OSError, ValueError) :
+            return {}
+
+    def save(self) :
+        directory = os.path.dirname(self.path)
+        if directory :
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f :
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def save_later(self) :
+        # For callers that must not wait on the disk (the UART reader thread); lock held
+        self.dirty = True
+        if self.saver == None :
+            self.saver = threading.Thread(target=self.saver_loop, name="state-saver", daemon=True)
+            self.saver.start()
+        self.wake.set()
+
+    def saver_loop(self) :
+        while True :
+            self.wake.wait()
+            self.wake.clear()
+            self.flush()
+
+    def flush(self) :
+        # A failed write is logged and kept dirty, the next change or flush() tries again
+        with self.lock :
+            if not self.dirty :
+                return True
+            try :
+                self.save()
+            except OSError as e :
+                print("[STATE][ ] : falha ao salvar %s: %s" % (self.path, e))
+                return False
+            self.dirty = False
+            return True
+
+
+class BondCache(JsonStore) :
+    # {extender: {bait address: {"bonded_at": epoch}}}
+    def __init__(self, path=BOND_CACHE_PATH) :
+        JsonStore.__init__(self, path)
+
+    def is_bonded(self, extender, addr) :
+        with self.lock :
+            return addr in self.data.get(extender, {})
+
+    def mark(self, extender, addr, later=False) :
+        with self.lock :
+            self.data.setdefault(extender, {})[addr] = {'bonded_at': time()}
+            self.save_later() if later else self.save()
+
+    def invalidate(self, extender, addr=None, later=False) :
+        with self.lock :
+            bonds = self.data.get(extender)
+            if bonds == None :
+                return
+            if addr == None :
+                del self.data[extender]
+            elif addr in bonds :
+                del bonds[addr]
+            else :
+                return
+            self.save_later() if later else self.save()
+
+
+class BaitRegistry(JsonStore) :
+    # {bait address: {"name", "last_seen", "times", "configured_at"}}
+    def __init__(self, path=BAIT_REGISTRY_PATH) :
+        JsonStore.__init__(self, path)
+
+    def get(self, addr) :
+        with self.lock :
+            return self.data.get(addr)
+
+    def resolve(self, key) :
+        # Address with or without the ",tN" suffix, or the bait name
+        with self.lock :
+            if key in self.data :
+                return key
+            for addr, entry in self.data.items() :
+                if addr.split(",")[0] == key.upper() or entry.get('name') == key :
+                    return addr
+        return None
+
+    def seen(self, addr, name=None, when=None) :
+        with self.lock :
+            entry = self.data.setdefault(addr, {})
+            if name :
+                entry['name'] = name
+            entry['last_seen'] = when or time()
+            self.save()
+
+    def configured(self, addr, times) :
+        with self.lock :
+            entry = self.data.setdefault(addr, {})
+            entry['times'] = dict(times)
+            entry['configured_at'] = time()
+            self.save()
@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import threading
+from array import array
+from time import time
+
+try :
+    import numpy
+except ImportError :
+    numpy = None
+
+MAGIC = b"CBTELEM\x01"
+BLOCK = struct.Struct("<4sII")
+BLOCK_TAG = b"BLK\x00"
+FLUSH_ROWS = 4096
+
+# Fixed-width record, one array per column
+COLUMNS = (('t', 'd'), ('bait', 'H'), ('trip', 'H'), ('kind', 'B'), ('value', 'd'), ('ref', 'd'))
+NUMPY_TYPES = {'d': '<f8', 'H': '<u2', 'B': 'u1'}
+
+CONNECT = 1
+TID = 2
+PERIOD = 3
+LOST = 4
+BATTERY = 5
+KINDS = {CONNECT: 'connect', TID: 'tid', PERIOD: 'period', LOST: 'lost', BATTERY: 'battery'}
+PERCENTILES = (50, 90, 99)
+
+
+class TelemetryError(ValueError) :
+    pass
+
+
+def percentiles(values, qs=PERCENTILES) :
+    # Linear interpolation between closest ranks, the same as numpy's default
+    if not len(values) :
+        return [None] * len(qs)
+    if numpy != None :
+        return [float(v) for v in numpy.percentile(values, qs)]
+    ordered = sorted(values)
+    result = []
+    for q in qs :
+        pos = (len(ordered) - 1) * q / 100.0
+        low = int(pos)
+        high = min(low + 1, len(ordered) - 1)
+        result.append(ordered[low] + (ordered[high] - ordered[low]) * (pos - low))
+    return result
+
+
+def mean(values) :
+    if not len(values) :
+        return None
+    return float(numpy.mean(values)) if numpy != None else sum(values) / len(values)
+
+
+class TelemetryStore :
+    # Trip facts as columns of fixed-width records. The file is a header followed by
+    # append-only blocks (row count, bait/trip tables as JSON, then each column's raw
+    # bytes), so a crash loses at most the unflushed rows and never the earlier blocks.
+    def __init__(self, path=None, flush_rows=FLUSH_ROWS) :
+        self.path = path
+        self.flush_rows = flush_rows
+        self.columns = dict((name, array(code)) for name, code in COLUMNS)
+        self.baits = []
+        self.bait_index = {}
+        self.trips = []
+        self.trip = None
+        self.flushed = 0
+        self.lock = threading.Lock()
+        if path and os.path.exists(path) and os.path.getsize(path) :
+            end = self.load(path)
+            if end < os.path.getsize(path) :
+                # New blocks go right after the last good one
+                with open(path, 'r+b') as f :
+                    f.truncate(end)
+
+    def __len__(self) :
+        return len(self.columns['t'])
+
+    def load(self, path) :
+        with open(path, 'rb') as f :
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC :
+            raise TelemetryError("%s is not a telemetry file" % path)
+        pos = len(MAGIC)
+        widths = [(name, array(code).itemsize) for name, code in COLUMNS]
+        while pos + BLOCK.size <= len(data) :
+            tag, rows, meta_size = BLOCK.unpack_from(data, pos)
+            size = BLOCK.size + meta_size + sum(width * rows for name, width in widths)
+            # A crash can leave a partial block at the tail, it is ignored
+            if tag != BLOCK_TAG or pos + size > len(data) :
+                break
+            start = pos + BLOCK.size
+            meta = json.loads(data[start:start + meta_size].decode('utf-8'))
+            start += meta_size
+            for name, width in widths :
+                self.columns[name].frombytes(data[start:start + width * rows])
+                start += width * rows
+            self.baits = meta['baits']
+            self.trips = meta['trips']
+            pos += size
+        self.bait_index = dict((addr, idx) for idx, addr in enumerate(self.baits))
+        self.flushed = len(self)
+        return pos
+
+    def start_trip(self, mode) :
+        with self.lock :
+            self.trips.append({'mode': mode, 'started': time()})
+            self.trip = len(self.trips) - 1
+        return self.trip
+
+    def bait_id(self, addr) :
+        idx = self.bait_index.get(addr)
+        if idx == None :
+            idx = self.bait_index[addr] = len(self.baits)
+            self.baits.append(addr)
+        return idx
+
+    def record(self, kind, addr, value, ref=float('nan')) :
+        with self.lock :
+            if self.trip == None :
+                self.trips.append({'mode': None, 'started': time()})
+                self.trip = len(self.trips) - 1
+            columns = self.columns
+            columns['t'].append(time())
+            columns['bait'].append(self.bait_id(addr))
+            columns['trip'].append(self.trip)
+            columns['kind'].append(kind)
+            columns['value'].append(value)
+            columns['ref'].append(ref)
+            pending = len(columns['t']) - self.flushed
+        if self.path and pending >= self.flush_rows :
+            self.flush()
+
+    def flush(self) :
+        with self.lock :
+            rows = len(self) - self.flushed
+            if not self.path or not rows :
+                return 0
+            meta = json.dumps({'baits': self.baits, 'trips': self.trips}).encode('utf-8')
+            new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+            with open(self.path, 'ab') as f :
+                if new :
+                    f.write(MAGIC)
+                f.write(BLOCK.pack(BLOCK_TAG, rows, len(meta)))
+                f.write(meta)
+                for name, code in COLUMNS :
+                    f.write(self.columns[name][self.flushed:].tobytes())
+            self.flushed += rows
+            return rows
+
+    def close(self) :
+        self.flush()
+
+    def column(self, name) :
+        # Zero-copy numpy view when available, the array itself otherwise
+        data = self.columns[name]
+        if numpy != None :
+            return numpy.frombuffer(data, dtype=NUMPY_TYPES[data.typecode]) if len(data) else numpy.zeros(0, NUMPY_TYPES[data.typecode])
+        return data
+
+    def groups(self, by) :
+        # {(group id, kind): (values, refs)} for by in ('bait', 'trip')
+        keys = self.column(by)
+        kinds = self.column('kind')
+        values = self.column('value')
+        refs = self.column('ref')
+        if numpy != None :
+            if not len(keys) :
+                return {}
+            order = numpy.lexsort((kinds, keys))
+            keys, kinds, values, refs = keys[order], kinds[order], values[order], refs[order]
+            starts = numpy.concatenate(([0], numpy.flatnonzero((numpy.diff(keys) != 0) | (numpy.diff(kinds) != 0)) + 1))
+            ends = numpy.append(starts[1:], len(keys))
+            return dict(((int(keys[s]), int(kinds[s])), (values[s:e], refs[s:e])) for s, e in zip(starts.tolist(), ends.tolist()))
+        out = {}
+        for key, kind, value, ref in zip(keys, kinds, values, refs) :
+            group = out.setdefault((key, kind), ([], []))
+            group[0].append(value)
+            group[1].append(ref)
+        return out
+
+    def summarize(self, by='bait') :
+        if by not in ('bait', 'trip') :
+            raise TelemetryError("summaries are per bait or per trip, not %s" % by)
+        groups = self.groups(by)
+        empty = ([], [])
+        summaries = []
+        for gid in sorted(set(key for key, kind in groups)) :
+            connects = groups.get((gid, CONNECT), empty)[0]
+            tids = groups.get((gid, TID), empty)[0]
+            periods, configured = groups.get((gid, PERIOD), empty)
+            lost = len(groups.get((gid, LOST), empty)[0])
+            battery = groups.get((gid, BATTERY), empty)[0]
+            summary = {by: self.baits[gid] if by == 'bait' else gid}
+            if by == 'trip' :
+                summary.update(self.trips[gid])
+            summary['connects'] = len(connects)
+            summary['connect_s'] = dict(zip(('p50', 'p90', 'p99'), percentiles(connects)))
+            summary['tid_s'] = dict(zip(('p50', 'p90', 'p99'), percentiles(tids)))
+            summary['lost'] = lost
+            summary['loss_rate'] = lost / float(lost + len(connects)) if lost + len(connects) else None
+            summary['period_s'] = mean(periods)
+            summary['configured_s'] = mean(configured)
+            if len(periods) :
+                if numpy != None :
+                    summary['drift'] = float(numpy.mean(periods / configured) - 1)
+                else :
+                    summary['drift'] = sum(p / c for p, c in zip(periods, configured)) / len(periods) - 1
+            else :
+                summary['drift'] = None
+            summary['battery'] = {'last': float(battery[-1]), 'min': float(min(battery))} if len(battery) else None
+            summaries.append(summary)
+        return summaries
+
+
+def fmt(value, spec="%.3f") :
+    return "-" if value == None else spec % value
+
+
+def percent(value, spec="%.2f%%") :
+    return fmt(value * 100 if value != None else None, spec)
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Summarize trip telemetry written with simulate_cb.py --telemetry')
+    parser.add_argument('telemetry', type=str)
+    parser.add_argument('--by', type=str, default='bait', choices=('bait', 'trip'))
+    parser.add_argument('--json', type=int, default=0,
+                        help='Print the summaries as JSON')
+    args = parser.parse_args(sys.argv[1:])
+    if not os.path.exists(args.telemetry) :
+        parser.error("%s not found" % args.telemetry)
+
+    store = TelemetryStore()
+    try :
+        store.load(args.telemetry)
+        summaries = store.summarize(args.by)
+    except TelemetryError as e :
+        parser.error(str(e))
+    if args.json :
+        print(json.dumps(summaries, indent=2))
+        return
+    print("%-20s %8s %9s %9s %9s %6s %8s %9s %8s" %
+          (args.by, "connects", "conn p50", "conn p99", "tid p50", "lost", "loss", "period", "drift"))
+    for s in summaries :
+        label = s['bait'] if args.by == 'bait' else "%d %s" % (s['trip'], s.get('mode'))
+        print("%-20s %8d %9s %9s %9s %6d %8s %9s %8s" %
+              (label, s['connects'], fmt(s['connect_s']['p50']), fmt(s['connect_s']['p99']), fmt(s['tid_s']['p50']),
+               s['lost'], percent(s['loss_rate']), fmt(s['period_s'], "%.2f"), percent(s['drift'], "%+.2f%%")))
+    print("[TELEMETRY][X] : %d records, %d baits, %d trips (%s)" %
+          (len(store), len(store.baits), len(store.trips), "numpy" if numpy != None else "python"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# Puts the flat cb_*.py modules on sys.path for the tests under tests/
@@ -4,9 +4,29 @@ import argparse
 import sys
 import binascii
 import re
+import json
+import threading
+import heapq
+import itertools
+import random
+import signal
+import os
+from collections import deque
+from functools import lru_cache
 from serial import Serial
 from time import sleep
 from time import time
+from time import monotonic
+
+from cb_events import EventLog, CMD, REPLY, STATE, LOST, RECOVERED, CRASH_DUMP_PATH
+from cb_firmware import FirmwareImage, HexError
+from cb_gatt import AttributeMap, AttributeMirror
+from cb_metrics import Metrics
+from cb_session import SessionRecorder, RecordingSerial
+from cb_telemetry import TelemetryStore
+import cb_telemetry
+from cb_scenario import StateMachine, ScenarioError, STOP_POLL, load_scenario, parse_params, available_scenarios
+from cb_state import BondCache, BaitRegistry, BOND_CACHE_PATH, BAIT_REGISTRY_PATH
 
 
 CB_CONNECTED = 1
@@ -16,6 +36,7 @@ TIMEOUT = 120
 ISCA_LOST = -5
 ISCA_RECOVERED = -6
 ATTEMPTS_FAILED = -7
+BOND_FAILED = -8
 
 SERVICE_ID = '00000001100020003000111122223333'
 
@@ -29,104 +50,499 @@ STAT_SLEEP_TIME_ADDR = '0x0030'
 STAT_WAIT_TIME_ADDR = '0x0033'
 DYN_SLEEP_TIME_ADDR = '0x0036'
 DYN_WAIT_TIME_ADDR = '0x0039'
+# OTA service of the bait bootloader: control/commit, data stream and acknowledged offset
+OTA_CTRL_ADDR = '0x0040'
+OTA_DATA_ADDR = '0x0043'
+OTA_STATUS_ADDR = '0x0046'
+OTA_CHUNK = 64
+OTA_BLOCK = 1024
+OTA_RETRIES = 5
+FIRMWARE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tc-bait-p2.hex")
+
+BRO_PREFIX = b'bro "'
+BRO_FRAME = re.compile(rb'bro "(.*?)" ([0-9A-Fa-f]{4})\r\n', re.DOTALL)
+POLL_INTERVAL = 0.05
+# A reply frame may take the bridge turnaround plus its own transfer time at the current baud
+FRAME_LATENCY = 0.5
+MAX_FRAME = 4096
+INTER_BYTE_TIMEOUT = 0.01
+BAUD_RATES = (115200, 230400, 460800, 921600)
+BAUD_CMD = "AT+UARTBAUD=%d"
+# The extender drops back to its previous rate when no valid frame arrives at the new one;
+# the check at the new rate has to be over well before that
+BAUD_REVERT = 3
+BAUD_VERIFY = 0.5
+RETRY_DELAY = 1
+WAKE_LEAD = 1.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+SCAN_TTL = 120
+# Ends a running AT+LESCAN; an extender without it answers ERROR and the scan ends on its own
+SCAN_STOP_CMD = "AT+LESCAN=STOP"
+# Scans for a target bait before giving up, 0 scans until it shows up
+SCAN_ATTEMPTS = 10
+PIPELINE_WINDOW = 4
+# The firmware must see these alone, after every earlier command was answered
+BARRIER_CMDS = ('AT&W', 'AT+RESET')
+RESPONSE_LIMIT = 64 * 1024
+READY_BANNER = "BlueMod+SR READY"
+SETUP_CMDS = ('AT+LETIO=4', 'AT+BIOCAP=2', 'AT+BMITM=1', 'AT+LECONINTMIN=400', 'AT+LECONINTMAX=400', 'AT+LEROLE=1',
+              'AT&W', 'AT+RESET')
+RESET_TIMEOUT = 15
+
+NO_CARRIER_PAT = re.compile("NO CARRIER")
+OK_PAT = re.compile("OK")
+RESULT_PAT = re.compile(r"^(OK|ERROR)\b")
+FINAL_RESULT = r"(?m)^(OK|ERROR)\r?$"
+FINAL_PAT = re.compile(FINAL_RESULT)
+SCAN_LINE = re.compile(r'^\s*([0-9A-Fa-f]{12},t[0-3])(?:\s+(-?\d+)\b)?\s*"?([^"\r\n]*)')
+COMMAND_PAT = re.compile(r"^(AT[+&][A-Z]+|ATD|ATH|AT[A-Z]*)")
+SETTING_PAT = re.compile(r"^AT\+(\w+)=(.*)$")
+
+OUTCOMES = {0: 'OK', ISCA_LOST: 'ISCA_LOST', ISCA_RECOVERED: 'ISCA_RECOVERED', ATTEMPTS_FAILED: 'ATTEMPTS_FAILED',
+            BOND_FAILED: 'BOND_FAILED'}
+SSPPIN_PAT = re.compile(r"SSPPIN (\w*,t[1-3]) \?")
+BOND_FAIL_PAT = re.compile(r"BNDFAIL\s*(\w*)")
+BOND_EVENT_PAT = re.compile(r"(BNDSUCCESS|BNDFAIL)\s*([0-9A-Fa-f]{12})")
+BD_ADDR_PAT = re.compile(r"\b([0-9A-Fa-f]{12})\b")
+OTA_STATUS_PAT = re.compile(r"LEREAD:0x10,0x0*46,([0-9A-Fa-f]{8})")
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern) :
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=256)
+def command_name(data) :
+    match = COMMAND_PAT.match(data)
+    return match.group(1) if match else data
+
+
+@lru_cache(maxsize=256)
+def encode_frame(cmd, suffix) :
+    if cmd == 'a' or cmd == 'r':
+        data = "b " + cmd + "\r\n"
+    elif cmd == 'w':
+        crc = binascii.crc_hqx(suffix.encode('ascii'), 0xFFFF)
+        data = "b w \"" + suffix + "\" " + '{:04x}'.format(crc) + "\r\n"
+    return data.encode('ascii')
+
+
+class FrameCodec :
+    def __init__(self) :
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def encode(self, cmd, suffix='') :
+        return encode_frame(cmd, suffix)
+
+    def reset(self) :
+        del self.buffer[:]
+
+    def feed(self, data) :
+        # Returns the payloads of every complete "bro" frame with a valid CRC
+        self.buffer += data
+        payloads = []
+        pos = 0
+        while True :
+            start = self.buffer.find(BRO_PREFIX, pos)
+            if start < 0 :
+                # Keep a possible partial prefix for the next feed
+                pos = max(pos, len(self.buffer) - len(BRO_PREFIX) + 1)
+                break
+            match = BRO_FRAME.match(self.buffer, start)
+            if not match :
+                pos = start
+                break
+            payload = match.group(1)
+            if binascii.crc_hqx(payload, 0xFFFF) == int(match.group(2), 16) :
+                payloads.append(bytes(payload))
+            else :
+                self.crc_errors += 1
+            pos = match.end()
+        del self.buffer[:pos]
+        return payloads
+
+
+class LineSplitter :
+    def __init__(self) :
+        self.tail = ""
+
+    def feed(self, text) :
+        parts = (self.tail + text).split('\n')
+        self.tail = parts.pop()
+        return [line for line in (part.strip('\r') for part in parts) if line]
+
+    def flush(self) :
+        # Prompts such as "SSPPIN ... ?" are not newline terminated
+        line = self.tail.strip('\r')
+        self.tail = ""
+        return [line] if line else []
+
 
 class UnexpectedDisconnect(Exception) :
     pass
 
+
+def match_response(pattern, response) :
+    if compile_pattern(pattern).search(response) :
+        return 0
+    elif pattern != "CONNECT" and pattern != "NO CARRIER" and pattern != "NO CARRIER|OK" and NO_CARRIER_PAT.search(response) :
+        raise UnexpectedDisconnect("Unexpected disconnect!")
+    elif pattern == "CONNECT" and NO_CARRIER_PAT.search(response) :
+       return ISCA_LOST 
+    elif pattern == "NO CARRIER" and OK_PAT.search(response) :
+        return ISCA_RECOVERED
+    return None
+
+def split_replies(text) :
+    # [(ok, [lines])] per final result, in order: the lines before each OK/ERROR are its reply
+    replies = []
+    current = []
+    for line in text.split("\n") :
+        line = line.strip()
+        if not line :
+            continue
+        if RESULT_PAT.match(line) :
+            replies.append((line.startswith("OK"), current))
+            current = []
+        else :
+            current.append(line)
+    return replies
+
+
+def setting_value(name, lines) :
+    # "4", "LETIO: 4" or "+LETIO=4", depending on the firmware
+    if not lines :
+        return None
+    value = lines[-1]
+    for prefix in ("+" + name, name) :
+        if value.startswith(prefix) :
+            value = value[len(prefix):].lstrip(" :=")
+            break
+    return value
+
+
+def same_setting(current, wanted) :
+    if current == None :
+        return False
+    if current.isdigit() and wanted.isdigit() :
+        return int(current) == int(wanted)
+    return current.strip().upper() == wanted.strip().upper()
+
+
 class UartDriver :
-    def __init__(self, baud=115200, port="/dev/ttyUSB0", timeout=0.5, verbose=0) :
+    def __init__(self, baud=115200, port="/dev/ttyUSB0", timeout=0.5, verbose=0, reader=0, window=PIPELINE_WINDOW, metrics=None,
+                 record=None, link=None, events=None) :
         self.baud = baud
         self.port = port
         self.verbose = int(verbose)
-        self.serial = None
-        self.full_response = ""
-        self.bind()
+        self.window = int(window)
+        self.metrics = metrics
+        # Commands and replies always go to the event ring; verbose echoes them from its writer thread
+        self.events = events if events != None else EventLog(console=bool(self.verbose))
+        # link: an already open serial-like object (session replay) used instead of the port
+        self.serial = link
+        self.codec = FrameCodec()
+        self.poll_frame = self.codec.encode('r')
+        self.response_chunks = deque()
+        self.response_size = 0
+        # Reader mode: one thread owns the "b r"/"b a" polling and fills the line queue
+        self.lock = threading.Lock()
+        self.lines = deque()
+        self.lines_cond = threading.Condition()
+        self.splitter = LineSplitter()
+        self.legacy_splitter = LineSplitter()
+        self.listeners = []
+        self.reader_thread = None
+        self.reader_stop = threading.Event()
+        if not self.serial :
+            self.bind()
+        if record and self.serial :
+            self.serial = RecordingSerial(self.serial, SessionRecorder(record))
+        if int(reader) :
+            self.start_reader()
+
+    @property
+    def full_response(self) :
+        return "".join(self.response_chunks)
+
+    def reset_response(self) :
+        self.response_chunks.clear()
+        self.response_size = 0
+
+    def append_response(self, text) :
+        self.response_chunks.append(text)
+        self.response_size += len(text)
+        while self.response_size > RESPONSE_LIMIT and len(self.response_chunks) > 1 :
+            self.response_size -= len(self.response_chunks.popleft())
 
     def write(self, data) :
-        if self.verbose: 
-            print("Enviando \"%s\"" % data, end='')
-        self.serial.write(data.encode('ascii'))
-        response = self.serial.read(300)
-        if self.verbose: 
-            print("Resposta do comando: \"%s\"" % response.decode('ascii'))
-            print("++++++")
+        if isinstance(data, str) :
+            data = data.encode('ascii')
+        self.events.emit(CMD, data=data)
+        if self.metrics :
+            self.metrics.inc("cb_serial_bytes_total", len(data), direction="out")
+        if self.reader_thread :
+            with self.lock :
+                self.serial.write(data)
+            return b''
+        self.serial.write(data)
+        if data == self.poll_frame :
+            response = self.read_response(monotonic() + self.frame_timeout())
+        else :
+            # Writes and acks get no frame back, only collect what is already there
+            response = self.drain()
+        if self.metrics :
+            self.metrics.inc("cb_serial_bytes_total", len(response), direction="in")
+        self.events.emit(REPLY, data=response)
         return response
 
     def read(self) :
-        msg = self.mount_msg('r', '')
-        return self.write(msg)
+        return self.write(self.poll_frame)
+
+    def frame_timeout(self) :
+        return FRAME_LATENCY + MAX_FRAME * 10.0 / self.baud
+
+    def drain(self) :
+        waiting = self.serial.in_waiting
+        return self.serial.read(waiting) if waiting else b''
+
+    def read_response(self, deadline) :
+        # Bulk reads sized from in_waiting until a whole "bro" frame is in, instead of
+        # a fixed read that either splits long replies or sits out the port timeout
+        data = bytearray()
+        while monotonic() < deadline :
+            chunk = self.serial.read(max(1, self.serial.in_waiting))
+            if chunk :
+                data += chunk
+                if BRO_FRAME.search(data) :
+                    break
+        return bytes(data)
+
+    def read_payloads(self) :
+        # Legacy poll: one "b r" round trip, acked only when every frame checked out
+        errors = self.codec.crc_errors
+        self.codec.reset()
+        payloads = self.codec.feed(self.read())
+        # Frames longer than one read keep arriving line by line
+        while not payloads and BRO_PREFIX in self.codec.buffer :
+            data = self.serial.read_until(b'\n')
+            if not data :
+                break
+            if self.metrics :
+                self.metrics.inc("cb_serial_bytes_total", len(data), direction="in")
+            payloads = self.codec.feed(data)
+        if self.codec.crc_errors == errors :
+            self.clear_buffer()
+        return [p.decode('ascii', 'replace') for p in payloads]
+
+    def start_reader(self) :
+        if self.reader_thread or not self.serial :
+            return
+        self.serial.timeout = POLL_INTERVAL
+        self.reader_stop.clear()
+        self.reader_thread = threading.Thread(target=self.reader_loop, name="uart-reader", daemon=True)
+        self.reader_thread.start()
+
+    def stop_reader(self) :
+        if not self.reader_thread :
+            return
+        self.reader_stop.set()
+        self.reader_thread.join()
+        self.reader_thread = None
+
+    def close(self) :
+        self.stop_reader()
+        if self.serial :
+            self.serial.close()
+            self.serial = None
+        self.events.close()
+
+    def reader_loop(self) :
+        poll = self.codec.encode('r')
+        ack = self.codec.encode('a')
+        while not self.reader_stop.is_set() :
+            with self.lock :
+                self.serial.write(poll)
+                payload = self.read_frame(monotonic() + self.frame_timeout())
+                if payload :
+                    self.serial.write(ack)
+            if self.metrics :
+                self.metrics.inc("cb_serial_bytes_total", len(poll) + (len(ack) if payload else 0), direction="out")
+            if payload :
+                self.push_payload(payload.decode('ascii', 'replace'))
+            else :
+                self.flush_tail()
+                self.reader_stop.wait(POLL_INTERVAL)
+
+    def read_frame(self, deadline) :
+        # A frame with a bad CRC is dropped and left unacked, so the next poll reads it again
+        self.codec.reset()
+        while monotonic() < deadline :
+            data = self.serial.read(max(1, self.serial.in_waiting))
+            if not data :
+                continue
+            if self.metrics :
+                self.metrics.inc("cb_serial_bytes_total", len(data), direction="in")
+            payloads = self.codec.feed(data)
+            if payloads :
+                return b''.join(payloads)
+        return None
+
+    def push_payload(self, text) :
+        self.events.emit(REPLY, data=text)
+        self.push_lines(self.splitter.feed(text))
+
+    def flush_tail(self) :
+        self.push_lines(self.splitter.flush())
+
+    def push_lines(self, lines) :
+        if not lines :
+            return
+        self.dispatch_lines(lines)
+        chunk = "\r\n".join(lines)
+        # Lines that arrived in the same frame are matched together, like a legacy poll
+        with self.lines_cond :
+            self.lines.append(chunk)
+            self.lines_cond.notify_all()
+
+    def dispatch_lines(self, lines) :
+        for listener in self.listeners :
+            for line in lines :
+                listener(line)
+
+    def next_line(self, deadline) :
+        with self.lines_cond :
+            while not self.lines :
+                remaining = deadline - monotonic()
+                if remaining <= 0 :
+                    return None
+                self.lines_cond.wait(remaining)
+            return self.lines.popleft()
+
+    def check_response(self, pattern, response) :
+        err = match_response(pattern, response)
+        if err != None :
+            return err
+        if BOND_FAIL_PAT.search(response) :
+            return BOND_FAILED
+        ssppin = SSPPIN_PAT.search(response)
+        if ssppin :
+            msg = "AT+BSSPPIN " + ssppin.group(1) + ",123456"
+            self.transport_msg(attempts=2, timeout=10, data=msg, expected="OK")
+            # The caller keeps waiting for the bond completion instead of a fixed sleep
+            print("Aguardando a isca processar o bound...")
+        return None
 
     def read_until_x(self, timeout=1, pattern=None) :
-        now = int(time())
-        last = now
-        self.full_response = ""
+        deadline = monotonic() + timeout
+        self.reset_response()
+
+        if self.reader_thread :
+            if pattern == None :
+                with self.lines_cond :
+                    self.lines.clear()
+                return 0
+            while True :
+                line = self.next_line(deadline)
+                if line == None :
+                    return 1
+                self.append_response(line + "\r\n")
+                err = self.check_response(pattern, line)
+                if err != None :
+                    return err
 
         if pattern == None :
-            while now - last <= timeout :
-                response = self.read()
-                self.full_response += response.decode('ascii')
-                self.clear_buffer()
-                if response == b'\r\nbro "" FFFF\r\n' :
+            while monotonic() <= deadline :
+                payloads = self.read_payloads()
+                for response in payloads :
+                    self.append_response(response)
+                if payloads == [''] :
                     return 0
-                now = int(time())
         else :
-            while now - last <= timeout :
-                response = self.read()
-                self.clear_buffer()
-                response = response.decode('ascii')
-                self.full_response += response
-                matches = re.findall(pattern, response)
-                if len(matches) :
-                    return 0
-                elif pattern != "CONNECT" and pattern != "NO CARRIER" and pattern != "NO CARRIER|OK" and len(re.findall("NO CARRIER", response)) :
-                    raise UnexpectedDisconnect("Unexpected disconnect!")
-                elif pattern == "CONNECT" and len(re.findall("NO CARRIER", response)) :
-                   return ISCA_LOST 
-                elif pattern == "NO CARRIER" and len(re.findall("OK", response)) :
-                    return ISCA_RECOVERED
-                elif len(re.findall("SSPPIN \w*,t[1-3] \?", response)):
-                    msg = "AT+BSSPPIN " + re.findall("\w*,t[1-3]", response)[0] + ",123456"
-                    self.transport_msg(attempts=2, timeout=10, data=msg, expected="OK")
-                    print("Aguardando a isca processar o bound...")
-                    sleep(30)
-                now = int(time())
+            while monotonic() <= deadline :
+                payloads = self.read_payloads()
+                for response in payloads :
+                    self.dispatch_lines(self.legacy_splitter.feed(response))
+                    self.append_response(response)
+                    err = self.check_response(pattern, response)
+                    if err != None :
+                        return err
+                if not any(payloads) :
+                    # Polls no longer wait out a read timeout, pace them like the reader thread
+                    sleep(POLL_INTERVAL)
 
         return 1
 
     def clear_buffer(self) :
-        msg = self.mount_msg('a', '')
-        self.write(msg)
+        self.write(self.codec.encode('a'))
 
     def mount_msg(self, cmd, suffix) :
-        if cmd == 'a' or cmd == 'r':
-            data = "b "
-            data += cmd
-            data += "\r\n"
-        elif cmd == 'w':
-            data = "b "
-            data += cmd + " \""
-            data += suffix
-            data += "\" "
-            crc = binascii.crc_hqx(suffix.encode('ascii'), 0xFFFF)
-            data += '{:04x}'.format(crc)
-            data += "\r\n"
-
-        return data
+        return self.codec.encode(cmd, suffix).decode('ascii')
 
 
     def bind(self) :
         print("[UART_BIND][ ]: The uart driver will be bind to port %s with baudrate %d" % (self.port, self.baud))
         try :
-            self.serial = Serial(port=self.port, baudrate=self.baud, bytesize=8, timeout=2, stopbits=serial.STOPBITS_ONE)
+            self.serial = Serial(port=self.port, baudrate=self.baud, bytesize=8, timeout=POLL_INTERVAL,
+                                 inter_byte_timeout=INTER_BYTE_TIMEOUT, stopbits=serial.STOPBITS_ONE)
         except :
             print("Error bind uart to port %s with baudrate %d" % (self.port, self.baud))
         print("[UART_BIND][X]")
 
+    def set_baud(self, baud) :
+        with self.lock :
+            self.serial.baudrate = baud
+            self.baud = baud
+
+    def negotiate_baud(self, wanted) :
+        # Steps the extender UART up to the fastest rate it accepts that also survives a round
+        # trip; a rate failing the check is left to the extender's own fallback after BAUD_REVERT
+        old = self.baud
+        for baud in sorted((b for b in BAUD_RATES if old < b <= wanted), reverse=True) :
+            err = self.transport_msg(attempts=1, timeout=5, data=BAUD_CMD % baud, expected="OK|ERROR")
+            if err or "ERROR" in self.full_response :
+                print("[UART_BAUD][ ] : extensor recusou %d" % baud)
+                continue
+            self.set_baud(baud)
+            if not self.transport_msg(attempts=2, timeout=BAUD_VERIFY, data="AT", expected="OK") :
+                print("[UART_BAUD][X] : %d -> %d" % (old, baud))
+                return baud
+            print("[UART_BAUD][ ] : sem resposta em %d, voltando para %d" % (baud, old))
+            self.set_baud(old)
+            sleep(BAUD_REVERT)
+            self.read_until_x()
+            if self.transport_msg(attempts=3, timeout=1, data="AT", expected="OK") :
+                print("[UART_BAUD][ ] : extensor também não responde em %d" % old)
+                return None
+        return self.baud
+
     def transport_msg(self, attempts, timeout, data, expected="OK") :
+        if not self.metrics :
+            return self.send_msg(attempts, timeout, data, expected)
+
+        cmd = command_name(data)
+        start = monotonic()
+        outcome = "UnexpectedDisconnect"
+        try :
+            err = self.send_msg(attempts, timeout, data, expected)
+            outcome = OUTCOMES.get(err, str(err))
+            return err
+        finally :
+            self.metrics.observe("cb_transport_seconds", monotonic() - start, cmd=cmd, outcome=outcome)
+            self.metrics.inc("cb_transport_total", cmd=cmd, outcome=outcome)
+
+    def send_msg(self, attempts, timeout, data, expected) :
         err = 0
-        data = self.mount_msg('w', data)
+        frame = self.codec.encode('w', data)
+        tries = 0
         while attempts > 0 :
-            self.write(data)
+            if tries and self.metrics :
+                self.metrics.inc("cb_transport_retries_total", cmd=command_name(data))
+            tries += 1
+            self.write(frame)
             err = self.read_until_x(timeout, expected)
             if not err :
                 return 0
@@ -136,106 +552,511 @@ class UartDriver :
                 return ISCA_RECOVERED
             attempts = attempts - 1
 
-        return ATTEMPTS_FAILED
-
-
-class Simulation :
-    def __init__(self, uart, mode, setup) :
+        return err if err == BOND_FAILED else ATTEMPTS_FAILED
+
+    def transport_batch(self, cmds, timeout=10, expected="OK", on_result=None, stop_on=(), cancel=None) :
+        # Keeps up to self.window commands in flight and matches each OK/ERROR to the
+        # oldest outstanding command. Returns one error code per command. A failure of a
+        # command whose index is in stop_on, a timeout, or the cancel event sends nothing
+        # more; the unsent commands stay ATTEMPTS_FAILED.
+        results = [ATTEMPTS_FAILED] * len(cmds)
+        sent = [monotonic()] * len(cmds)
+
+        def done(idx, err) :
+            results[idx] = err
+            if self.metrics :
+                self.metrics.observe("cb_batch_command_seconds", monotonic() - sent[idx],
+                                     cmd=command_name(cmds[idx]), outcome=OUTCOMES.get(err, str(err)))
+            if on_result :
+                on_result(idx, err)
+
+        if not self.reader_thread or self.window <= 1 :
+            # ERROR is a final reply too, a failed write must not sit out the whole timeout
+            pattern = compile_pattern(expected)
+            for idx, cmd in enumerate(cmds) :
+                err = self.transport_msg(attempts=1, timeout=timeout, data=cmd, expected=expected + "|ERROR")
+                if not err and not pattern.search(self.full_response) :
+                    err = ATTEMPTS_FAILED
+                done(idx, err)
+                if (err and idx in stop_on) or (cancel != None and cancel.is_set()) :
+                    break
+            return results
+
+        pattern = compile_pattern(expected)
+        pending = deque()
+        nxt = 0
+        self.reset_response()
+        while nxt < len(cmds) or pending :
+            if cancel != None and cancel.is_set() :
+                nxt = len(cmds)
+                if not pending :
+                    break
+            while nxt < len(cmds) and len(pending) < self.window :
+                barrier = cmds[nxt] in BARRIER_CMDS
+                if pending and (barrier or cmds[pending[-1][0]] in BARRIER_CMDS) :
+                    break
+                self.write(self.codec.encode('w', cmds[nxt]))
+                sent[nxt] = monotonic()
+                pending.append((nxt, monotonic() + timeout))
+                nxt += 1
+
+            chunk = self.next_line(pending[0][1])
+            if chunk == None :
+                # A late reply would be matched to the next command: fail everything in flight,
+                # send nothing more and swallow the replies still on their way
+                if self.metrics :
+                    self.metrics.inc("cb_batch_resyncs_total", cmd=command_name(cmds[pending[0][0]]))
+                late = len(pending)
+                while pending :
+                    done(pending.popleft()[0], ATTEMPTS_FAILED)
+                self.resync(late, monotonic() + timeout)
+                break
+            self.append_response(chunk + "\r\n")
+            for line in chunk.split("\r\n") :
+                if NO_CARRIER_PAT.search(line) :
+                    raise UnexpectedDisconnect("Unexpected disconnect!")
+                if pending and RESULT_PAT.match(line) :
+                    idx = pending.popleft()[0]
+                    done(idx, 0 if pattern.search(line) else ATTEMPTS_FAILED)
+                    if results[idx] and idx in stop_on :
+                        nxt = len(cmds)
+
+        return results
+
+    def resync(self, count, deadline) :
+        # Reads until count more final results arrived, or the deadline passed
+        while count > 0 :
+            chunk = self.next_line(deadline)
+            if chunk == None :
+                return
+            self.append_response(chunk + "\r\n")
+            for line in chunk.split("\r\n") :
+                if NO_CARRIER_PAT.search(line) :
+                    raise UnexpectedDisconnect("Unexpected disconnect!")
+                if RESULT_PAT.match(line) :
+                    count -= 1
+
+
+class ScannedDevice :
+    __slots__ = ('addr', 'addr_type', 'name', 'rssi', 'first_seen', 'last_seen', 'seen')
+
+    def __init__(self, addr, now) :
+        self.addr = addr
+        self.addr_type = addr.split(",")[1]
+        self.name = ""
+        self.rssi = None
+        self.first_seen = now
+        self.last_seen = now
+        self.seen = 0
+
+
+class ScanTable :
+    # Filled line by line while AT+LESCAN output arrives, keyed by "ADDRESS,tN"
+    def __init__(self, ttl=SCAN_TTL) :
+        self.ttl = ttl
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def feed(self, line) :
+        match = SCAN_LINE.match(line)
+        if not match :
+            return None
+        addr, rssi, name = match.groups()
+        addr = addr[:12].upper() + addr[12:]
+        name = name.strip()
+        now = monotonic()
+        with self.lock :
+            device = self.devices.get(addr)
+            if device == None :
+                device = self.devices[addr] = ScannedDevice(addr, now)
+            if name :
+                device.name = name
+            if rssi != None :
+                device.rssi = int(rssi)
+            device.last_seen = now
+            device.seen += 1
+        return device
+
+    def expire(self) :
+        limit = monotonic() - self.ttl
+        with self.lock :
+            for addr in [a for a, d in self.devices.items() if d.last_seen < limit] :
+                del self.devices[addr]
+
+    def get(self, addr) :
+        with self.lock :
+            return self.devices.get(addr[:12].upper() + addr[12:])
+
+    def find(self, key) :
+        # Address (with or without the ",tN" suffix) or bait name
+        device = self.get(key)
+        if device :
+            return device
+        key_up = key.upper()
+        with self.lock :
+            for device in self.devices.values() :
+                if device.addr.split(",")[0] == key_up or device.name == key :
+                    return device
+        return None
+
+    def baits(self) :
+        with self.lock :
+            found = [d for d in self.devices.values() if "ISCA" in d.name]
+        return sorted(found, key=lambda d : d.first_seen)
+
+
+class CbProtocol :
+    # What a trip sends and what it keeps from the replies, without the I/O: the *_msg methods
+    # return transport_msg arguments. Simulation sends them from its thread, cb_async.AsyncSimulation
+    # from the event loop.
+    def init_protocol(self, events) :
+        self.events = events
+        self.addr = None
+        self.link_state = None
+        self.now_tid = time()
+        self.nisca_lost = 0
+        self.predictors = {}
+        # Host side copy of each bait's GATT attributes, fed by every LEREAD reply on the link
+        self.attributes = AttributeMap()
+        self.mirrors = {}
+        self.bonded = set()
+        self.setup_arr = list(SETUP_CMDS)
+
+    @property
+    def actual_state(self) :
+        return self.link_state
+
+    @actual_state.setter
+    def actual_state(self, state) :
+        if state != self.link_state :
+            self.events.emit(STATE, addr=self.addr, state='connected' if state == CB_CONNECTED else 'disconnected')
+        self.link_state = state
+
+    def note(self, kind, value, ref=float('nan'), addr=None) :
+        if self.telemetry != None :
+            self.telemetry.record(kind, addr or self.addr, value, ref)
+
+    def mirror(self, addr=None) :
+        addr = addr or self.addr
+        if addr not in self.mirrors :
+            self.mirrors[addr] = AttributeMirror(self.attributes)
+        return self.mirrors[addr]
+
+    def predictor(self, addr, sleep_time) :
+        if addr not in self.predictors :
+            self.predictors[addr] = WakePredictor(sleep_time)
+        return self.predictors[addr]
+
+    def on_gatt_line(self, line) :
+        if self.addr and "LEREAD:" in line :
+            if self.mirror().feed(line) == 'battery' :
+                self.note(cb_telemetry.BATTERY, self.mirror().get('battery'))
+
+    def bait_lost(self, addr, count) :
+        # NO CARRIER on a dial: the bait missed its wake window, nothing mirrored can be trusted
+        self.mirror(addr).invalidate()
+        self.events.emit(LOST, addr=addr, count=count)
+        self.note(cb_telemetry.LOST, 1, addr=addr)
+
+    def bait_connected(self, addr, predictor, tid_time, attempt) :
+        # tid_time None: the dial did not follow a TID, there is no wake period to learn
+        if tid_time == None :
+            predictor.failures = 0
+            return
+        connected = time()
+        predictor.observe(tid_time, attempt, connected)
+        if predictor.nominal :
+            self.note(cb_telemetry.PERIOD, connected - tid_time, predictor.nominal, addr=addr)
+
+    def backoff_delay(self, predictor, deadline=None) :
+        delay = predictor.backoff()
+        if self.uart.metrics :
+            self.uart.metrics.observe("cb_reconnect_backoff_seconds", delay, mode=self.mode)
+        return delay if deadline == None else min(delay, max(0, deadline - monotonic()))
+
+    def setup_settings(self) :
+        # (cmd, name, value) of each AT+NAME=value of the setup
+        return [(cmd,) + SETTING_PAT.match(cmd).groups() for cmd in self.setup_arr if SETTING_PAT.match(cmd)]
+
+    def changed_settings(self, settings, current) :
+        return [cmd for cmd, name, value in settings if not same_setting(current[name], value)]
+
+    def save_msg(self) :
+        return dict(attempts=2, timeout=10, data="AT&W", expected="OK")
+
+    def reset_msg(self) :
+        # Done when the firmware announces itself again, not after a fixed delay
+        return dict(attempts=1, timeout=RESET_TIMEOUT, data="AT+RESET", expected=re.escape(READY_BANNER))
+
+    def connect_msg(self, addr) :
+        return dict(attempts=1, timeout=10, data='ATD' + addr + ',GATT', expected="CONNECT")
+
+    def disconnect_msg(self, channel) :
+        return dict(attempts=2, timeout=10, data='ATH=' + channel, expected="NO CARRIER|OK")
+
+    def tid_msg(self, expected=None) :
+        # The bait sleeps once it takes the TID, its wake is counted from here
+        self.actual_state = CB_DISCONNECT
+        self.now_tid = time()
+        return dict(attempts=1, timeout=10, data='AT+LEWRITE=0x10,' + TID_ADDR + ",000F",
+                    expected="NO CARRIER" if expected == None else expected)
+
+    def mode_msg(self, mode) :
+        return dict(attempts=2, timeout=10, data=self.attributes['op_mode_ctrl'].write_cmd(int(mode, 16)), expected="OK")
+
+    def mode_written(self) :
+        # Even a failed write may have reached the bait
+        self.mirror().mode_changed()
+
+    def time_values(self, static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time) :
+        return {'static_sleep_time': static_sleep_time, 'static_wait_time': static_wait_time,
+                'dyn_sleep_time': dyn_sleep_time, 'dyn_wait_time': dyn_wait_time}
+
+    def attribute_writes(self, values) :
+        # Only attributes whose mirrored value is unknown or different go on the air
+        names = self.mirror().changed(values)
+        if self.uart.metrics and len(names) < len(values) :
+            self.uart.metrics.inc("cb_gatt_writes_skipped_total", len(values) - len(names))
+        return names, [self.attributes[name].write_cmd(values[name]) for name in names]
+
+    def attributes_written(self, names, values, results) :
+        mirror = self.mirror()
+        for name, err in zip(names, results) :
+            if err :
+                mirror.invalidate([name])
+            else :
+                mirror.update(name, values[name])
+        return next((err for err in results if err), 0)
+
+
+class Simulation(CbProtocol) :
+    def __init__(self, uart, mode, setup, bonds=None, registry=None, target=None, firmware=FIRMWARE_PATH, params=None,
+                 telemetry=None) :
         if not uart or not mode :
             raise Exception("Uart device or mode was not specified!")
         self.setup = setup
         self.uart = uart
-        self.scenario = {'static': self.super_static,
-                         'recover_dyn': self.recover_dyn,
-                         'bait_lost': self.bait_lost,
-                         'field' : self.bait_in_field}
+        self.bonds = bonds
+        self.registry = registry
+        self.target = target
+        self.firmware = firmware
+        self.params = params or {}
+        self.telemetry = telemetry
+        self.init_protocol(uart.events)
+        self.extender = None
+        self.machine = None
+        # Address search_bait already connected to (registry hint), taken by the next connect
+        self.dialed = None
+        # Set by stop() to end an in-code mode (ota) at its next check, scenarios use machine.stop()
+        self.cancel = threading.Event()
+        # Modes still written in code; any other mode is a scenario file (see scenarios/)
+        self.scenario = {'multi' : self.multi_bait,
+                         'ota' : self.bait_ota}
         self.mode = mode
-        self.now_tid = int(time())
-        self.setup_arr = ['AT+LETIO=4', 'AT+BIOCAP=2',
-                         'AT+BMITM=1', 'AT+LECONINTMIN=400',
-                          'AT+LECONINTMAX=400', 'AT+LEROLE=1',
-                          'AT&W', 'AT+RESET']
+        self.progress = True
+        self.uart_baud = 0
+        self.scan_attempts = SCAN_ATTEMPTS
+        self.scan_table = ScanTable()
+        self.uart.listeners.append(self.scan_table.feed)
+        if self.bonds :
+            self.uart.listeners.append(self.on_bond_event)
+        self.uart.listeners.append(self.on_gatt_line)
+
+    def query_settings(self, names) :
+        # Current value of each AT+NAME setting, None where the extender did not answer
+        cmds = ["AT+%s?" % name for name in names]
+        if self.uart.reader_thread and self.uart.window > 1 :
+            results = self.uart.transport_batch(cmds, timeout=5, expected="OK")
+            replies = [lines for ok, lines in split_replies(self.uart.full_response)]
+        else :
+            results = []
+            replies = []
+            for cmd in cmds :
+                results.append(self.uart.transport_msg(attempts=1, timeout=5, data=cmd, expected="OK"))
+                replies.append(([lines for ok, lines in split_replies(self.uart.full_response)] or [[]])[-1])
+        if len(replies) != len(cmds) :
+            # Replies out of step with the queries: trust none of them
+            return dict((name, None) for name in names)
+        return dict((name, setting_value(name, lines) if not err else None)
+                    for name, err, lines in zip(names, results, replies))
+
+    def reset_extender(self) :
+        start = monotonic()
+        err = self.uart.transport_msg(**self.reset_msg())
+        if err :
+            print("[CB_SETUP][ ] : extensor não anunciou \"%s\" após o reset" % READY_BANNER)
+        elif self.uart.metrics :
+            self.uart.metrics.observe("cb_reset_seconds", monotonic() - start)
+        return err
 
     def cb_setup(self) :
         print("[CB_SETUP][ ] : Setando as configurações necessárias para o extensor atuar como CB")
 
-        for i in progressbar.progressbar(range(len(self.setup_arr)), redirect_stdout=True) :
-            print("Comando %s enviado\n" % self.setup_arr[i])
-            self.uart.transport_msg(attempts=1, timeout=10, data=self.setup_arr[i], expected="OK")
-            if self.setup_arr[i] == 'AT+RESET' :
-                sleep(5)
+        settings = self.setup_settings()
+        current = self.query_settings([name for cmd, name, value in settings])
+        changed = self.changed_settings(settings, current)
+        if not changed :
+            # Nothing to store: no flash write and no reset
+            print("[CB_SETUP][X] : extensor já configurado")
+            return 0
+
+        for err in self.send_batch(changed) :
+            if err :
+                print("[CB_SETUP][ ] : falha ao configurar o extensor")
+                return err
+        if 'AT&W' in self.setup_arr :
+            err = self.uart.transport_msg(**self.save_msg())
+            if err :
+                print("[CB_SETUP][ ] : falha ao salvar a configuração")
+                return err
+        if 'AT+RESET' in self.setup_arr :
+            err = self.reset_extender()
+            if err :
+                return err
 
-        print("[CB_SETUP][X]")
+        print("[CB_SETUP][X] : %d de %d configurações alteradas" % (len(changed), len(settings)))
+        return 0
 
 
     def connect(self, addr) :
-        data = 'ATD'
-        data += addr
-        data += ',GATT'
-        return self.uart.transport_msg(attempts=1, timeout=10, data=data, expected="CONNECT")
+        start = monotonic()
+        err = self.uart.transport_msg(**self.connect_msg(addr))
+        if not err :
+            self.addr = addr
+            self.note(cb_telemetry.CONNECT, monotonic() - start, addr=addr)
+        return err
 
     def read_service(self, channel) :
         msg = 'AT+LEREAD=0x10,' + channel
         expected = 'LEREAD:0x10,' + channel
-        err = self.uart.transport_msg(attempts=2, timeout=10, data=msg, expected=expected)
+        return self.uart.transport_msg(attempts=2, timeout=10, data=msg, expected=expected)
+
+    def read_attributes(self) :
+        # One pipelined pass over every readable attribute; the listener fills the mirror.
+        # Protected ones wait for the bond, reading them earlier starts a pairing.
+        attributes = self.attributes.readable(bonded=self.addr in self.bonded)
+        results = self.uart.transport_batch([a.read_cmd() for a in attributes], timeout=10, expected="OK")
+        for attribute, err in zip(attributes, results) :
+            if err :
+                self.mirror().invalidate([attribute.name])
+        return next((err for err in results if err), 0)
+
+    def write_attributes(self, values) :
+        names, cmds = self.attribute_writes(values)
+        if not names :
+            if self.progress :
+                print("Atributos já configurados na isca!")
+            return 0
+        return self.attributes_written(names, values, self.send_batch(cmds))
 
     def set_times(self, static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time) :
-        time_msgs = ['AT+LEWRITE=0x10,' + STAT_SLEEP_TIME_ADDR + (",%04x" % static_sleep_time),
-                     'AT+LEWRITE=0x10,' + STAT_WAIT_TIME_ADDR + (",%04x" % static_wait_time),
-                     'AT+LEWRITE=0x10,' + DYN_SLEEP_TIME_ADDR + (",%04x" % dyn_sleep_time),
-                     'AT+LEWRITE=0x10,' + DYN_WAIT_TIME_ADDR + (",%04x" % dyn_wait_time)
-                     ]
-
-        for i in progressbar.progressbar(range(len(time_msgs)), redirect_stdout=True) :
-            print("Enviando comando %s\n" % time_msgs[i])
-            err = self.uart.transport_msg(attempts=1, timeout=10, data=time_msgs[i], expected="OK")
-            if err:
-                return err
+        values = self.time_values(static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time)
+        err = self.write_attributes(values)
+        if err :
+            return err
 
+        if self.registry and getattr(self, 'addr', None) :
+            self.registry.configured(self.addr, values)
         return 0
 
+    def send_batch(self, cmds) :
+        if not self.progress :
+            return self.uart.transport_batch(cmds, timeout=10, expected="OK")
+
+        bar = progressbar.ProgressBar(max_value=len(cmds), redirect_stdout=True)
+        answered = []
+
+        def on_result(idx, err) :
+            answered.append(idx)
+            print("Comando %s %s\n" % (cmds[idx], "enviado" if not err else "falhou"))
+            bar.update(len(answered))
+
+        results = self.uart.transport_batch(cmds, timeout=10, expected="OK", on_result=on_result)
+        bar.finish()
+        return results
+
+    def scan(self, target=None, timeout=20) :
+        # Returns as soon as target shows up in the scan instead of waiting for the final OK
+        self.scan_table.expire()
+        expected = FINAL_RESULT if not target else FINAL_RESULT + "|" + re.escape(target)
+        err = self.uart.transport_msg(attempts=1, timeout=timeout, data="AT+LESCAN=GATT", expected=expected)
+        if not FINAL_PAT.search(self.uart.full_response) :
+            self.stop_scan(timeout)
+        if self.registry :
+            for device in self.scan_table.baits() :
+                self.registry.seen(device.addr, device.name)
+        return err
+
+    def stop_scan(self, timeout) :
+        # The scan is still running (target seen early, or out of time): stop it and take both
+        # its final OK/ERROR and the stop's, so neither is read as the next command's reply
+        self.uart.transport_msg(attempts=1, timeout=timeout, data=SCAN_STOP_CMD, expected=FINAL_RESULT)
+        if len(FINAL_PAT.findall(self.uart.full_response)) < 2 :
+            self.uart.read_until_x(timeout, FINAL_RESULT)
+
     def show_baits(self) :
-        content = self.uart.full_response
-        content = content.replace('bro', '')
-        content = re.sub('\" [A-Z0-9]{4}', '', content)
-        content = content.replace('\"', '\b')
-        temp = content.split('\n')
-        content = ""
-        for x in temp :
-            content += x
-        content = content.split()
-
-        self.indexs = []
-        self.names = []
-        self.addrs = []
-
-        for i in range(len(content)) :
-            if len(re.findall("ISCA", content[i])) :
-                self.indexs.append(i)
-                self.names.append(content[i] + " " + content[i+1] + " " + content[i+2])
-
-        for x in self.indexs :
-            found = False
-            while not found and x > 0:
-                x -= 1
-                if len(re.findall("[A-Z0-9]{12},t2", content[x])) :
-                    self.addrs.append(content[x])
-                    found = True
-            if not x :
-                print("erro legal")
-
-        if len(self.indexs) :
-            for i in range(len(self.indexs)) :
-                print("%d: %s [%s]" % (i+1, self.addrs[i], self.names[i]))
+        baits = self.scan_table.baits()
+        self.indexs = list(range(len(baits)))
+        self.names = [d.name for d in baits]
+        self.addrs = [d.addr for d in baits]
+
+        if len(baits) :
+            for i, device in enumerate(baits) :
+                print("%d: %s [%s] %s" % (i+1, device.addr, device.name, "" if device.rssi == None else "%d dBm" % device.rssi))
         else :
             print("Nenhuma isca encontrada!")
 
-    def search_bait(self) :
+    def dial_known(self, addr, deadline=None) :
+        # A registry entry is only a hint: dial it until one sleep and wait of the bait went by,
+        # so a wake window was missed only if the address is stale
+        times = (self.registry.get(addr) or {}).get('times', {})
+        sleep_time = times.get('static_sleep_time', 0)
+        until = monotonic() + sleep_time + times.get('static_wait_time', 0)
+        err = self.reconnect(addr, self.predictor(addr, sleep_time), learn=False,
+                             deadline=until if deadline == None else min(until, deadline))
+        if not err :
+            self.actual_state = CB_CONNECTED
+            self.dialed = addr
+        return err
+
+    def find_target(self, target, deadline=None) :
+        # A bait already in the registry is dialled first, otherwise (or if it does not answer)
+        # scan until it shows up
+        addr = self.registry.resolve(target) if self.registry else None
+        if addr :
+            print("Isca %s conhecida: %s, conectando..." % (target, addr))
+            if not self.dial_known(addr, deadline) :
+                return addr
+            print("Isca %s não respondeu em %s" % (target, addr))
+        print("[PESQUISANDO][ ]: Procurando a isca %s" % target)
+        device = self.scan_table.find(target)
+        scans = 0
+        while not device :
+            if self.stopped() :
+                return ""
+            if (deadline != None and monotonic() >= deadline) or (self.scan_attempts and scans >= self.scan_attempts) :
+                print("[PESQUISANDO][ ]: Isca %s não encontrada" % target)
+                return ""
+            self.scan(target=target, timeout=20 if deadline == None else max(1, min(20, deadline - monotonic())))
+            scans += 1
+            device = self.scan_table.find(target)
+        print("[PESQUISANDO][X]: %s [%s]" % (device.addr, device.name))
+        return device.addr
+
+    def take_dialed(self) :
+        # True once if the search left the link to the chosen bait up
+        addr, self.dialed = self.dialed, None
+        return addr != None and addr == self.addr and self.actual_state == CB_CONNECTED
+
+    def search_bait(self, deadline=None) :
+        if self.target :
+            return self.find_target(self.target, deadline)
+
         print("[PESQUISANDO][ ]: Por favor, escolha o endereço da isca ao fim da pesquisa")
         addr = ""
         end = False
         while(not end) :
-            self.uart.transport_msg(attempts=1, timeout=20, data="AT+LESCAN=GATT")
+            self.scan()
             self.show_baits()
             print("Digite o índice da isca a ser escolhida ou -1 para continuar pesquisando")
             idx = int(input("ÍNDICE: "))
@@ -248,285 +1069,380 @@ class Simulation :
         return addr
 
     def send_tid(self, expected=None) :
-        tid_msg = 'AT+LEWRITE=0x10,' + TID_ADDR + (",000F")
-        self.actual_state = CB_DISCONNECT
-        self.now_tid = int(time())
-        if expected == None :
-            return self.uart.transport_msg(attempts=1, timeout=10, data=tid_msg, expected="NO CARRIER")
-        else :
-            return self.uart.transport_msg(attempts=1, timeout=10, data=tid_msg, expected=expected)
-
-    def change_mode(self, mode) :
-        opmodectrl_msg = 'AT+LEWRITE=0x10,' + OP_MODE_CTRL_ADDR + "," + mode
-        return self.uart.transport_msg(attempts=2, timeout=10, data=opmodectrl_msg, expected="OK")
-
-    def super_static(self) :
-        sleep_time = int(input("Type the sleep static time that you want: "))
-        wait = int(input("Type the wait static time that you want: "))
-        it_to_finish = int(input("Type the number of iterations to trip finish: "))
-        end = False
-
-        while not end :
-            try : 
-                addr = self.search_bait()
-
-                err = self.connect(addr)
-                if (err) :
-                    print("Error connecting to bait")
-                    return err
-
-                err = self.set_times(sleep_time=sleep_time, wait=wait)
-                if (err) :
-                    print("Error setting times")
-                    return err
-
-                err = self.change_mode("01")
-                if (err) :
-                    print("Error changing to supervised static mode")
-                    return err
-
-                while(it_to_finish > 0) :
-                    self.send_tid()
-                    now = int(time())
-                    print("Waiting for wakeup bait...\nsleep_time = %d\nnow = %d\nnow_tid = %d\ndiff = %d" % (sleep_time, now, self.now_tid, now - self.now_tid))
-                    waiting_bait = sleep_time - (now - self.now_tid) if sleep_time - (now - self.now_tid) > 0 else 0
-                    sleep(waiting_bait)
-                    self.connect(addr)
-                    it_to_finish -= 1
-
-                self.change_mode("00")
-                end = True
+        start = monotonic()
+        err = self.uart.transport_msg(**self.tid_msg(expected))
+        if not err and expected == None :
+            # TID written until the bait dropped the link to sleep
+            self.note(cb_telemetry.TID, monotonic() - start)
+        return err
+
+    def wait_bait(self, sleep_time, deadline=None) :
+        return self.wait_until(self.now_tid + sleep_time, deadline)
+
+    def wait_until(self, when, deadline=None) :
+        # Cut short by the deadline (monotonic), then the wait failed
+        waiting_bait = when - time()
+        if deadline != None and waiting_bait > deadline - monotonic() :
+            self.nap(max(0, deadline - monotonic()))
+            return ATTEMPTS_FAILED
+        if waiting_bait > 0 :
+            if not self.nap(waiting_bait) :
+                return ATTEMPTS_FAILED
+            if self.uart.metrics :
+                self.uart.metrics.observe("cb_bait_wait_seconds", waiting_bait, mode=self.mode)
+        return 0
 
-                err = self.disconnect("0x10")
-                if (err) :
-                    print("Error disconnecting to bait")
-                    return err
-                print("Test performed successfully")
+    def reconnect(self, addr, predictor, learn=True, deadline=None) :
+        # Dials until the bait answers or the deadline (monotonic) passes, backing off with
+        # jitter between failed attempts
+        lost = 0
+        while True :
+            if self.stopped() :
+                return ATTEMPTS_FAILED
+            attempt = time()
+            err = self.connect(addr)
+            if not err :
+                self.bait_connected(addr, predictor, self.now_tid if learn else None, attempt)
+                if lost :
+                    self.events.emit(RECOVERED, addr=addr, attempts=lost)
+                return 0
+            if err == ISCA_LOST :
+                print("Isca perdida, tentando reconectar...")
+                self.nisca_lost += 1
+                lost += 1
+                self.bait_lost(addr, self.nisca_lost)
+            if deadline != None and monotonic() >= deadline :
+                return err if err == ISCA_LOST else ATTEMPTS_FAILED
+            self.nap(self.backoff_delay(predictor, deadline))
 
-            except UnexpectedDisconnect as ud:
-                print("Unexpected disconnect")
-                print("Repeating routine...")
-                
+    def change_mode(self, mode) :
+        err = self.uart.transport_msg(**self.mode_msg(mode))
+        self.mode_written()
+        return err
 
     def disconnect(self, channel) :
-        msg = 'ATH=' + channel
-        return self.uart.transport_msg(attempts=2, timeout=10, data=msg, expected="NO CARRIER|OK")
+        return self.uart.transport_msg(**self.disconnect_msg(channel))
         
-    def recover_dyn(self) :
-        sleep_time = int(input("Type the last sleep static time: "))
-        wait = int(input("Type the last wait static time: "))
-        it_to_finish = int(input("Type the number of iterations to trip finish: "))
-        end = False
-
-        err = self.disconnect("0x10")
-        if (err) :
-            print("Error disconnecting to bait")
-            return err
-
-        while (not end) :
-            try : 
-                addr = self.search_bait()
-                err = self.connect(addr)
-                if (err) :
-                    print("Error connecting to bait")
-                    return err
-
-                self.send_tid("OK")
-
-                while (it_to_finish) :
-                    self.send_tid()
-                    print("Waiting for wakeup bait...")
-                    now = int(time())
-                    waiting_bait = sleep_time - (now - self.now_tid) if sleep_time - (now - self.now_tid) > 0 else 0
-                    sleep(waiting_bait)
-                    self.connect(addr)
-                    it_to_finish -= 1
-
-                self.change_mode("00")
-                err = self.disconnect("0x10")
-                if (err) :
-                    print("Error disconnecting to bait")
-                    return err
-                end = True
-                print("Test performed successfully")
-            except UnexpectedDisconnect as ud :
-                print("Unexpected disconnect")
-                print("Repeating routine...")
-                
-
-
-    def bait_lost(self) :
-        sleep_time = int(input("Type the sleep static time that you want: "))
-        wait = int(input("Type the wait static time that you want: "))
-        static_it = int(input("Max static iterations: "))
-        lost_time = int(input("Type the lost time: "))
-        it_to_finish = int(input("Type the number of iterations to trip finish: "))
-        end = False
-
-        while not end :
-            try :
-                err = self.disconnect("0x10")
-                if (err) :
-                    print("Error disconnecting to bait")
-                    return err
-
-                addr = self.search_bait()
-
-                err = self.connect(addr)
-                if (err) :
-                    print("Error connecting to bait")
-                    return err
-
-                err = self.set_times(sleep_time=sleep_time, wait=wait)
-                if (err) :
-                    print("Error setting times")
-                    return err
-
-                err = self.change_mode("01")
-                if (err) :
-                    print("Error changing to supervised static mode")
-                    return err
-
-                while(static_it > 0) :
-                    self.send_tid()
-                    print("Waiting for wakeup bait...")
-                    now = int(time())
-                    waiting_bait = sleep_time - (now - self.now_tid) if sleep_time - (now - self.now_tid) > 0 else 0
-                    sleep(waiting_bait)
-                    self.connect(addr)
-                    static_it -= 1
-
-
-                err = self.disconnect("0x10")
-                if (err) :
-                    print("Error disconnecting to bait")
-                    return err
-
-                print("Bait lost...")
-                sleep(lost_time)
-                print("Let's save it")
-
-                addr = self.search_bait()
-
-                err = self.connect(addr)
-                if (err) :
-                    print("Error connecting to bait")
-                    return err
-
-                self.send_tid("OK")
-
-                while (it_to_finish > 0) :
-                    self.send_tid()
-                    print("Waiting for wakeup bait...")
-                    now = int(time())
-                    waiting_bait = sleep_time - (now - self.now_tid) if sleep_time - (now - self.now_tid) > 0 else 0
-                    sleep(waiting_bait)
-                    self.connect(addr)
-                    it_to_finish -= 1
-
-                self.change_mode("00")
-
-                err = self.disconnect("0x10")
-                if (err) :
-                    print("Error disconnecting to bait")
-                    return err
-                
-                print("Test performed successfully")
-                end = True
-            except UnexpectedDisconnect as ud :
-                print("Unexpected disconnect")
-                print("Repeating routine...")
+    def extender_id(self) :
+        # Bonds live in the extender, so the cache is keyed by its own BD address
+        if self.extender == None :
+            self.extender = self.uart.port
+            if not self.uart.transport_msg(attempts=1, timeout=5, data="AT+BOAD", expected="OK") :
+                match = BD_ADDR_PAT.search(self.uart.full_response)
+                if match :
+                    self.extender = match.group(1).upper()
+        return self.extender
+
+    def on_bond_event(self, line) :
+        # Runs on the thread that reads the port: only touches the cache, a worker writes it
+        match = BOND_EVENT_PAT.search(line) or SSPPIN_PAT.search(line)
+        if not match or self.extender == None :
+            return
+        if match.re is BOND_EVENT_PAT and match.group(1) == "BNDSUCCESS" :
+            self.bonds.mark(self.extender, match.group(2).upper(), later=True)
+        else :
+            # A failure, or a passkey prompt for a bait we thought was bonded
+            addr = match.group(2) if match.re is BOND_EVENT_PAT else match.group(1).split(",")[0]
+            self.bonds.invalidate(self.extender, addr.upper(), later=True)
 
     def bounding(self) :
         addr = self.addr
         addr = addr.replace(",t2", "")
+        if self.bonds and self.bonds.is_bonded(self.extender_id(), addr) :
+            print("Processo de bound já foi realizado com a isca %s!" % addr)
+            self.bonded.add(self.addr)
+            return 0
+
         print("Verificando se o processo de bound já foi realizado com a isca %s..." % addr)
         msg = "AT+BNDLIST"
-        if self.uart.transport_msg(attempts=1, timeout=5, data=msg, expected=addr) :
+        err = self.uart.transport_msg(attempts=1, timeout=5, data=msg, expected=addr + "|OK")
+        if err or addr not in self.uart.full_response :
             print("Iniciando processo de bound com a isca...")
             msg = "AT+LEREAD=0x10,0x0033"
-            self.uart.transport_msg(attempts=2, timeout=50, data=msg, expected="OK")
+            err = self.uart.transport_msg(attempts=2, timeout=50, data=msg, expected="BNDSUCCESS|OK")
+            if err :
+                print("Falha no bound com a isca!")
+                if self.bonds :
+                    self.bonds.invalidate(self.extender_id(), addr)
+                return err
             print("Bound realizado com sucesso!")
         else :
             print("Processo de bound já foi realizado!")
+        if self.bonds :
+            self.bonds.mark(self.extender_id(), addr)
+        self.bonded.add(self.addr)
+        return 0
 
-    def bait_in_field(self) :
-        print("Limpando buffer...")
-        while self.uart.read_until_x() :
-            pass
-        print("Buffer limpo!")
+    def choose_baits(self) :
+        print("[PESQUISANDO][ ]: Por favor, escolha as iscas ao fim da pesquisa")
+        addrs = []
+        while not addrs :
+            self.scan()
+            self.show_baits()
+            print("Digite os índices separados por vírgula, 0 para todas ou -1 para continuar pesquisando")
+            idxs = input("ÍNDICES: ").strip()
+            if idxs == "0" :
+                addrs = list(self.addrs)
+            elif idxs != "-1" :
+                addrs = [self.addrs[int(i) - 1] for i in idxs.split(",")]
+        print("[PESQUISANDO][X]")
+
+        return addrs
 
+    def multi_bait(self) :
         print("Desconectando de possíveis antigas conexões...")
         self.disconnect("0x10")
-        print("Extensor desconectado de todas as suas conexões!")
 
-        self.addr = self.search_bait()
+        addrs = self.choose_baits()
         static_sleep_time = int(input("Tempo de suspensão da isca no modo estático: "))
         static_wait_time = int(input("Tempo de espera da isca no modo estático: "))
         dyn_sleep_time = int(input("Tempo de suspensão da isca no modo dinâmico: "))
         dyn_wait_time = int(input("Tempo de espera da isca no modo dinâmico: "))
-        nisca_lost = 0
-        end = False
-        setup = True
-        self.actual_state = CB_DISCONNECT
-
-        while not end :
+        cycles = int(input("Número de ciclos por isca (0 para infinito): "))
+
+        scheduler = BaitScheduler(self, static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time)
+        for addr in addrs :
+            scheduler.add(addr)
+        return scheduler.run(cycles)
+
+    def ota_start(self, size, crc) :
+        # Opens (or reopens) the transfer and returns the offset the bait already committed
+        msg = 'AT+LEWRITE=0x10,' + OTA_CTRL_ADDR + (",01%08X%08X" % (size, crc))
+        # An ERROR here is a dead link, not a reply worth waiting the timeout out for
+        err = self.uart.transport_msg(attempts=2, timeout=10, data=msg, expected="OK|ERROR")
+        if err or "ERROR" in self.uart.full_response :
+            return err or ATTEMPTS_FAILED, 0
+        msg = 'AT+LEREAD=0x10,' + OTA_STATUS_ADDR
+        err = self.uart.transport_msg(attempts=2, timeout=10, data=msg, expected="OK")
+        status = OTA_STATUS_PAT.search(self.uart.full_response)
+        if err or not status :
+            return err or ATTEMPTS_FAILED, 0
+        return 0, int(status.group(1), 16)
+
+    def ota_blocks(self, data, offset, chunk, block) :
+        # Data writes of each block followed by its commit, which the bait only acks if the CRC matches
+        cmds = []
+        commits = {}
+        view = memoryview(data)
+        for start in range(offset, len(data), block) :
+            end = min(start + block, len(data))
+            for pos in range(start, end, chunk) :
+                cmds.append('AT+LEWRITE=0x10,' + OTA_DATA_ADDR + (",%08X" % pos) + view[pos:min(pos + chunk, end)].hex().upper())
+            cmds.append('AT+LEWRITE=0x10,' + OTA_CTRL_ADDR + (",02%08X%04X%04X" % (start, end - start, binascii.crc_hqx(view[start:end], 0xFFFF))))
+            commits[len(cmds) - 1] = end
+        return cmds, commits
+
+    def ota_update(self, image, chunk=OTA_CHUNK, block=OTA_BLOCK) :
+        data = image.read(image.base, image.ranges()[-1][1] - image.base)
+        crc = binascii.crc32(data)
+        predictor = self.predictor(self.addr, 0)
+        acked = [0]
+        start = monotonic()
+        resumes = 0
+        stalls = 0
+        while True :
             try :
-                print("Tentando conectar à isca...")
-                while(self.connect(self.addr)) :
-                    print("Tentando conectar à isca...")
-
+                err, offset = self.ota_start(len(data), crc)
+                if err :
+                    # The link may have dropped with the NO CARRIER swallowed by an earlier reply
+                    stalls += 1
+                    if stalls >= OTA_RETRIES :
+                        return err
+                    self.disconnect("0x10")
+                    raise UnexpectedDisconnect("OTA start failed")
+                acked[0] = offset
+                if offset >= len(data) :
+                    break
+                print("[OTA][ ] : 0x%08X/0x%08X" % (offset, len(data)))
+                cmds, commits = self.ota_blocks(data, offset, chunk, block)
+
+                def on_result(idx, err) :
+                    if idx in commits and not err :
+                        acked[0] = commits[idx]
+
+                # Everything after a rejected commit is wasted, ota_start tells where to resume
+                self.uart.transport_batch(cmds, timeout=10, expected="OK", on_result=on_result, stop_on=commits,
+                                          cancel=self.cancel)
+                if self.cancel.is_set() :
+                    print("[OTA][ ] : interrompido em 0x%08X" % acked[0])
+                    return ATTEMPTS_FAILED
+                if acked[0] == offset :
+                    stalls += 1
+                    if stalls >= OTA_RETRIES :
+                        print("[OTA][ ] : sem progresso em 0x%08X" % offset)
+                        return ATTEMPTS_FAILED
+                else :
+                    stalls = 0
+            except UnexpectedDisconnect :
+                print("[OTA][ ] : conexão perdida em 0x%08X, retomando..." % acked[0])
+                resumes += 1
+                self.actual_state = CB_DISCONNECT
+                if self.uart.metrics :
+                    self.uart.metrics.inc("cb_ota_resumes_total")
+                # Let the replies of writes still in flight drain before dialing again
+                sleep(RETRY_DELAY)
+                self.uart.read_until_x()
+                if self.reconnect(self.addr, predictor, learn=False) :
+                    return ATTEMPTS_FAILED
                 self.actual_state = CB_CONNECTED
-                print("CB conectado à Isca!")
 
-                if setup :
+        msg = 'AT+LEWRITE=0x10,' + OTA_CTRL_ADDR + ",03"
+        err = self.uart.transport_msg(attempts=1, timeout=30, data=msg, expected="OK")
+        # New firmware, nothing we knew about the bait's attributes still holds
+        self.mirror().invalidate()
+        elapsed = monotonic() - start
+        if self.uart.metrics :
+            self.uart.metrics.observe("cb_ota_seconds", elapsed)
+            self.uart.metrics.inc("cb_ota_bytes_total", len(data))
+        print("[OTA][%s] : %d bytes em %.1fs (%.0f B/s), %d retomadas" %
+              (" " if err else "X", len(data), elapsed, len(data) / elapsed if elapsed else 0, resumes))
+        return err
+
+    def load_firmware(self) :
+        # None if the image cannot be read or is not valid Intel HEX
+        try :
+            return FirmwareImage.load(self.firmware)
+        except (OSError, HexError) as e :
+            print("[OTA][ ] : %s" % e)
+            return None
 
-                    self.bounding()
+    def bait_ota(self) :
+        image = self.load_firmware()
+        if image == None :
+            return ATTEMPTS_FAILED
+        print("[OTA][ ] : %s, %d bytes, reset handler 0x%08X" % (self.firmware, image.size, image.reset_handler))
 
-                    print("Configurando tempos da isca...")
-                    err = self.set_times(static_sleep_time=static_sleep_time, static_wait_time=static_wait_time,
-                                         dyn_sleep_time=dyn_sleep_time, dyn_wait_time=dyn_wait_time)
-                    if (err) :
-                        print("Error setting times")
-                        return err
-                    print("Tempos configurados com sucesso!")
+        self.disconnect("0x10")
+        self.addr = self.search_bait()
+        if not self.addr :
+            return ATTEMPTS_FAILED
+        print("Tentando conectar à isca...")
+        if not self.take_dialed() and self.reconnect(self.addr, self.predictor(self.addr, 0), learn=False) :
+            return ATTEMPTS_FAILED
+        self.actual_state = CB_CONNECTED
+        self.bounding()
+        err = self.ota_update(image)
+        self.disconnect("0x10")
+        self.actual_state = CB_DISCONNECT
+        return err
 
-                    err = self.change_mode("01")
-                    if (err) :
-                        print("Error changing to supervised static mode")
-                        return err
+    def scenario_actions(self) :
+        # Everything a scenario state may call, all returning 0 or an error code. Actions that
+        # block give up at the deadline of the state's timeout, which the machine maps to 'timeout'
+        def deadline() :
+            return self.machine.deadline if self.machine else None
 
-                    print("Mudando para o modo estático!")
-
-                    normal = False
-
-                while(True) :
-                    print("Tentando estabelecer comunicação via TID...")
-                    while self.send_tid() :
-                        pass
-                    print("Comunicação estabelecida com sucesso!\nConexão perdida com a isca!")
-                    now = int(time())
-                    print("Isca entrou em modo low power, esperando ela acordar para tentar conexão...")
-                    waiting_bait = static_sleep_time - (now - self.now_tid) if static_sleep_time - (now - self.now_tid) > 0 else 0
-                    sleep(waiting_bait)
-                    print("Tentando conectar com a isca...")
-                    err = self.connect(self.addr)
-                    while err :
-                        if err == ISCA_LOST :
-                            print("Isca perdida, tentando reconectar...")
-                            nisca_lost = 1
-                        err = self.connect(self.addr)
-                    print("CB conectado à isca!")
-                    self.actual_state = CB_CONNECTED
-                            
-            except UnexpectedDisconnect as ud :
-                print("Isca perdida!!!")
-                nisca_lost = 1
-        
+        def search() :
+            self.addr = self.search_bait(deadline())
+            return 0 if self.addr else ATTEMPTS_FAILED
+
+        def connect() :
+            if self.take_dialed() :
+                return 0
+            err = self.connect(self.addr)
+            if not err :
+                self.actual_state = CB_CONNECTED
+            return err
+
+        def reconnect(sleep_time=0, learn=False) :
+            if self.take_dialed() :
+                return 0
+            err = self.reconnect(self.addr, self.predictor(self.addr, sleep_time), learn, deadline())
+            if not err :
+                self.actual_state = CB_CONNECTED
+            return err
+
+        def ensure_connected(sleep_time=0, wait_time=0) :
+            # done: no bait was chosen yet, there is no trip to finish
+            if not self.addr :
+                return 'done'
+            if self.actual_state == CB_CONNECTED :
+                return 0
+            # Runs in the stop chain: a bait that did not answer within one sleep and wait
+            # is gone, the trip cannot be finished
+            until = monotonic() + sleep_time + wait_time
+            limit = deadline()
+            err = self.reconnect(self.addr, self.predictor(self.addr, sleep_time), False,
+                                 until if limit == None else min(until, limit))
+            if not err :
+                self.actual_state = CB_CONNECTED
+            return err
+
+        def disconnect(channel="0x10") :
+            self.actual_state = CB_DISCONNECT
+            return self.disconnect(channel)
+
+        def wait_wake(sleep_time) :
+            return self.wait_until(self.predictor(self.addr, sleep_time).next_attempt(self.now_tid), deadline())
+
+        def wait_bait(sleep_time) :
+            return self.wait_bait(sleep_time, deadline())
+
+        def ota() :
+            # A bad image is a failed state like any other, the scenario still ends the trip
+            image = self.load_firmware()
+            return ATTEMPTS_FAILED if image == None else self.ota_update(image)
+
+        return {'search': search,
+                'connect': connect,
+                'reconnect': reconnect,
+                'ensure_connected': ensure_connected,
+                'disconnect': disconnect,
+                'bounding': self.bounding,
+                'set_times': self.set_times,
+                'read_attributes': self.read_attributes,
+                'change_mode': self.change_mode,
+                'send_tid': self.send_tid,
+                'wait_bait': wait_bait,
+                'wait_wake': wait_wake,
+                'ota': ota}
+
+    def run_scenario(self, name) :
+        spec = load_scenario(name)
+        self.machine = StateMachine(spec, self.scenario_actions(), outcomes=OUTCOMES,
+                                    disconnect=(UnexpectedDisconnect,), metrics=self.uart.metrics)
+        return self.machine.run(self.params)
+
+    def stop(self) :
+        # Scenarios end through their stop states, in-code modes give up at the next check
+        if self.machine :
+            self.machine.stop()
+        else :
+            self.cancel.set()
+
+    def stopped(self) :
+        # cancel ends everything, a scenario stop only the states before its stop chain
+        return self.cancel.is_set() or (self.machine != None and self.machine.stop_requested())
+
+    def nap(self, seconds) :
+        # Sleeps in STOP_POLL slices, False if stopped meanwhile
+        end = monotonic() + seconds
+        while not self.stopped() :
+            left = end - monotonic()
+            if left <= 0 :
+                return True
+            sleep(min(left, STOP_POLL))
+        return False
 
     def run(self) :
+        if self.telemetry != None :
+            self.telemetry.start_trip(self.mode)
         if self.setup :
-            self.cb_setup()
+            err = self.cb_setup()
+            if err :
+                # No trip on an extender that is not set up as CB
+                print("[CB_SETUP][ ] : viagem abortada (%s)" % OUTCOMES.get(err, err))
+                return err
+        # After the setup: its reset brings the extender back to the rate it boots with
+        if self.uart_baud :
+            self.uart.negotiate_baud(self.uart_baud)
+
+        if self.mode not in self.scenario :
+            try :
+                return self.run_scenario(self.mode)
+            except ScenarioError as e :
+                print("[SCENARIO][ ] : %s" % e)
+                return ATTEMPTS_FAILED
 
         # data = 'AT+LESRVD=0x10,u00000001100020003000111122223333'
         # data = self.uart.mount_msg('w', data)
@@ -538,7 +1454,7 @@ class Simulation :
             # pass
 
         try : 
-            self.scenario[self.mode]()
+            return self.scenario[self.mode]()
         except KeyboardInterrupt :
             if self.actual_state == CB_CONNECTED :
                 print("Encerrando viagem...")
@@ -549,12 +1465,9 @@ class Simulation :
 
             elif self.actual_state == CB_DISCONNECT :
                 print("Isca desconectada, tentando conectar com a isca para finalizar viagem...")
-                err = self.connect(self.addr)
-                while err :
-                    if err == ISCA_LOST :
-                        print("Isca perdida, tentando reconectar...")
-                        nisca_lost = 1
-                    err = self.connect(self.addr)
+                if self.reconnect(self.addr, self.predictor(self.addr, 0), learn=False, deadline=monotonic() + TIMEOUT) :
+                    print("Isca não respondeu, viagem não encerrada")
+                    return ATTEMPTS_FAILED
                 print("CB conectado à isca!")
                 print("Encerrando viagem...")
                 self.change_mode("00")
@@ -562,27 +1475,216 @@ class Simulation :
                 self.disconnect("0x10")
                 print("Desconectando da isca!")
 
+class WakePredictor :
+    # Learns the real TID-to-wake period of one bait from CONNECT timestamps
+    def __init__(self, nominal, alpha=0.25) :
+        self.nominal = nominal
+        self.period = float(nominal)
+        self.deviation = 0.0
+        self.alpha = alpha
+        self.samples = 0
+        self.failures = 0
+
+    @property
+    def drift(self) :
+        return (self.period - self.nominal) / self.nominal if self.nominal else 0.0
+
+    def next_attempt(self, tid_time) :
+        # Dial a little ahead of the predicted wake; the extender holds ATD until the bait answers
+        return tid_time + self.period - max(WAKE_LEAD, 2 * self.deviation)
+
+    def observe(self, tid_time, attempt_time, connect_time) :
+        self.failures = 0
+        observed = connect_time - tid_time
+        if connect_time - attempt_time < WAKE_LEAD / 2 :
+            # Connected at once: the bait was already awake, observed is only an upper bound
+            if observed < self.period :
+                self.period += self.alpha * (observed - self.period)
+            return
+        error = observed - self.period
+        self.period += self.alpha * error
+        self.deviation += self.alpha * (abs(error) - self.deviation)
+        self.samples += 1
+
+    def backoff(self) :
+        self.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1))
+        return random.uniform(delay / 2, delay)
+
+
+class BaitScheduler :
+    # Serves many baits from one CB: a heap keeps them ordered by predicted wake time
+    def __init__(self, sim, static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time) :
+        self.sim = sim
+        self.times = (static_sleep_time, static_wait_time, dyn_sleep_time, dyn_wait_time)
+        self.static_sleep_time = static_sleep_time
+        self.heap = []
+        self.baits = {}
+        self.seq = itertools.count()
+
+    def add(self, addr, wake=None) :
+        self.baits[addr] = {'setup': True, 'cycles': 0, 'lost': 0, 'tid': None,
+                            'predictor': self.sim.predictor(addr, self.static_sleep_time)}
+        self.schedule(addr, monotonic() if wake == None else wake)
+
+    def schedule(self, addr, wake) :
+        heapq.heappush(self.heap, (wake, next(self.seq), addr))
+
+    def next_due(self) :
+        return self.heap[0][0] if self.heap else None
+
+    def run(self, cycles=0) :
+        while self.heap :
+            if self.sim.stopped() :
+                print("Viagens interrompidas")
+                return ATTEMPTS_FAILED
+            delay = self.next_due() - monotonic()
+            if delay > 0 :
+                if not self.sim.nap(delay) :
+                    continue
+                if self.sim.uart.metrics :
+                    self.sim.uart.metrics.observe("cb_bait_wait_seconds", delay, mode=self.sim.mode)
+            wake, _, addr = heapq.heappop(self.heap)
+            try :
+                wake = self.service(addr, cycles)
+            except UnexpectedDisconnect :
+                print("Isca %s perdida!!!" % addr)
+                self.baits[addr]['lost'] += 1
+                self.sim.bait_lost(addr, self.baits[addr]['lost'])
+                self.sim.actual_state = CB_DISCONNECT
+                wake = monotonic() + self.sim.backoff_delay(self.baits[addr]['predictor'])
+            if wake != None :
+                self.schedule(addr, wake)
+
+        return 0
+
+    def service(self, addr, cycles) :
+        bait = self.baits[addr]
+        predictor = bait['predictor']
+        self.sim.addr = addr
+        attempt = time()
+        err = self.sim.connect(addr)
+        if err :
+            if err == ISCA_LOST :
+                bait['lost'] += 1
+                self.sim.bait_lost(addr, bait['lost'])
+            # Not awake yet: give the radio to the next due bait and come back
+            return monotonic() + self.sim.backoff_delay(predictor)
+        self.sim.bait_connected(addr, predictor, bait['tid'], attempt)
+        self.sim.actual_state = CB_CONNECTED
+
+        if bait['setup'] :
+            self.sim.bounding()
+            err = self.sim.set_times(*self.times)
+            if not err :
+                err = self.sim.change_mode("01")
+            if err :
+                print("Erro configurando a isca %s" % addr)
+                self.sim.disconnect("0x10")
+                return monotonic() + RETRY_DELAY
+            bait['setup'] = False
+
+        if cycles and bait['cycles'] >= cycles :
+            print("Encerrando viagem da isca %s..." % addr)
+            self.sim.change_mode("00")
+            self.sim.disconnect("0x10")
+            self.sim.actual_state = CB_DISCONNECT
+            return None
+
+        if self.sim.send_tid() :
+            self.sim.disconnect("0x10")
+        self.sim.actual_state = CB_DISCONNECT
+        bait['cycles'] += 1
+        bait['tid'] = self.sim.now_tid
+        print("Isca %s dormindo, próximo despertar em %.1fs" % (addr, predictor.period))
+        return monotonic() + predictor.next_attempt(self.sim.now_tid) - time()
+
+
 def main() :
     parser = argparse.ArgumentParser(description='Tracker working as CB')
-    parser.add_argument('-b', '--baudrate', default=115200,
-                        help='UART baudrate')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200,
+                        help='UART baudrate the extender is at when the port opens')
+    parser.add_argument('--uart-baud', type=int, default=0,
+                        help='Negotiate up to this UART baudrate after opening the port (%s), 0 keeps it' %
+                             ", ".join(str(b) for b in BAUD_RATES))
     parser.add_argument('-p', '--port', type=str,
                         help='Port of UART device', default="/dev/ttyUSB0")
     parser.add_argument('-m', '--mode', type=str,
-                        help='Simulation mode', default="")
+                        help='multi, ota, or a scenario name (%s) / file' % ", ".join(available_scenarios()), default="field")
+    parser.add_argument('-P', '--param', type=str, action='append', default=[],
+                        help='Scenario parameter as name=value, may be repeated')
     parser.add_argument('-s', '--setup', default=0,
                         help='Enable the setup to extensor work as CB')
     parser.add_argument('-v', '--verbose', default=0,
                         help='Simulation verbose')
+    parser.add_argument('-r', '--reader', default=0,
+                        help='Drain the UART from a dedicated reader thread')
+    parser.add_argument('-w', '--window', type=int, default=PIPELINE_WINDOW,
+                        help='Commands kept in flight by batched writes (reader mode only)')
+    parser.add_argument('--bond-cache', type=str, default=BOND_CACHE_PATH,
+                        help='Bond cache file, empty to always ask the extender')
+    parser.add_argument('-a', '--bait', type=str, default=None,
+                        help='Target bait address or name, skips the interactive choice')
+    parser.add_argument('--registry', type=str, default=BAIT_REGISTRY_PATH,
+                        help='Known-bait registry file, empty to disable')
+    parser.add_argument('--scan-attempts', type=int, default=SCAN_ATTEMPTS,
+                        help='Scans for the target bait (-a) before giving up, 0 scans forever')
+    parser.add_argument('-f', '--firmware', type=str, default=FIRMWARE_PATH,
+                        help='Intel HEX image streamed to the bait in ota mode')
+    parser.add_argument('--record', type=str, default=None,
+                        help='Record every byte on the UART to this session log (see cb_session/cb_replay)')
+    parser.add_argument('-c', '--config', type=str, default=None,
+                        help='JSON file with defaults for any of these options')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Export timing metrics here on exit and on SIGUSR1 (.json or Prometheus text)')
+    parser.add_argument('--telemetry', type=str, default=None,
+                        help='Append trip telemetry (connects, TIDs, wake periods, losses, battery) to this file')
+    parser.add_argument('--events', type=str, default=None,
+                        help='Append the structured event log (commands, replies, state changes) here as JSON lines')
+    parser.add_argument('--crash-dump', type=str, default=CRASH_DUMP_PATH,
+                        help='Where the last events are saved if the simulation crashes')
     args = parser.parse_args(sys.argv[1:])
+    if args.config :
+        with open(args.config) as f :
+            parser.set_defaults(**json.load(f))
+        args = parser.parse_args(sys.argv[1:])
 
     print("**************************************")
     print("*       Tracker as Control Board     *")
     print("**************************************")
 
-    uart = UartDriver(baud=args.baudrate, port=args.port, verbose=args.verbose)
-    s = Simulation(uart=uart, mode=args.mode, setup=int(args.setup))
-    s.run()
+    metrics = Metrics() if args.metrics else None
+    if metrics :
+        # The handler runs on the main thread, maybe inside inc()/observe() holding the metrics
+        # lock: the dump waits for it on its own thread instead of deadlocking
+        signal.signal(signal.SIGUSR1, lambda signum, frame : threading.Thread(
+            target=metrics.dump, args=(args.metrics,), name="metrics-dump", daemon=True).start())
+
+    events = EventLog(path=args.events, console=bool(int(args.verbose)))
+    events.install_crash_dump(args.crash_dump)
+    uart = UartDriver(baud=args.baudrate, port=args.port, verbose=args.verbose, reader=args.reader,
+                      window=args.window, metrics=metrics, record=args.record, events=events)
+    bonds = BondCache(args.bond_cache) if args.bond_cache else None
+    registry = BaitRegistry(args.registry) if args.registry else None
+    try :
+        params = parse_params(args.param)
+    except ScenarioError as e :
+        parser.error(str(e))
+    telemetry = TelemetryStore(args.telemetry) if args.telemetry else None
+    s = Simulation(uart=uart, mode=args.mode, setup=int(args.setup), bonds=bonds, registry=registry, target=args.bait,
+                   firmware=args.firmware, params=params, telemetry=telemetry)
+    s.uart_baud = args.uart_baud
+    s.scan_attempts = args.scan_attempts
+    try :
+        s.run()
+    finally :
+        uart.close()
+        if bonds :
+            bonds.flush()
+        if telemetry != None :
+            telemetry.close()
+        if metrics :
+            metrics.dump(args.metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+import pytest
+
+from cb_emulator import CbEmulator
+from simulate_cb import UartDriver, Simulation
+
+
+@pytest.fixture
+def emulator() :
+    emulator = CbEmulator(seed=1, scan_time=0.3)
+    yield emulator
+    emulator.stop()
+
+
+@pytest.fixture
+def sim(emulator) :
+    # Simulation on the emulator with the reader thread, no bond cache and no registry
+    uart = UartDriver(port=emulator.start(), reader=1)
+    sim = Simulation(uart=uart, mode='field', setup=0)
+    sim.progress = False
+    yield sim
+    uart.close()
@@ -0,0 +1,83 @@
+import os
+import stat
+import threading
+from time import monotonic
+
+import cb_daemon
+from cb_daemon import CbDaemon
+from cb_scenario import StateMachine
+from simulate_cb import ATTEMPTS_FAILED, OUTCOMES, UnexpectedDisconnect
+
+STUCK = {
+    "name": "stuck",
+    "initial": "connect",
+    "stop": "bye",
+    "states": {
+        "connect": {"action": "reconnect", "args": {"sleep_time": 1}, "next": "end"},
+        "bye": {"action": "log", "args": {"message": "bye"}, "next": "end"}
+    }
+}
+
+
+def stuck_machine(emulator, sim) :
+    # A bait that never answers: reconnect has no deadline and dials until stopped
+    emulator.drop = 1.0
+    emulator.connect_timeout = 0.2
+    emulator.add_bait("001EC0A1B2C3,t2")
+    sim.addr = "001EC0A1B2C3,t2"
+    sim.machine = StateMachine(STUCK, sim.scenario_actions(), outcomes=OUTCOMES,
+                               disconnect=(UnexpectedDisconnect,))
+    return sim.machine
+
+
+def test_socket_created_private(sim, tmp_path) :
+    daemon = CbDaemon(sim, str(tmp_path / "cb.sock"))
+    daemon.listen()
+    try :
+        assert stat.S_IMODE(os.stat(daemon.path).st_mode) == 0o600
+    finally :
+        daemon.server.close()
+
+
+def test_stop_ends_stuck_reconnect(emulator, sim) :
+    machine = stuck_machine(emulator, sim)
+    threading.Timer(1, sim.stop).start()
+    start = monotonic()
+    # Goes through the stop state instead of dialing forever
+    assert machine.run() == 0
+    assert monotonic() - start < 5
+
+
+def test_close_waits_for_job(emulator, sim, monkeypatch) :
+    monkeypatch.setattr(cb_daemon, 'STOP_GRACE', 1)
+    machine = stuck_machine(emulator, sim)
+    # Stop states that would outlast the grace period on their own
+    machine.stop_chain = lambda : {"connect", "bye"}
+    daemon = CbDaemon(sim)
+    daemon.job = {'mode': 'stuck'}
+    daemon.job_lock.acquire()
+
+    def job() :
+        try :
+            machine.run()
+        finally :
+            daemon.job_lock.release()
+
+    worker = threading.Thread(target=job)
+    worker.start()
+    start = monotonic()
+    daemon.close()
+    # The hard cancel ended the job before the port was closed under it
+    assert not worker.is_alive()
+    assert monotonic() - start < 5
+    assert sim.uart.serial == None
+
+
+def test_failed_setup_aborts_trip(sim, monkeypatch) :
+    ran = []
+    sim.setup = 1
+    monkeypatch.setattr(sim, 'cb_setup', lambda : ATTEMPTS_FAILED)
+    sim.scenario['ota'] = lambda : ran.append(True)
+    sim.mode = 'ota'
+    assert sim.run() == ATTEMPTS_FAILED
+    assert ran == []
@@ -0,0 +1,113 @@
+import json
+import os
+import sys
+import threading
+
+from cb_events import EventLog, CRASH_DUMP_PATH, CMD, REPLY, STATE, console_line
+from cb_state import STATE_DIR
+
+
+def records(path) :
+    with open(path) as f :
+        return [json.loads(line) for line in f]
+
+
+def test_crash_dump_goes_to_the_state_dir() :
+    assert os.path.dirname(CRASH_DUMP_PATH) == STATE_DIR
+    assert os.path.isabs(CRASH_DUMP_PATH)
+
+
+def test_ring_is_bounded() :
+    log = EventLog(size=4)
+    for n in range(10) :
+        log.emit(CMD, data=b"AT%d" % n)
+    assert [e[0] for e in log.ring] == [6, 7, 8, 9]
+
+
+def test_pending_returns_each_event_once() :
+    log = EventLog(size=8)
+    log.emit(CMD, data="a")
+    log.emit(REPLY, data="OK")
+    assert [e[0] for e in log.pending()] == [0, 1]
+    assert log.pending() == []
+    log.emit(STATE, state="connected")
+    assert [e[0] for e in log.pending()] == [2]
+    assert log.dropped == 0
+
+
+def test_pending_counts_dropped_events() :
+    log = EventLog(size=4)
+    log.emit(CMD, data="first")
+    log.pending()
+    for n in range(10) :
+        log.emit(CMD, data=n)
+    # Events 1..6 were overwritten before anyone wrote them
+    assert [e[0] for e in log.pending()] == [7, 8, 9, 10]
+    assert log.dropped == 6
+
+
+def test_flush_writes_jsonl(tmp_path) :
+    path = str(tmp_path / "events.jsonl")
+    log = EventLog(path=path, interval=60)
+    log.emit(CMD, data=b"AT\r\n")
+    log.emit(REPLY, data="OK")
+    log.close()
+    written = records(path)
+    assert [r['event'] for r in written] == [CMD, REPLY]
+    assert written[0]['data'] == "AT\r\n"
+    assert written[0]['seq'] == 0
+
+
+def test_writer_thread_flushes(tmp_path) :
+    path = str(tmp_path / "events.jsonl")
+    log = EventLog(path=path, interval=0.05)
+    log.emit(STATE, state="connected")
+    try :
+        for _ in range(40) :
+            if os.path.getsize(path) :
+                break
+            threading.Event().wait(0.05)
+        assert records(path)[0]['state'] == "connected"
+    finally :
+        log.close()
+
+
+def test_dump_whole_ring_creates_directory(tmp_path) :
+    log = EventLog(size=4)
+    for n in range(3) :
+        log.emit(CMD, data=n)
+    log.pending()
+    path = str(tmp_path / "cache" / "crash.jsonl")
+    assert log.dump(path) == path
+    assert [r['data'] for r in records(path)] == [0, 1, 2]
+
+
+def test_console_line() :
+    assert console_line((0, 0, CMD, {'data': b"AT\r\n"})) == 'Enviando "AT"'
+    assert console_line((0, 0, REPLY, {'data': "OK"})) == 'Resposta do comando: "OK"'
+    assert console_line((0, 0, STATE, {'state': "connected"})) == "[STATE] state=connected"
+
+
+def test_thread_crash_dumps_the_ring(tmp_path, capsys) :
+    path = str(tmp_path / "crash.jsonl")
+    log = EventLog()
+    hooks = sys.excepthook, threading.excepthook
+    try :
+        # The previous hook is chained to, keep it quiet
+        threading.excepthook = lambda args : None
+        log.install_crash_dump(path)
+        log.emit(CMD, data="AT")
+
+        def boom() :
+            raise RuntimeError("boom")
+
+        thread = threading.Thread(target=boom, name="worker")
+        thread.start()
+        thread.join()
+    finally :
+        sys.excepthook, threading.excepthook = hooks
+    written = records(path)
+    assert written[-1]['event'] == "crash"
+    assert written[-1]['error'] == "RuntimeError: boom"
+    assert written[-1]['thread'] == "worker"
+    assert path in capsys.readouterr().err
@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+import cb_firmware
+from cb_firmware import FirmwareImage, HexError, record_checksums, split_records
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = [os.path.join(ROOT, name) for name in ("tc-bait-p2.hex", "tracker.hex")]
+
+needs_numpy = pytest.mark.skipif(cb_firmware.numpy == None, reason="numpy not installed")
+
+
+def read(path) :
+    with open(path) as f :
+        return f.read()
+
+
+def corrupt(data, starts, victim) :
+    buf = bytearray(data)
+    buf[starts[victim] + 1] ^= 0x01
+    return bytes(buf)
+
+
+@pytest.mark.parametrize("path", IMAGES)
+def test_python_checksums_clean(path) :
+    data, starts, ends = split_records(read(path), path)
+    assert record_checksums(data, starts, ends, vectorized=False) == []
+
+
+@pytest.mark.parametrize("path", IMAGES)
+def test_python_checksums_corrupted(path) :
+    data, starts, ends = split_records(read(path), path)
+    victims = [0, len(starts) // 2, len(starts) - 1]
+    buf = data
+    for victim in victims :
+        buf = corrupt(buf, starts, victim)
+    assert record_checksums(buf, starts, ends, vectorized=False) == victims
+
+
+@needs_numpy
+@pytest.mark.parametrize("path", IMAGES)
+def test_numpy_checksums_match_python(path) :
+    data, starts, ends = split_records(read(path), path)
+    assert record_checksums(data, starts, ends) == []
+    for victim in (0, len(starts) // 2, len(starts) - 1) :
+        buf = corrupt(data, starts, victim)
+        assert record_checksums(buf, starts, ends) == [victim]
+        assert record_checksums(buf, starts, ends) == record_checksums(buf, starts, ends, vectorized=False)
+
+
+@needs_numpy
+def test_numpy_checksums_wrap() :
+    # Record sums far above 255 that are still zero mod 256
+    text = ":10000000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF00\n:00000001FF\n"
+    data, starts, ends = split_records(text)
+    assert record_checksums(data, starts, ends) == []
+    assert record_checksums(data, starts, ends, vectorized=False) == []
+
+
+@pytest.mark.parametrize("path", IMAGES)
+def test_load_vector_table(path) :
+    image = FirmwareImage.load(path)
+    assert image.base == 0x08000000
+    assert image.vector_table(1)[0] & 0xFF000000 == 0x20000000
+    assert image.base <= image.reset_handler < image.base + image.size
+
+
+def test_parse_rejects_bad_checksum() :
+    text = read(IMAGES[0])
+    lines = text.split()
+    line = lines[1]
+    lines[1] = line[:-2] + "%02X" % ((int(line[-2:], 16) + 1) & 0xFF)
+    with pytest.raises(HexError, match=":2: checksum mismatch") :
+        FirmwareImage.parse("\n".join(lines), "bait.hex")
+
+
+@pytest.mark.parametrize("text, message", [
+    ("10000000\n:00000001FF\n", "malformed record"),
+    (":0200000000FE\n:00000001FF\n", "length byte"),
+    (":01000000ZZFF\n:00000001FF\n", "invalid hex digits"),
+    (":0100000000FF\n", "missing end of file"),
+    (":00000001FF\n:0100000000FF\n", "record after end of file"),
+])
+def test_parse_rejects_malformed(text, message) :
+    with pytest.raises(HexError, match=message) :
+        FirmwareImage.parse(text, "bad.hex")
+
+
+def record(addr, rtype, payload) :
+    body = bytes([len(payload), addr >> 8, addr & 0xFF, rtype]) + payload
+    return ":%s%02X" % (body.hex().upper(), -sum(body) & 0xFF)
+
+
+def test_parse_merges_segments() :
+    text = "\n".join([record(0, cb_firmware.EXT_LINEAR, b"\x01\xaa"),
+                      record(0x0002, cb_firmware.DATA, b"\x03\x04"),
+                      record(0x0000, cb_firmware.DATA, b"\x01\x02"),
+                      record(0x0010, cb_firmware.DATA, b"\x05\x06"),
+                      record(0, cb_firmware.EOF, b"")])
+    image = FirmwareImage.parse(text)
+    assert image.ranges() == [(0x01AA0000, 0x01AA0004), (0x01AA0010, 0x01AA0012)]
+    assert image.read(0x01AA0000, 6) == b"\x01\x02\x03\x04\xff\xff"
+
+
+def test_diff_reports_changed_blocks() :
+    old = FirmwareImage.load(IMAGES[0])
+    new = FirmwareImage.parse(read(IMAGES[0]))
+    assert old.diff(new) == []
+    new.segments[0][1][300] ^= 0xFF
+    assert old.diff(new, 256) == [(old.base + 256, old.base + 512)]
@@ -0,0 +1,184 @@
+import json
+from time import monotonic
+
+import pytest
+
+from cb_scenario import (StateMachine, ScenarioError, load_scenario, parse_params, available_scenarios,
+                         END, FAIL)
+from simulate_cb import OUTCOMES, ATTEMPTS_FAILED, CB_DISCONNECT, UnexpectedDisconnect
+
+
+def machine(states, initial="a", actions=None, **spec) :
+    spec.update({'name': "test", 'initial': initial, 'states': states})
+    return StateMachine(spec, actions or {}, outcomes=OUTCOMES, disconnect=(UnexpectedDisconnect,))
+
+
+class Recorder :
+    # Actions that return a scripted result per call and record the states that ran
+    def __init__(self, **results) :
+        self.results = dict((name, list(r)) for name, r in results.items())
+        self.calls = []
+
+    def action(self, name) :
+        def run(**args) :
+            self.calls.append(name)
+            script = self.results.get(name)
+            result = script.pop(0) if script and len(script) > 1 else (script[0] if script else 0)
+            if isinstance(result, type) and issubclass(result, BaseException) :
+                raise result()
+            return result
+        return run
+
+    def actions(self, *names) :
+        return dict((name, self.action(name)) for name in names)
+
+
+@pytest.mark.parametrize("name", available_scenarios())
+def test_bundled_scenarios_compile(name, sim) :
+    spec = load_scenario(name)
+    m = StateMachine(spec, sim.scenario_actions(), outcomes=OUTCOMES)
+    m.bind({})
+    # Nothing in the stop chain may wait on the bait without a bound
+    for state in m.stop_chain() :
+        if m.states[state].action == 'ensure_connected' :
+            assert 'wait_time' in m.states[state].args
+
+
+def test_load_scenario_from_path(tmp_path) :
+    path = tmp_path / "mine.json"
+    path.write_text(json.dumps({'initial': "a", 'states': {"a": {"action": "log", "args": {"message": "hi"}, "next": "end"}}}))
+    spec = load_scenario(str(path))
+    assert spec['name'] == "mine"
+    assert machine(spec['states']).run() == 0
+
+
+def test_load_scenario_errors(tmp_path) :
+    with pytest.raises(ScenarioError, match="not found") :
+        load_scenario("no_such_scenario")
+    path = tmp_path / "list.json"
+    path.write_text("[]")
+    with pytest.raises(ScenarioError, match="mapping") :
+        load_scenario(str(path))
+
+
+@pytest.mark.parametrize("states, message", [
+    ({"a": {"action": "nope", "next": "end"}}, "unknown action"),
+    ({"a": {"action": "log", "args": {"message": "x"}}}, "no ok/next"),
+    ({"a": {"action": "log", "args": {"message": "x"}, "next": "b"}}, "undefined state b"),
+    ({"a": {"action": "sleep", "args": {"seconds": "$missing"}, "next": "end"}}, "undeclared parameter"),
+])
+def test_compile_errors(states, message) :
+    with pytest.raises(ScenarioError, match=message) :
+        machine(states)
+
+
+def test_params() :
+    m = machine({"a": {"action": "log", "args": {"message": "{n} {flag}"}, "next": "end"}},
+                params={'n': {'type': 'int', 'default': 3}, 'flag': {'type': 'bool', 'default': False},
+                        'need': {'type': 'str'}})
+    assert m.bind({'need': "x", 'flag': "sim"}) == {'n': 3, 'flag': True, 'need': "x"}
+    assert parse_params(["n=5", "need = y"]) == {'n': "5", 'need': " y"}
+    with pytest.raises(ScenarioError, match="required") :
+        m.bind({})
+    with pytest.raises(ScenarioError, match="expects int") :
+        m.bind({'need': "x", 'n': "five"})
+    with pytest.raises(ScenarioError, match="unknown parameters") :
+        m.bind({'need': "x", 'other': 1})
+    with pytest.raises(ScenarioError, match="no value") :
+        parse_params(["n"])
+
+
+def test_transitions_by_outcome() :
+    r = Recorder(a=[ATTEMPTS_FAILED], b=['done'])
+    m = machine({"a": {"action": "a", "on": {"ok": "end", "ATTEMPTS_FAILED": "b"}},
+                 "b": {"action": "b", "on": {"ok": FAIL, "done": END}}}, actions=r.actions("a", "b"))
+    assert m.run() == 0
+    assert r.calls == ["a", "b"]
+
+
+def test_disconnect_goes_to_scenario_wide_transition() :
+    r = Recorder(a=[UnexpectedDisconnect])
+    m = machine({"a": {"action": "a", "next": "end"}, "lost": {"action": "lost", "next": "end"}},
+                actions=r.actions("a", "lost"), on={"disconnect": "lost"})
+    assert m.run() == 0
+    assert r.calls == ["a", "lost"]
+
+
+def test_unhandled_error_fails_with_its_code() :
+    r = Recorder(a=[ATTEMPTS_FAILED])
+    m = machine({"a": {"action": "a", "next": "end"}}, actions=r.actions("a"))
+    assert m.run() == ATTEMPTS_FAILED
+
+
+def test_retry_with_backoff() :
+    r = Recorder(a=[ATTEMPTS_FAILED, ATTEMPTS_FAILED, 0])
+    m = machine({"a": {"action": "a", "retry": {"attempts": 3, "delay": 0.05, "backoff": 2}, "next": "end"}},
+                actions=r.actions("a"))
+    start = monotonic()
+    assert m.run() == 0
+    assert r.calls == ["a"] * 3
+    assert monotonic() - start == pytest.approx(0.15, abs=0.1)
+
+
+def test_timeout_bounds_retries() :
+    r = Recorder(a=[ATTEMPTS_FAILED])
+    m = machine({"a": {"action": "a", "timeout": 0.3, "retry": {"attempts": 0, "delay": 0.05},
+                       "on": {"ok": "end", "timeout": "late"}},
+                 "late": {"action": "log", "args": {"message": "late"}, "next": "end"}}, actions=r.actions("a"))
+    start = monotonic()
+    assert m.run() == 0
+    assert monotonic() - start < 0.6
+    assert len(r.calls) > 2
+
+
+def test_sleep_past_the_deadline_is_a_timeout() :
+    m = machine({"a": {"action": "sleep", "args": {"seconds": 5}, "timeout": 0.2, "on": {"ok": FAIL, "timeout": END}}})
+    start = monotonic()
+    assert m.run() == 0
+    assert monotonic() - start < 1
+    assert m.deadline == None
+
+
+def test_actions_see_the_state_deadline() :
+    seen = []
+    m = machine({"a": {"action": "a", "timeout": 10, "next": "b"}, "b": {"action": "a", "next": "end"}},
+                actions={'a': lambda : seen.append(m.deadline)})
+    start = monotonic()
+    m.run()
+    assert start + 9 < seen[0] <= monotonic() + 10
+    assert seen[1] == None
+
+
+def test_interrupt_runs_the_stop_chain() :
+    r = Recorder(loop=[KeyboardInterrupt])
+    m = machine({"a": {"action": "loop", "next": "a"},
+                 "finish": {"action": "finish", "next": "bye"},
+                 "bye": {"action": "bye", "next": "end"}},
+                actions=r.actions("loop", "finish", "bye"), stop="finish")
+    assert m.run() == 0
+    assert r.calls == ["loop", "finish", "bye"]
+
+
+def test_stop_diverts_to_the_stop_chain() :
+    r = Recorder()
+    machines = []
+    actions = r.actions("finish")
+    actions['tick'] = lambda : machines[0].stop()
+    m = machine({"a": {"action": "tick", "next": "a"},
+                 "finish": {"action": "finish", "next": "end"}}, actions=actions, stop="finish")
+    machines.append(m)
+    assert m.run() == 0
+    assert r.calls == ["finish"]
+
+
+def test_stop_chain_gives_up_on_a_missing_bait(emulator, sim) :
+    # The bait is never there: finish must not dial forever
+    emulator.connect_timeout = 0.2
+    sim.addr = "001EC0A1B2C3,t2"
+    sim.actual_state = CB_DISCONNECT
+    sim.machine = machine({"finish": {"action": "ensure_connected", "args": {"sleep_time": 1, "wait_time": 1},
+                                      "on": {"ok": "end", "done": "end"}}},
+                          initial="finish", actions=sim.scenario_actions(), stop="finish")
+    start = monotonic()
+    assert sim.machine.run() != 0
+    assert monotonic() - start < 5
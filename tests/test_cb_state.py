@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+
+from cb_state import BondCache, BaitRegistry
+
+
+def read(path) :
+    with open(path) as f :
+        return json.load(f)
+
+
+def test_mark_saves_at_once(tmp_path) :
+    path = str(tmp_path / "bonds.json")
+    bonds = BondCache(path)
+    bonds.mark("EXT", "001EC0A1B2C3")
+    assert "001EC0A1B2C3" in read(path)["EXT"]
+    assert BondCache(path).is_bonded("EXT", "001EC0A1B2C3")
+
+
+def test_save_later_written_by_worker(tmp_path) :
+    path = str(tmp_path / "bonds.json")
+    bonds = BondCache(path)
+    saved = threading.Event()
+    threads = []
+    save = bonds.save
+
+    def recording_save() :
+        threads.append(threading.current_thread().name)
+        save()
+        saved.set()
+
+    bonds.save = recording_save
+    bonds.mark("EXT", "001EC0A1B2C3", later=True)
+    assert bonds.is_bonded("EXT", "001EC0A1B2C3")
+    assert saved.wait(2)
+    assert threads == ["state-saver"]
+    assert "001EC0A1B2C3" in read(path)["EXT"]
+    bonds.invalidate("EXT", "001EC0A1B2C3", later=True)
+    assert bonds.flush()
+    assert read(path)["EXT"] == {}
+
+
+def test_flush_failure_is_logged_and_kept(tmp_path, capsys) :
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    bonds = BondCache(str(blocker / "bonds.json"))
+    bonds.dirty = True
+    assert not bonds.flush()
+    assert "falha ao salvar" in capsys.readouterr().out
+    assert bonds.dirty
+
+
+def test_registry_resolve(tmp_path) :
+    registry = BaitRegistry(str(tmp_path / "baits.json"))
+    registry.seen("001EC0A1B2C3,t2", "ISCA TC-P2 B2C3")
+    for key in ("001EC0A1B2C3,t2", "001EC0A1B2C3", "001ec0a1b2c3", "ISCA TC-P2 B2C3") :
+        assert registry.resolve(key) == "001EC0A1B2C3,t2"
+    assert registry.resolve("001EC0A1B2C4") == None
+
+
+def test_bond_event_not_saved_on_reader(emulator, sim, tmp_path) :
+    emulator.add_bait("001EC0A1B2C3")
+    bonds = sim.bonds = BondCache(str(tmp_path / "bonds.json"))
+    sim.uart.listeners.append(sim.on_bond_event)
+    threads = []
+    save = bonds.save
+
+    def recording_save() :
+        threads.append(threading.current_thread().name)
+        save()
+
+    bonds.save = recording_save
+    assert sim.connect("001EC0A1B2C3,t2") == 0
+    assert sim.bounding() == 0
+    assert bonds.flush()
+    assert "uart-reader" not in threads
+    assert bonds.is_bonded(sim.extender_id(), "001EC0A1B2C3")
+    assert os.path.exists(bonds.path)
@@ -0,0 +1,44 @@
+from time import monotonic
+
+from cb_state import BaitRegistry
+
+
+def registry_with(sim, tmp_path, addr, times=None) :
+    sim.registry = BaitRegistry(str(tmp_path / "baits.json"))
+    sim.registry.seen(addr, "ISCA TC-P2 B2C3")
+    if times :
+        sim.registry.configured(addr, times)
+    return sim.registry
+
+
+def test_known_bait_dialled_without_scan(emulator, sim, tmp_path) :
+    emulator.add_bait("001EC0A1B2C3")
+    registry_with(sim, tmp_path, "001EC0A1B2C3,t2")
+    assert sim.find_target("001EC0A1B2C3") == "001EC0A1B2C3,t2"
+    assert sim.scan_table.devices == {}
+    assert emulator.connected
+    sim.addr = "001EC0A1B2C3,t2"
+    # The connect after the search uses the link that is already up, once
+    assert sim.take_dialed()
+    assert not sim.take_dialed()
+
+
+def test_stale_registry_entry_falls_back_to_scan(emulator, sim, tmp_path) :
+    emulator.connect_timeout = 0.2
+    emulator.add_bait("001EC0A1B2C3,t1")
+    registry_with(sim, tmp_path, "001EC0A1B2C3,t2", {'static_sleep_time': 1, 'static_wait_time': 1})
+    start = monotonic()
+    assert sim.find_target("001EC0A1B2C3") == "001EC0A1B2C3,t1"
+    # Dialled for one sleep and wait of the bait before scanning
+    assert monotonic() - start >= 2
+    assert not emulator.connected
+    assert sim.dialed == None
+
+
+def test_hint_respects_deadline(emulator, sim, tmp_path) :
+    emulator.connect_timeout = 0.2
+    sim.scan_attempts = 1
+    registry_with(sim, tmp_path, "001EC0A1B2C3,t2", {'static_sleep_time': 60, 'static_wait_time': 10})
+    start = monotonic()
+    assert sim.find_target("001EC0A1B2C3", deadline=monotonic() + 1) == ""
+    assert monotonic() - start < 5
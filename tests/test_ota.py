@@ -0,0 +1,35 @@
+from cb_scenario import StateMachine
+from simulate_cb import OUTCOMES, ATTEMPTS_FAILED, UnexpectedDisconnect
+
+SPEC = {'name': "ota_test",
+        'initial': "ota",
+        'stop': "bye",
+        'states': {"ota": {"action": "ota", "on": {"ok": "end", "error": "bye"}},
+                   "bye": {"action": "disconnect", "on": {"ok": "failed", "error": "failed"}},
+                   "failed": {"action": "log", "args": {"message": "ota failed"}, "next": "fail"}}}
+
+
+def run_ota(sim) :
+    sim.machine = StateMachine(SPEC, sim.scenario_actions(), outcomes=OUTCOMES, disconnect=(UnexpectedDisconnect,))
+    return sim.machine.run()
+
+
+def test_missing_image_takes_the_fail_transition(sim, tmp_path, capsys) :
+    sim.firmware = str(tmp_path / "missing.hex")
+    assert run_ota(sim) == -1
+    out = capsys.readouterr().out
+    assert "missing.hex" in out
+    assert "ota failed" in out
+
+
+def test_corrupted_image_takes_the_fail_transition(sim, tmp_path, capsys) :
+    bad = tmp_path / "bad.hex"
+    bad.write_text(":0100000000FE\n:00000001FF\n")
+    sim.firmware = str(bad)
+    assert run_ota(sim) == -1
+    assert "checksum mismatch" in capsys.readouterr().out
+
+
+def test_cli_ota_rejects_bad_image(sim, tmp_path) :
+    sim.firmware = str(tmp_path / "missing.hex")
+    assert sim.bait_ota() == ATTEMPTS_FAILED
@@ -0,0 +1,82 @@
+from simulate_cb import ScanTable
+
+
+def test_feed_parses_scan_lines() :
+    table = ScanTable()
+    device = table.feed('001ec0a1b2c3,t2 -61 "ISCA TC-P2 B2C3"')
+    assert device.addr == "001EC0A1B2C3,t2"
+    assert device.addr_type == "t2"
+    assert device.rssi == -61
+    assert device.name == "ISCA TC-P2 B2C3"
+    assert device.seen == 1
+
+
+def test_feed_ignores_other_lines() :
+    table = ScanTable()
+    for line in ("OK", "ERROR", "", "AT+LESCAN=GATT", "001EC0A1B2C3 -61", "CONNECT 001EC0A1B2C3,t2") :
+        assert table.feed(line) == None
+    assert table.devices == {}
+
+
+def test_feed_merges_repeated_advertisements() :
+    table = ScanTable()
+    table.feed('001EC0A1B2C3,t2 -70 "ISCA TC-P2 B2C3"')
+    device = table.feed("001EC0A1B2C3,t2 -55")
+    assert len(table.devices) == 1
+    # A line without a name keeps the one already known
+    assert device.name == "ISCA TC-P2 B2C3"
+    assert device.rssi == -55
+    assert device.seen == 2
+
+
+def test_feed_without_rssi() :
+    table = ScanTable()
+    device = table.feed('001EC0A1B2C3,t1 "ISCA TC-P2 B2C3"')
+    assert device.rssi == None
+    assert device.name == "ISCA TC-P2 B2C3"
+
+
+def test_find_by_address_or_name() :
+    table = ScanTable()
+    table.feed('001EC0A1B2C3,t2 -61 "ISCA TC-P2 B2C3"')
+    for key in ("001EC0A1B2C3,t2", "001ec0a1b2c3,t2", "001EC0A1B2C3", "001ec0a1b2c3", "ISCA TC-P2 B2C3") :
+        assert table.find(key).addr == "001EC0A1B2C3,t2"
+    assert table.find("001EC0A1B2C4") == None
+    assert table.find("isca tc-p2 b2c3") == None
+
+
+def test_baits_only_named_baits_in_order() :
+    table = ScanTable()
+    table.feed('00AA00000001,t1 -80 "Device 0"')
+    table.feed('001EC0A1B2C4,t2 -61 "ISCA TC-P2 B2C4"')
+    table.feed('001EC0A1B2C3,t2 -61 "ISCA TC-P2 B2C3"')
+    table.feed('001EC0A1B2C4,t2 -50')
+    assert [d.addr for d in table.baits()] == ["001EC0A1B2C4,t2", "001EC0A1B2C3,t2"]
+
+
+def test_expire() :
+    table = ScanTable(ttl=60)
+    old = table.feed('001EC0A1B2C3,t2 -61 "ISCA TC-P2 B2C3"')
+    table.feed('001EC0A1B2C4,t2 -61 "ISCA TC-P2 B2C4"')
+    old.last_seen -= 61
+    table.expire()
+    assert list(table.devices) == ["001EC0A1B2C4,t2"]
+
+
+def test_scan_fills_table(emulator, sim) :
+    emulator.noise = 5
+    emulator.add_bait("001EC0A1B2C3")
+    assert sim.scan() == 0
+    assert len(sim.scan_table.devices) == 6
+    assert [d.addr for d in sim.scan_table.baits()] == ["001EC0A1B2C3,t2"]
+
+
+def test_scan_for_target_stops_early(emulator, sim) :
+    emulator.noise = 20
+    emulator.scan_time = 2
+    emulator.add_bait("001EC0A1B2C3")
+    assert sim.find_target("001EC0A1B2C3") == "001EC0A1B2C3,t2"
+    assert emulator.scanning == None
+    # The stopped scan left no OK behind for the next command
+    assert sim.uart.transport_msg(attempts=1, timeout=2, data="AT+BOAD", expected="OK") == 0
+    assert emulator.own_addr in sim.uart.full_response
@@ -0,0 +1,62 @@
+from time import monotonic
+
+import pytest
+
+from cb_emulator import CbEmulator
+from simulate_cb import UartDriver, ATTEMPTS_FAILED, split_replies, setting_value
+
+
+class StallingEmulator(CbEmulator) :
+    # Holds back every reply for `stall` seconds once `slow` is received, in order, as a busy
+    # extender does
+    def __init__(self, slow, stall, **kwargs) :
+        CbEmulator.__init__(self, **kwargs)
+        self.slow = slow
+        self.stall = stall
+        self.stall_until = 0
+
+    def handle_command(self, cmd) :
+        if cmd == self.slow :
+            self.stall_until = monotonic() + self.stall
+        CbEmulator.handle_command(self, cmd)
+
+    def reply(self, *lines, delay=0) :
+        CbEmulator.reply(self, *lines, delay=delay + max(0, self.stall_until - monotonic()))
+
+
+@pytest.fixture
+def stalled() :
+    emulator = StallingEmulator("AT+LETIO=1", 0.8, seed=1)
+    uart = UartDriver(port=emulator.start(), reader=1, window=4)
+    yield emulator, uart
+    uart.close()
+    emulator.stop()
+
+
+def test_batch_stops_after_timeout(stalled) :
+    emulator, uart = stalled
+    cmds = ["AT+LETIO=%d" % n for n in range(6)]
+    results = uart.transport_batch(cmds, timeout=0.5)
+    assert results == [0] + [ATTEMPTS_FAILED] * 5
+    # The window refilled once, nothing was sent after the timeout
+    assert emulator.settings['LETIO'] == '4'
+
+
+def test_late_replies_not_credited(stalled) :
+    emulator, uart = stalled
+    uart.transport_batch(["AT+LETIO=%d" % n for n in range(6)], timeout=0.5)
+    assert uart.transport_msg(attempts=1, timeout=2, data="AT+LETIO?", expected="OK") == 0
+    replies = split_replies(uart.full_response)
+    assert setting_value("LETIO", replies[-1][1]) == '4'
+
+
+def test_batch_without_timeout() :
+    emulator = CbEmulator(seed=1)
+    uart = UartDriver(port=emulator.start(), reader=1, window=4)
+    try :
+        results = uart.transport_batch(["AT+LETIO=%d" % n for n in range(6)] + ["AT+NOPE"], timeout=2)
+        assert results == [0] * 6 + [ATTEMPTS_FAILED]
+        assert emulator.settings['LETIO'] == '5'
+    finally :
+        uart.close()
+        emulator.stop()
@@ -0,0 +1,92 @@
+import heapq
+import random
+from time import monotonic
+
+import pytest
+
+from simulate_cb import WakePredictor, BaitScheduler, BACKOFF_BASE, BACKOFF_MAX, WAKE_LEAD
+
+
+def test_next_attempt_leads_the_wake() :
+    predictor = WakePredictor(60)
+    assert predictor.next_attempt(1000) == 1000 + 60 - WAKE_LEAD
+
+
+def test_observe_learns_a_slow_clock() :
+    predictor = WakePredictor(60)
+    tid = 0.0
+    for _ in range(40) :
+        # Dialled ahead of the wake, the extender held ATD until the bait answered at 63s
+        predictor.observe(tid, tid + predictor.next_attempt(0), tid + 63)
+        tid += 100
+    assert predictor.period == pytest.approx(63, abs=0.05)
+    assert predictor.drift == pytest.approx(0.05, abs=0.001)
+    assert predictor.samples == 40
+    assert predictor.next_attempt(0) < 63
+
+
+def test_immediate_connect_only_lowers_the_period() :
+    predictor = WakePredictor(60)
+    # Connected at once at 70s: the bait may have woken any time before, no new sample
+    predictor.observe(0, 70, 70.1)
+    assert predictor.period == 60
+    predictor.observe(0, 50, 50.1)
+    assert predictor.period < 60
+    assert predictor.samples == 0
+
+
+def test_backoff_doubles_with_jitter_up_to_the_cap() :
+    random.seed(1)
+    predictor = WakePredictor(60)
+    for n in range(12) :
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n)
+        assert delay / 2 <= predictor.backoff() <= delay
+    assert predictor.failures == 12
+    predictor.observe(0, 59, 60)
+    assert predictor.failures == 0
+
+
+def test_nominal_zero() :
+    predictor = WakePredictor(0)
+    assert predictor.drift == 0.0
+    assert predictor.next_attempt(100) == 100 - WAKE_LEAD
+
+
+class ScriptedSim :
+    # Stand in for Simulation: the scheduler only needs predictor() here
+    def __init__(self) :
+        self.predictors = {}
+
+    def predictor(self, addr, sleep_time) :
+        return self.predictors.setdefault(addr, WakePredictor(sleep_time))
+
+
+def test_scheduler_orders_by_wake() :
+    scheduler = BaitScheduler(ScriptedSim(), 60, 10, 30, 10)
+    now = monotonic()
+    scheduler.add("A", wake=now + 30)
+    scheduler.add("B", wake=now + 10)
+    scheduler.add("C", wake=now + 20)
+    scheduler.add("D", wake=now + 10)
+    assert scheduler.next_due() == now + 10
+    order = [heapq.heappop(scheduler.heap)[2] for _ in range(4)]
+    # Equal wakes keep the order they were added in
+    assert order == ["B", "D", "C", "A"]
+    assert scheduler.next_due() == None
+
+
+def test_scheduler_serves_every_bait(emulator, sim) :
+    addrs = ["001EC0A1B2C%d,t2" % n for n in range(3)]
+    for addr in addrs :
+        emulator.add_bait(addr, bonded=True)
+    sim.uart.transport_msg(attempts=1, timeout=2, data="AT+BOAD", expected="OK")
+    scheduler = BaitScheduler(sim, 2, 1, 30, 10)
+    for addr in addrs :
+        scheduler.add(addr)
+    start = monotonic()
+    assert scheduler.run(cycles=2) == 0
+    assert monotonic() - start < 20
+    for addr in addrs :
+        assert scheduler.baits[addr]['cycles'] == 2
+        assert emulator.baits[addr].attrs[0x0029] == 0
+        assert emulator.baits[addr].attrs[0x0030] == 2